@@ -0,0 +1,138 @@
+"""
+Download memory benchmark.
+
+Serves a large synthetic file from the FakeStreamingService and downloads it
+with onthespot.http_download in a separate interpreter, reporting how much
+memory the transfer itself needed. Memory per worker should not grow with the
+file size.
+
+Usage:
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --file-size 500000000 --segments 4
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-size', type=int, default=200 * 1024 * 1024, help='Size of the stand-in file in bytes')
+    parser.add_argument('--segments', type=int, default=1, help='Parallel Range requests (download_segments)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='download_chunk_size override')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        return 0.0
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_download(args, work_dir):
+    for name in ('config', 'cache', 'music'):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    os.environ['ONTHESPOTDIR'] = os.path.join(work_dir, 'config')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+    from onthespot.otsconfig import config
+    from onthespot.http_download import download_resumable
+
+    config.set('download_segments', args.segments)
+    config.set('segmented_download_min_size_mb', 0)
+    if args.chunk_size:
+        config.set('download_chunk_size', args.chunk_size)
+    # Written now, the exit handler would otherwise recreate the removed work_dir
+    config.flush()
+
+    temp_file_path = os.path.join(work_dir, 'music', '~benchmark.flac')
+    item = {'item_status': 'Downloading'}
+
+    rss_before = current_rss_mb()
+    peak_before = peak_rss_mb()
+    tracemalloc.start()
+    start = time.time()
+    download_resumable(args.url, temp_file_path, item, lambda progress: None)
+    elapsed = time.time() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'file_size': os.path.getsize(temp_file_path),
+        'segments': args.segments,
+        'elapsed_s': elapsed,
+        'mb_per_s': os.path.getsize(temp_file_path) / max(elapsed, 1e-9) / (1024 * 1024),
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_growth_mb': max(0.0, peak_rss_mb() - max(peak_before, rss_before)),
+        'traced_peak_mb': traced_peak / (1024 * 1024),
+    }
+
+
+def main():
+    args = parse_args()
+    if args.url:
+        work_dir = tempfile.mkdtemp(prefix='ots-bench-')
+        try:
+            print(json.dumps(run_download(args, work_dir)))
+        finally:
+            # The downloaded stand-in file is as large as --file-size
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return
+
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fake_service import FakeStreamingService
+
+    # The payload lives in this process, only the downloader's memory is measured
+    service = FakeStreamingService(file_size=args.file_size)
+    service.start()
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--url', service.get_file_url(None, 'benchmark'),
+                   '--segments', str(args.segments)]
+        if args.chunk_size:
+            command += ['--chunk-size', str(args.chunk_size)]
+        env = dict(os.environ, LOG_LEVEL='30')
+        output = subprocess.run(command, capture_output=True, text=True, env=env)
+    finally:
+        service.stop()
+    if output.returncode != 0:
+        print(output.stderr, file=sys.stderr)
+        sys.exit(output.returncode)
+
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    if args.json:
+        print(json.dumps(result, indent=4))
+        return
+    print(f"File size:          {result['file_size'] / (1024 * 1024):.1f} MB in {result['segments']} segment(s)")
+    print(f"Throughput:         {result['mb_per_s']:.1f} MB/s")
+    print(f"RSS before:         {result['rss_before_mb']:.1f} MB")
+    print(f"Peak RSS growth:    {result['peak_rss_growth_mb']:.1f} MB")
+    print(f"Traced peak:        {result['traced_peak_mb']:.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+End-to-end download pipeline benchmark.
+
+Runs the real parsingworker -> QueueWorker -> DownloadWorker pipeline against
+the local FakeStreamingService and reports throughput, per-stage latency
+percentiles, peak RSS and how long threads waited for download_queue_lock.
+Every playlist size runs in its own interpreter so peak RSS is not polluted by
+the previous run.
+
+Usage:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --sizes 1000 --file-size 2000000 --latency 0.02 --rate-limit 0.05
+    python benchmarks/bench_pipeline.py --sizes 10000 --workers 16 --readers 2
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TERMINAL_STATUSES = ('Downloaded', 'Already Exists', 'Failed', 'Unavailable', 'Cancelled')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='Playlist sizes to benchmark')
+    parser.add_argument('--format', choices=('flac', 'mp3'), default='flac', help='Synthetic payload served by the fake service')
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='Payload size in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added before every response')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Per-connection download rate in bytes/s (0 for unlimited)')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Fraction of API requests answered with 429')
+    parser.add_argument('--workers', type=int, default=None, help='Download workers (defaults to maximum_download_workers)')
+    parser.add_argument('--segments', type=int, default=1, help='Parallel Range requests per file (download_segments)')
+    parser.add_argument('--readers', type=int, default=0, help='Threads polling /api/download_queue 10 times per second, like the web UI')
+    parser.add_argument('--timeout', type=float, default=3600, help='Give up on a run after this many seconds')
+    parser.add_argument('--log-level', type=int, default=30, help='Numeric LOG_LEVEL passed to onthespot (20 is INFO, 30 is WARNING)')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary config, cache and downloads of each run')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+class TimedLock:
+    """Stands in for download_queue_lock and records how long every acquisition waited."""
+    def __init__(self, lock):
+        self.lock = lock
+        self.waits = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            # Appended while holding the lock, no further synchronisation needed
+            self.waits.append(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_single(args, size, work_dir):
+    # Isolate config, cache and downloads before anything from onthespot is imported
+    for name in ('config', 'cache', 'music'):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    os.environ['ONTHESPOTDIR'] = os.path.join(work_dir, 'config')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+    os.environ['LOG_LEVEL'] = str(args.log_level)
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from onthespot.otsconfig import config
+    from onthespot import runtimedata
+    # Installed before the modules that import the lock by name
+    queue_lock = TimedLock(runtimedata.download_queue_lock)
+    runtimedata.download_queue_lock = queue_lock
+    from onthespot.runtimedata import account_pool, download_queue, parsing, parsing_lock
+    from onthespot import downloader, parse_item, web
+    from fake_service import FakeStreamingService
+
+    config.set('audio_download_path', os.path.join(work_dir, 'music'))
+    config.set('raw_media_download', True)
+    config.set('download_delay', 0)
+    config.set('save_album_cover', False)
+    config.set('embed_cover', False)
+    config.set('download_lyrics', False)
+    config.set('create_m3u_file', False)
+    config.set('rotate_active_account_number', False)
+    config.set('active_account_number', 0)
+    config.set('download_segments', args.segments)
+    # Segment every file so the option has an effect on synthetic payloads
+    config.set('segmented_download_min_size_mb', 0)
+    config.save()
+
+    # The pseudo-service occupies the qobuz slot, its download branch is a plain HTTP stream
+    service = FakeStreamingService(
+        file_format=args.format,
+        file_size=args.file_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        rate_limit=args.rate_limit
+    )
+    service.install('qobuz')
+    service.start()
+    account_pool.append({
+        "uuid": "benchmark",
+        "username": "benchmark",
+        "service": "qobuz",
+        "status": "active",
+        "account_type": "premium",
+        "bitrate": "1411k",
+        "login": {}
+    })
+
+    started = {}
+    finished = {}
+    record_lock = threading.Lock()
+
+    class BenchDownloadWorker(downloader.DownloadWorker):
+        def update_progress(self, item, status, progress_value):
+            super().update_progress(item, status, progress_value)
+            now = time.time()
+            with record_lock:
+                if status == 'Downloading':
+                    started.setdefault(item['local_id'], now)
+                elif status in TERMINAL_STATUSES:
+                    finished[item['local_id']] = now
+
+    playlist_id = f'bench{size}'
+    service.add_playlist(playlist_id, size)
+
+    threading.Thread(target=parse_item.parsingworker, daemon=True).start()
+    queue_worker = web.QueueWorker()
+    queue_worker.daemon = True
+    queue_worker.start()
+    workers = []
+    for _ in range(args.workers or config.get('maximum_download_workers')):
+        worker = BenchDownloadWorker()
+        worker.thread.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    stop_readers = threading.Event()
+
+    def poll_download_queue():
+        client = web.app.test_client()
+        while not stop_readers.is_set():
+            client.get('/api/download_queue')
+            time.sleep(0.1)
+
+    web.app.config['LOGIN_DISABLED'] = True
+    for _ in range(args.readers):
+        threading.Thread(target=poll_download_queue, daemon=True).start()
+
+    submit_time = time.time()
+    with parsing_lock:
+        parsing[playlist_id] = {
+            'item_url': f'{service.base_url}/playlist/{playlist_id}',
+            'item_service': 'qobuz',
+            'item_type': 'playlist',
+            'item_id': playlist_id
+        }
+
+    timed_out = False
+    while True:
+        with record_lock:
+            done = len(finished)
+        if done >= size:
+            break
+        if time.time() - submit_time > args.timeout:
+            timed_out = True
+            break
+        time.sleep(0.1)
+    end_time = max(finished.values()) if finished else time.time()
+
+    stop_readers.set()
+    with queue_lock:
+        items = list(download_queue.values())
+    total_bytes = 0
+    statuses = {}
+    for item in items:
+        statuses[item['item_status']] = statuses.get(item['item_status'], 0) + 1
+        if isinstance(item.get('file_path'), str) and os.path.isfile(item['file_path']):
+            total_bytes += os.path.getsize(item['file_path'])
+
+    # queue: submit until QueueWorker fetched metadata, wait: until a DownloadWorker
+    # picked the item up, download: transfer and post-processing.
+    # Metadata timestamps are keyed by service id, pipeline timestamps by local id
+    queue_latency = []
+    wait_latency = []
+    download_latency = []
+    total_latency = []
+    for item in items:
+        local_id = item['local_id']
+        if local_id not in finished:
+            continue
+        metadata_time = service.stats.first_metadata_time.get(item['item_id'], submit_time)
+        start_time = started.get(local_id, finished[local_id])
+        queue_latency.append(metadata_time - submit_time)
+        wait_latency.append(start_time - metadata_time)
+        download_latency.append(finished[local_id] - start_time)
+        total_latency.append(finished[local_id] - submit_time)
+
+    elapsed = max(end_time - submit_time, 1e-9)
+    result = {
+        'size': size,
+        'completed': len(finished),
+        'timed_out': timed_out,
+        'statuses': statuses,
+        'elapsed_s': elapsed,
+        'items_per_s': len(finished) / elapsed,
+        'mb_per_s': total_bytes / elapsed / (1024 * 1024),
+        'peak_rss_mb': peak_rss_mb(),
+        'requests': service.stats.requests,
+        'rate_limited': service.stats.rate_limited,
+        'lock_wait': {
+            'acquisitions': len(queue_lock.waits),
+            'total_s': sum(queue_lock.waits),
+            'p99_ms': percentile(queue_lock.waits, 99) * 1000,
+            'max_ms': max(queue_lock.waits, default=0.0) * 1000
+        },
+        'stages': {}
+    }
+    for name, values in (('queue', queue_latency), ('wait', wait_latency), ('download', download_latency), ('end_to_end', total_latency)):
+        result['stages'][name] = {'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+
+    for worker in workers:
+        worker.is_running = False
+    queue_worker.is_running = False
+    service.stop()
+    return result
+
+
+def print_report(results):
+    print(f"{'items':>8} {'done':>8} {'secs':>9} {'items/s':>9} {'MB/s':>8} {'RSS MB':>8} {'429s':>6}")
+    for result in results:
+        print(
+            f"{result['size']:>8} {result['completed']:>8} {result['elapsed_s']:>9.1f} {result['items_per_s']:>9.2f} "
+            f"{result['mb_per_s']:>8.2f} {result['peak_rss_mb']:>8.1f} {result['rate_limited']:>6}"
+            + ("  (timed out)" if result['timed_out'] else "")
+        )
+    print()
+    print(f"{'items':>8} {'stage':>11} {'p50 s':>9} {'p99 s':>9}")
+    for result in results:
+        for stage, values in result['stages'].items():
+            print(f"{result['size']:>8} {stage:>11} {values['p50']:>9.3f} {values['p99']:>9.3f}")
+    print()
+    print(f"{'items':>8} {'lock acqs':>10} {'wait s':>9} {'p99 ms':>9} {'max ms':>9}")
+    for result in results:
+        lock_wait = result['lock_wait']
+        print(
+            f"{result['size']:>8} {lock_wait['acquisitions']:>10} {lock_wait['total_s']:>9.3f} "
+            f"{lock_wait['p99_ms']:>9.3f} {lock_wait['max_ms']:>9.3f}"
+        )
+
+
+def main():
+    args = parse_args()
+    if args.single:
+        work_dir = tempfile.mkdtemp(prefix='ots-bench-')
+        try:
+            result = run_single(args, args.single, work_dir)
+            if args.keep:
+                result['work_dir'] = work_dir
+            print(json.dumps(result))
+        finally:
+            if not args.keep:
+                # A run of 50000 items with the default file size leaves about 50 GB behind
+                shutil.rmtree(work_dir, ignore_errors=True)
+        # Worker threads are daemons but the pipeline never joins them, exit hard
+        sys.stdout.flush()
+        os._exit(0)
+
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size)]
+        for option in ('format', 'file_size', 'latency', 'bandwidth', 'rate_limit', 'workers', 'segments', 'readers', 'timeout', 'log_level'):
+            value = getattr(args, option)
+            if value is not None:
+                command += [f"--{option.replace('_', '-')}", str(value)]
+        if args.keep:
+            command.append('--keep')
+        print(f"Running pipeline benchmark with {size} items...", file=sys.stderr)
+        output = subprocess.run(command, capture_output=True, text=True)
+        if output.returncode != 0:
+            print(output.stderr, file=sys.stderr)
+            continue
+        # onthespot logs to stdout as well, the result is the last line
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        if args.keep:
+            print(f"Kept the files of this run in {results[-1]['work_dir']}", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
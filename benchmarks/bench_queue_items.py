@@ -0,0 +1,112 @@
+"""
+Queue item memory benchmark.
+
+Builds download queue entries the way the QueueWorker does, once as plain
+dicts and once as onthespot.queue_item.QueueItem records, and reports the
+memory they hold and the time of the full-queue JSON dump served by
+/api/download_queue. Values that come from API responses are built at runtime
+so they are distinct string objects, as they are after JSON decoding.
+
+Usage:
+    python benchmarks/bench_queue_items.py
+    python benchmarks/bench_queue_items.py --items 50000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ('spotify', 'qobuz', 'deezer', 'tidal')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='Number of queue entries')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    return parser.parse_args()
+
+
+def runtime_str(value):
+    # A fresh, non-interned copy like json.loads would produce
+    return ''.join(list(value))
+
+
+def build_entry(index):
+    service = SERVICES[index % len(SERVICES)]
+    item_id = f"{index:022d}"
+    local_id = f"{item_id}-0"
+    return {
+        'local_id': local_id,
+        'available': True,
+        'item_service': runtime_str(service),
+        'item_type': runtime_str('track'),
+        'item_id': item_id,
+        'item_status': runtime_str('Waiting'),
+        'file_path': None,
+        'item_name': f"Track {index}",
+        'item_by': f"Artist {index % 500}",
+        'parent_category': runtime_str('playlist'),
+        'playlist_name': runtime_str('Benchmark Playlist'),
+        'playlist_by': runtime_str('benchmark'),
+        'playlist_number': str(index + 1),
+        'playlist_total': 0,
+        'playlist_sync_key': None,
+        'priority': runtime_str('bulk'),
+        'user': runtime_str('admin'),
+        'track_number': index % 20 + 1,
+        'album_name': f"Album {index // 12}",
+        'item_album_name': f"Album {index // 12}",
+        'item_thumbnail': f"https://images.example.com/{index // 12:010d}.jpg",
+        'item_url': f"https://open.example.com/track/{item_id}",
+        'progress': 0,
+        'last_update_time': time.time()
+    }
+
+
+def measure(count, wrap):
+    tracemalloc.start()
+    queue = {}
+    for index in range(count):
+        entry = build_entry(index)
+        queue[entry['local_id']] = wrap(entry)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    payload = json.dumps(queue, sort_keys=True, default=lambda item: item.to_dict())
+    dump_time = time.perf_counter() - start
+    return {'held_mb': held / (1024 * 1024), 'json_dump_s': dump_time, 'json_bytes': len(payload)}
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    # Only the stdlib module is needed, avoid importing the package and its dependencies
+    sys.path.insert(0, os.path.join(ROOT, 'src', 'onthespot'))
+    from queue_item import QueueItem
+
+    results = {
+        'items': args.items,
+        'dict': measure(args.items, dict),
+        'queue_item': measure(args.items, QueueItem)
+    }
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    per_10k = 10000 / args.items
+    print(f"{args.items} queue entries")
+    for name in ('dict', 'queue_item'):
+        result = results[name]
+        print(f"{name:<12} {result['held_mb']:8.1f} MB held ({result['held_mb'] * per_10k:.1f} MB per 10k), "
+              f"JSON dump {result['json_dump_s'] * 1000:.0f} ms")
+    saved = 1 - results['queue_item']['held_mb'] / results['dict']['held_mb']
+    print(f"QueueItem saves {saved:.0%}")
+
+
+if __name__ == '__main__':
+    main()
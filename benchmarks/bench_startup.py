@@ -0,0 +1,84 @@
+"""
+Cold-start benchmark.
+
+Imports an onthespot entry module in a fresh interpreter with
+`python -X importtime` and reports the total import time, peak RSS and which
+heavy provider dependencies were loaded. The slowest imports are listed so
+regressions in lazy loading are easy to spot.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --module onthespot.cli --top 30
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('librespot', 'yt_dlp', 'Cryptodome', 'pywidevine', 'google.protobuf', 'PIL', 'mutagen', 'music_tag', 'm3u8')
+IMPORTTIME_REGEX = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<name>\S+)')
+
+# Runs in the child: import the module, then report peak RSS and loaded heavy modules
+CHILD_SCRIPT = """
+import importlib, json, resource, sys
+importlib.import_module({module!r})
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    'peak_rss_mb': peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024,
+    'heavy': sorted(name for name in {heavy!r} if name in sys.modules),
+}}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='onthespot.web', help='Module to import')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    # Keep the user's config and cache untouched
+    work_dir = tempfile.mkdtemp(prefix='ots-bench-')
+    for name in ('config', 'cache'):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    env = dict(os.environ)
+    env['ONTHESPOTDIR'] = os.path.join(work_dir, 'config')
+    env['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+    env['PYTHONPATH'] = os.path.join(ROOT, 'src') + os.pathsep + env.get('PYTHONPATH', '')
+
+    script = CHILD_SCRIPT.format(module=args.module, heavy=HEAVY_MODULES)
+    try:
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True, env=env)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if output.returncode != 0:
+        print(output.stderr, file=sys.stderr)
+        sys.exit(output.returncode)
+
+    imports = []
+    for line in output.stderr.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if match:
+            imports.append((int(match.group('cumulative')), int(match.group('self')), len(match.group('indent')), match.group('name')))
+    # Top level imports have the smallest indent, their cumulative times add up to the total
+    top_level = min(indent for _, _, indent, _ in imports)
+    total_us = sum(cumulative for cumulative, _, indent, _ in imports if indent == top_level)
+
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    print(f"Module:           {args.module}")
+    print(f"Import time:      {total_us / 1000:.1f} ms")
+    print(f"Peak RSS:         {result['peak_rss_mb']:.1f} MB")
+    print(f"Heavy modules:    {', '.join(result['heavy']) or 'none'}")
+    print()
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_us, indent, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+
+if __name__ == '__main__':
+    main()
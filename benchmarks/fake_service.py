@@ -0,0 +1,257 @@
+"""
+Local stand-in for a streaming service, used by the offline benchmarks.
+
+The server speaks a tiny JSON API (playlists and track metadata) and serves
+synthetic FLAC/MP3 payloads. Latency, bandwidth and 429 rate limiting can be
+injected so the download pipeline can be exercised without network access or
+real accounts.
+"""
+import json
+import random
+import re
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from onthespot.services import register_service
+from onthespot.utils import make_call
+
+
+TRACKS_PER_ALBUM = 12
+CHUNK_SIZE = 64 * 1024
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d*)$')
+
+# Minimal valid-looking headers so anything sniffing the container is happy
+FORMAT_HEADERS = {
+    'flac': b'fLaC\x00\x00\x00\x22' + b'\x00' * 34,
+    'mp3': b'ID3\x04\x00\x00\x00\x00\x00\x00' + b'\xff\xfb\x90\x64',
+}
+
+
+def build_payload(file_format, size):
+    """Return a deterministic payload of exactly `size` bytes."""
+    header = FORMAT_HEADERS[file_format]
+    pattern = bytes(range(256)) * 256
+    body = (pattern * (size // len(pattern) + 1))[:max(0, size - len(header))]
+    return header + body
+
+
+class FakeServiceStats:
+    """Counters shared between the request handlers and the benchmark."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.bytes_served = 0
+        self.first_metadata_time = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        service.stats.count('requests')
+        if service.latency:
+            time.sleep(service.latency)
+
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if len(parts) != 2:
+            self._send_json({'error': 'not found'}, status=404)
+            return
+        kind, item_id = parts
+
+        # Only the JSON API is rate limited, the file endpoint mirrors CDNs which don't
+        if kind in ('playlist', 'track') and service.should_rate_limit():
+            service.stats.count('rate_limited')
+            self._send_json({'error': 'rate limited'}, status=429, headers={'Retry-After': '0'})
+            return
+
+        if kind == 'playlist':
+            size = service.playlists.get(item_id)
+            if size is None:
+                self._send_json({'error': 'not found'}, status=404)
+                return
+            self._send_json({
+                'name': f'Benchmark {item_id}',
+                'owner': {'name': 'onthespot'},
+                'track_ids': [f'{item_id}t{index}' for index in range(size)]
+            })
+        elif kind == 'track':
+            self._send_json(service.track_data(item_id))
+        elif kind == 'file':
+            self._send_file()
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def _send_file(self):
+        service = self.server.service
+        payload = memoryview(service.payload)
+        total = len(payload)
+        # Single byte ranges are enough for resumed and segmented downloads
+        match = RANGE_REGEX.match(self.headers.get('Range', ''))
+        if match:
+            first = int(match.group(1))
+            last = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+            if first >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{total}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            payload = payload[first:last + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{total}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', service.etag)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+
+        start = time.monotonic()
+        sent = 0
+        try:
+            while sent < len(payload):
+                chunk = payload[sent:sent + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if service.bandwidth:
+                    # Sleep until the per-connection rate is respected
+                    ahead = sent / service.bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        service.stats.count('bytes_served', sent)
+
+
+class FakeStreamingService:
+    """
+    Threaded HTTP server plus the pseudo-service functions the pipeline calls.
+
+    latency: seconds added before every response
+    bandwidth: per-connection bytes/s for file downloads (0 for unlimited)
+    rate_limit: fraction of API requests answered with 429
+    """
+    def __init__(self, file_format='flac', file_size=8 * 1024 * 1024, latency=0.0, bandwidth=0, rate_limit=0.0, seed=0):
+        self.file_format = file_format
+        self.payload = build_payload(file_format, file_size)
+        self.etag = f'"{file_format}-{file_size}"'
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.playlists = {}
+        self.stats = FakeServiceStats()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeServiceHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def should_rate_limit(self):
+        if not self.rate_limit:
+            return False
+        with self.random_lock:
+            return self.random.random() < self.rate_limit
+
+    def add_playlist(self, playlist_id, size):
+        self.playlists[playlist_id] = size
+
+    def track_data(self, item_id):
+        index = int(item_id.rsplit('t', 1)[1])
+        album_index = index // TRACKS_PER_ALBUM
+        return {
+            'id': item_id,
+            'title': f'Track {index}',
+            'artists': [f'Artist {album_index % 97}'],
+            'album': {
+                'title': f'Album {album_index}',
+                'artist': f'Artist {album_index % 97}',
+                'tracks_count': TRACKS_PER_ALBUM,
+                'release_date': '2024-01-01',
+                'image': f'{self.base_url}/cover/{album_index}',
+            },
+            'track_number': index % TRACKS_PER_ALBUM + 1,
+            'isrc': f'BENCH{index:07d}',
+            'duration': 240,
+            'streamable': True,
+        }
+
+    # Pseudo-service functions, named after the service slot they are installed into
+
+    def get_token(self, parsing_index):
+        return {'base_url': self.base_url}
+
+    def get_playlist_data(self, token, playlist_id):
+        playlist_data = make_call(f'{self.base_url}/playlist/{playlist_id}', skip_cache=True)
+        return playlist_data['name'], playlist_data['owner']['name'], playlist_data['track_ids']
+
+    def get_track_metadata(self, token, item_id):
+        with self.stats.lock:
+            self.stats.first_metadata_time.setdefault(item_id, time.time())
+        track_data = make_call(f'{self.base_url}/track/{item_id}')
+        if not track_data:
+            return
+        album = track_data['album']
+        info = {}
+        info['item_id'] = item_id
+        info['title'] = track_data['title']
+        info['artists'] = '; '.join(track_data['artists'])
+        info['album_name'] = album['title']
+        info['album_artists'] = album['artist']
+        info['album_type'] = 'album'
+        info['total_tracks'] = album['tracks_count']
+        info['total_discs'] = 1
+        info['disc_number'] = 1
+        info['track_number'] = track_data['track_number']
+        info['release_year'] = album['release_date'].split('-')[0]
+        info['image_url'] = album['image']
+        info['isrc'] = track_data['isrc']
+        info['length'] = str(track_data['duration']) + '000'
+        info['explicit'] = False
+        info['is_playable'] = track_data['streamable']
+        info['item_url'] = f'{self.base_url}/track/{item_id}'
+        return info
+
+    def get_file_url(self, token, item_id):
+        return f'{self.base_url}/file/{item_id}.{self.file_format}'
+
+    def install(self, service):
+        """Register the pseudo-service as the provider module for `service`."""
+        register_service(service, types.SimpleNamespace(**{
+            f'{service}_get_token': self.get_token,
+            f'{service}_get_playlist_data': self.get_playlist_data,
+            f'{service}_get_track_metadata': self.get_track_metadata,
+            f'{service}_get_file_url': self.get_file_url,
+        }))
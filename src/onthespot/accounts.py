@@ -1,17 +1,8 @@
 from time import sleep
 import threading
-from .api.apple_music import apple_music_login_user, apple_music_get_token
-from .api.bandcamp import bandcamp_login_user
-from .api.deezer import deezer_login_user, deezer_get_token
-from .api.qobuz import qobuz_login_user, qobuz_get_token
-from .api.soundcloud import soundcloud_login_user, soundcloud_get_token
-from .api.spotify import spotify_login_user, spotify_get_token
-from .api.tidal import tidal_login_user, tidal_get_token
-from .api.youtube_music import youtube_music_login_user
-from .api.generic import generic_login_user
-from .api.crunchyroll import crunchyroll_login_user, crunchyroll_get_token
 from .otsconfig import config
 from .runtimedata import get_logger, account_pool
+from .services import get_service_function
 
 logger = get_logger("accounts")
 
@@ -32,7 +23,8 @@ class FillAccountPool(threading.Thread):
             if self.progress_callback:
                 self.progress_callback(f'Attempting to create session for {account["uuid"]}...', True)
 
-            valid_login = globals()[f"{service}_login_user"](account)
+            # Provider modules are imported here, only for services with an active account
+            valid_login = get_service_function(service, "login_user")(account)
             if valid_login:
                 if self.progress_callback:
                     self.progress_callback(f'Session created for {account["uuid"]}!', True)
@@ -55,7 +47,7 @@ def get_account_token(item_service, rotate=False):
     # Try the primary account first if not rotating and it's active
     if item_service == account_pool[parsing_index]['service'] and not rotate:
         if account_pool[parsing_index].get('status') == 'active':
-            return globals()[f"{item_service}_get_token"](parsing_index)
+            return get_service_function(item_service, "get_token")(parsing_index)
         else:
             logger.debug(f"Primary account at index {parsing_index} is not active (status: {account_pool[parsing_index].get('status')}), searching for alternative")
     
@@ -73,7 +65,7 @@ def get_account_token(item_service, rotate=False):
                 config.save()
             else:
                 logger.info(f"Using alternative {account_pool[index]['service']} account at index {index}: {account_pool[index]['uuid']}")
-            return globals()[f"{item_service}_get_token"](index)
+            return get_service_function(item_service, "get_token")(index)
     
     # No active account found
     logger.error(f"No active account found for service: {item_service}")
@@ -216,6 +216,42 @@ def decryptfile(data_chunks, key, fo):
         i += 1
 
 
+class DeezerStreamDecryptor:
+    """
+    Incremental counterpart of decryptfile for streamed downloads.
+    Only whole 2048 byte blocks are returned by update(), so a partial file always
+    ends on a block boundary and can be resumed from its size.
+    """
+    block_size = 2048
+
+    def __init__(self, key, offset=0):
+        if offset % self.block_size:
+            raise ValueError(f"Deezer stream must resume on a {self.block_size} byte block boundary, got {offset}")
+        self.key = key
+        self.block_index = offset // self.block_size
+        self.buffer = bytearray()
+
+    def update(self, data):
+        self.buffer += data
+        whole_length = len(self.buffer) - len(self.buffer) % self.block_size
+        view = memoryview(self.buffer)
+        for start in range(0, whole_length, self.block_size):
+            # Encrypted blocks are decrypted in place, the rest pass through untouched
+            if self.block_index % 3 == 0:
+                view[start:start + self.block_size] = blowfishDecrypt(view[start:start + self.block_size], self.key)
+            self.block_index += 1
+        decrypted = bytes(view[:whole_length])
+        view.release()
+        del self.buffer[:whole_length]
+        return decrypted
+
+    def finalize(self):
+        # A trailing partial block is never encrypted
+        tail = bytes(self.buffer)
+        self.buffer.clear()
+        return tail
+
+
 def genurlkey(songid, md5origin, mediaver=4, fmt=1):
     """ Calculate the deezer download url given the songid, origin and media+format """
     data_concat = b'\xa4'.join(_ for _ in [md5origin.encode(),
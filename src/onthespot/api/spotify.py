@@ -9,7 +9,9 @@ import uuid
 from librespot.audio.decoders import AudioQuality
 from librespot.core import Session
 from librespot.zeroconf import ZeroconfServer
+from .. import librespot_patch  # noqa: F401
 from ..otsconfig import config, cache_dir
+from ..queue_item import QueueItem
 from ..runtimedata import get_logger, account_pool, pending, download_queue, pending_lock
 from ..utils import make_call, conv_list_format
 
@@ -231,7 +233,7 @@ class MirrorSpotifyPlayback:
                         # Use item id to prevent duplicates
                         #local_id = format_local_id(item_id)
                         with pending_lock:
-                            pending[item_id] = {
+                            pending[item_id] = QueueItem({
                                 'local_id': item_id,
                                 'item_service': 'spotify',
                                 'item_type': 'track',
@@ -240,7 +242,7 @@ class MirrorSpotifyPlayback:
                                 'playlist_name': playlist_name,
                                 'playlist_by': playlist_by,
                                 'playlist_number': '?'
-                            }
+                            })
                         logger.info(f'Mirror Spotify Playback added track to download queue: https://open.spotify.com/track/{item_id}')
                         continue
                 else:
@@ -595,6 +597,41 @@ def spotify_get_playlist_data(token, playlist_id, _retry=False):
     return resp['name'], resp['owner']['display_name'], image_url
 
 
+def spotify_get_playlist_snapshot(token, playlist_id, _retry=False):
+    """Name, owner, cover and snapshot id of a playlist in one small request."""
+    headers = {}
+    try:
+        headers['Authorization'] = f"Bearer {token.tokens().get('user-read-email')}"
+    except (RuntimeError, OSError) as e:
+        if _retry:
+            logger.error(f"Failed to get token after retry for playlist {playlist_id}: {e}")
+            raise
+        logger.warning(f"Token retrieval failed for playlist snapshot, attempting session reconnect: {e}")
+        # Re-initialize the session
+        parsing_index = config.get('active_account_number')
+        spotify_re_init_session(account_pool[parsing_index])
+        # Get the new token
+        new_token = account_pool[parsing_index]['login']['session']
+        # Retry with the new token
+        return spotify_get_playlist_snapshot(new_token, playlist_id, _retry=True)
+
+    resp = make_call(
+        f'{BASE_URL}/playlists/{playlist_id}',
+        params={'fields': 'snapshot_id,name,owner(display_name),images(url)'},
+        headers=headers,
+        skip_cache=True,
+    )
+    if not resp:
+        return None
+    images = resp.get('images') or []
+    return {
+        'snapshot_id': resp.get('snapshot_id'),
+        'name': resp['name'],
+        'owner': resp['owner']['display_name'],
+        'image_url': images[0].get('url', '') if images else ''
+    }
+
+
 def spotify_get_lyrics(token, item_id, item_type, metadata, filepath, _retry=False):
     if config.get('download_lyrics'):
         lyrics = []
@@ -1130,7 +1167,7 @@ def spotify_get_item_by_id(token, item_id, item_type, _retry=False):
         return []
 
 
-def spotify_get_track_metadata(token, item_id, _retry=False, album_lock=None):
+def spotify_get_track_metadata(token, item_id, _retry=False):
     headers = {}
     try:
         headers, auth_source = _spotify_get_public_api_headers(token, "track metadata")
@@ -1168,14 +1205,8 @@ def spotify_get_track_metadata(token, item_id, _retry=False, album_lock=None):
     album_data = make_call(f"{BASE_URL}/albums/{track_data.get('tracks', [])[0].get('album', {}).get('id')}", headers=headers)
     artist_data = make_call(f"{BASE_URL}/artists/{track_data.get('tracks', [])[0].get('artists', [])[0].get('id')}", headers=headers)
     
-    # Lock ONLY the album track ID fetch (critical section for duplicate prevention)
-    if album_lock:
-        album_lock.acquire()
-    try:
-        album_track_ids = spotify_get_album_track_ids(token, track_data.get('tracks', [])[0].get('album', {}).get('id'))
-    finally:
-        if album_lock:
-            album_lock.release()
+    # Concurrent lookups for tracks of the same album share one request in make_call
+    album_track_ids = spotify_get_album_track_ids(token, track_data.get('tracks', [])[0].get('album', {}).get('id'))
     try:
         track_audio_data = make_call(f'{BASE_URL}/audio-features/{item_id}', headers=headers)
     except Exception:
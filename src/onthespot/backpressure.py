@@ -0,0 +1,192 @@
+"""
+Bounded stages between parsing and the download queue.
+
+`pending` holds at most `pending_high_water` items. Items parsed beyond that
+are appended to a spill file in the cache directory and moved back into
+`pending` once it drained to `pending_low_water`. While `pending` is above the
+high water mark or spilled items are waiting, the parsing worker doesn't
+expand further submissions, so an artist discography or a file of hundreds of
+links costs disk space instead of memory. The queue workers in turn admit no
+more than `download_queue_high_water` unfinished items into the download queue.
+Single items somebody asked for bypass both limits so they never queue behind
+a bulk import.
+"""
+import json
+import os
+import tempfile
+import threading
+from .otsconfig import cache_dir, config
+from .runtimedata import download_queue, get_logger, pending, pending_lock
+from .queue_item import QueueItem
+from .scheduler import FINISHED_STATUSES, item_priority
+from .utils import format_local_id
+
+logger = get_logger("backpressure")
+
+
+class SpillStore:
+    """Append only file of pending items with a persisted read offset, survives restarts."""
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.lock = threading.Lock()
+        self.count = None
+
+
+    def _load(self):
+        if self.count is not None:
+            return
+        self.count = 0
+        offset = self._read_offset()
+        try:
+            with open(self.path, 'rb') as spill_file:
+                spill_file.seek(offset)
+                for _ in spill_file:
+                    self.count += 1
+        except OSError:
+            pass
+
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, 'r') as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def _write_offset(self, offset):
+        # Written next to the target and renamed so a crash never leaves a truncated offset
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.offset_path), prefix='.spill.')
+        try:
+            with os.fdopen(fd, 'w') as offset_file:
+                offset_file.write(str(offset))
+            os.replace(temp_path, self.offset_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def _remove_files(self):
+        for path in (self.path, self.offset_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.count = 0
+
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return self.count
+
+
+    def append(self, item):
+        with self.lock:
+            self._load()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as spill_file:
+                spill_file.write(json.dumps(dict(item)) + '\n')
+            self.count += 1
+
+
+    def take(self, limit):
+        """Remove and return up to `limit` items in the order they were spilled."""
+        with self.lock:
+            self._load()
+            if not self.count:
+                return []
+            items = []
+            with open(self.path, 'rb') as spill_file:
+                spill_file.seek(self._read_offset())
+                while len(items) < limit:
+                    line = spill_file.readline()
+                    if not line:
+                        break
+                    items.append(json.loads(line))
+                offset = spill_file.tell()
+                exhausted = not spill_file.readline()
+            if exhausted:
+                self._remove_files()
+            else:
+                self._write_offset(offset)
+                self.count -= len(items)
+            return items
+
+
+    def clear(self):
+        """Drop every spilled item, e.g. when the pending queue is cancelled."""
+        with self.lock:
+            self._remove_files()
+
+
+spill_store = SpillStore(os.path.join(cache_dir(), 'pending_spill.jsonl'))
+_paused = threading.Event()
+
+
+def add_pending(local_id, item):
+    """Add a parsed item to `pending`, or to the spill file if pending is full or items are already spilled."""
+    with pending_lock:
+        if item_priority(item) == 'interactive' or (len(pending) < config.get('pending_high_water') and not len(spill_store)):
+            pending[local_id] = QueueItem(item)
+            return
+    # Spilled items get a fresh local id when they come back, the current one may be taken by then
+    spill_store.append(item)
+
+
+def refill_pending():
+    """Move spilled items back into `pending` once it drained to the low water mark."""
+    if not len(spill_store):
+        return 0
+    with pending_lock:
+        room = config.get('pending_high_water') - len(pending)
+        if len(pending) > config.get('pending_low_water') or room <= 0:
+            return 0
+    try:
+        items = spill_store.take(room)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to read spilled pending items: {e}")
+        return 0
+    with pending_lock:
+        for item in items:
+            local_id = format_local_id(item['item_id'])
+            item['local_id'] = local_id
+            pending[local_id] = QueueItem(item)
+    logger.info(f"Moved {len(items)} spilled items back to the pending queue, {len(spill_store)} still spilled")
+    return len(items)
+
+
+def expansion_paused():
+    """
+    Whether the parsing worker should hold off expanding submissions. Pauses at the
+    high water mark and resumes once pending is at the low water mark with nothing spilled.
+    """
+    with pending_lock:
+        pending_count = len(pending)
+    if _paused.is_set():
+        if pending_count <= config.get('pending_low_water') and not len(spill_store):
+            _paused.clear()
+            logger.info(f"Pending queue drained to {pending_count} items, resuming parsing")
+    elif pending_count >= config.get('pending_high_water') or len(spill_store):
+        _paused.set()
+        logger.info(f"Pending queue at {pending_count} items with {len(spill_store)} spilled, pausing parsing")
+    return _paused.is_set()
+
+
+def download_queue_room():
+    """How many more items the download queue admits before it reaches `download_queue_high_water`."""
+    unfinished = sum(1 for _, item in download_queue.entries() if item['item_status'] not in FINISHED_STATUSES)
+    return max(0, config.get('download_queue_high_water') - unfinished)
+
+
+def get_backpressure_stats():
+    with pending_lock:
+        pending_count = len(pending)
+    return {
+        'pending': pending_count,
+        'pending_high_water': config.get('pending_high_water'),
+        'pending_low_water': config.get('pending_low_water'),
+        'spilled': len(spill_store),
+        'parsing_paused': _paused.is_set(),
+        'download_queue_room': download_queue_room()
+    }
@@ -10,21 +10,15 @@ import traceback
 import argparse
 from cmd import Cmd
 from .accounts import FillAccountPool, get_account_token
-from .api.apple_music import apple_music_get_track_metadata, apple_music_add_account
-from .api.bandcamp import bandcamp_get_track_metadata, bandcamp_add_account
-from .api.deezer import deezer_get_track_metadata, deezer_add_account
-from .api.qobuz import qobuz_get_track_metadata, qobuz_add_account
-from .api.soundcloud import soundcloud_get_track_metadata, soundcloud_add_account
-from .api.generic import generic_get_track_metadata, generic_add_account
-from .api.spotify import MirrorSpotifyPlayback, spotify_new_session, spotify_get_track_metadata, spotify_get_podcast_episode_metadata
-from .api.tidal import tidal_get_track_metadata, tidal_add_account_pt1, tidal_add_account_pt2
-from .api.youtube_music import youtube_music_get_track_metadata, youtube_music_add_account
-from .api.crunchyroll import crunchyroll_get_episode_metadata, crunchyroll_add_account
+from .backpressure import download_queue_room
 from .downloader import DownloadWorker, RetryWorker, build_final_file_path
 from .otsconfig import config_dir, config
 from .parse_item import parsingworker, parse_url
-from .runtimedata import account_pool, pending, download_queue, download_queue_lock, pending_lock, register_worker, kill_all_workers, set_worker_restart_callback
+from .queue_item import QueueItem, as_queue_item
+from .runtimedata import account_pool, pending, download_queue, download_queue_lock, pending_lock, register_worker, kill_all_workers, set_worker_restart_callback, flush_logs
+from .scheduler import metadata_slot
 from .search import get_search_results
+from .services import get_service_function
 from .utils import format_item_path, add_to_m3u_file
 
 if not config.get('debug_mode'):
@@ -53,12 +47,13 @@ class QueueWorker(threading.Thread):
     def run(self):
         while self.is_running:
             try:
-                if pending:
+                if pending and download_queue_room():
                     local_id = next(iter(pending))
                     with pending_lock:
                         item = pending.pop(local_id)
                     token = get_account_token(item['item_service'])
-                    item_metadata = globals()[f"{item['item_service']}_get_{item['item_type']}_metadata"](token, item['item_id'])
+                    with metadata_slot(item['item_service']):
+                        item_metadata = get_service_function(item['item_service'], f"get_{item['item_type']}_metadata")(token, item['item_id'])
                     if item_metadata:
                         # Align track numbering and path with playlist ordering before writing M3U
                         if item['item_service'] == 'youtube_music' and item.get('parent_category') == 'album':
@@ -87,7 +82,7 @@ class QueueWorker(threading.Thread):
                             logging.getLogger("cli").error(f"Failed to build file path for {item.get('item_id')}: {path_error}")
 
                         with download_queue_lock:
-                            download_queue[local_id] = {
+                            download_queue[local_id] = QueueItem({
                                 'local_id': local_id,
                                 'available': True,
                                 "item_service": item["item_service"],
@@ -103,13 +98,13 @@ class QueueWorker(threading.Thread):
                                 'playlist_number': item.get('playlist_number'),
                                 'playlist_total': item.get('playlist_total'),
                                 '_m3u_written': m3u_written
-                                }
+                                })
                 else:
                     time.sleep(0.2)
             except Exception as e:
                 logger.error(f"Unknown Exception for {item}: {str(e)}\nTraceback: {traceback.format_exc()}")
                 with pending_lock:
-                    pending[local_id] = item
+                    pending[local_id] = as_queue_item(item)
 
 
     def stop(self):
@@ -268,6 +263,7 @@ def main():
     fill_account_pool.wait()
 
     if config.get('mirror_spotify_playback'):
+        from .api.spotify import MirrorSpotifyPlayback
         mirrorplayback = MirrorSpotifyPlayback()
         mirrorplayback.start()
 
@@ -286,6 +282,9 @@ def main():
                     print(f"\033[31mItem ID {item['item_id']} {item['item_status']}'\033[0m")
                     failed_download = True
 
+        # os._exit skips atexit handlers, persist pending config changes first
+        config.flush()
+        flush_logs()
         if failed_download:
             print("\033[31mAt least one track download failed. Exiting with failure...\033[0m")
             os._exit(1)
@@ -379,7 +378,7 @@ class CLI(Cmd):
                     media_user_token = parts[2]
 
                     try:
-                        apple_music_add_account(media_user_token)
+                        get_service_function('apple_music', 'add_account')(media_user_token)
                         print("\033[32mApple Music account added successfully. Please restart the app.\033[0m")
                     except Exception as e:
                         print(f"\033[31mError while adding Apple Music account: {e}\033[0m")
@@ -390,7 +389,7 @@ class CLI(Cmd):
                 print("\033[32mInitializing Bandcamp account login...\033[0m")
 
                 try:
-                    bandcamp_add_account()
+                    get_service_function('bandcamp', 'add_account')()
                     print("\033[32mBandcamp account added successfully. Please restart the app.\033[0m")
                 except Exception as e:
                     print(f"\033[31mError while adding Bandcamp account: {e}\033[0m")
@@ -402,7 +401,7 @@ class CLI(Cmd):
                     password = parts[3]
 
                     try:
-                        crunchyroll_add_account(email, password)
+                        get_service_function('crunchyroll', 'add_account')(email, password)
                         print("\033[32mCrunchyroll account added successfully. Please restart the app.\033[0m")
                     except Exception as e:
                         print(f"\033[31mError while adding Crunchyroll account: {e}\033[0m")
@@ -414,7 +413,7 @@ class CLI(Cmd):
                     print("\033[32mAdding Deezer account with provided ARL token...\033[0m")
                     arl = parts[2]
                     try:
-                        deezer_add_account(arl)
+                        get_service_function('deezer', 'add_account')(arl)
                         print("\033[32mDeezer account added successfully. Please restart the app.\033[0m")
                     except Exception as e:
                         print(f"\033[31mError while adding Deezer account: {e}\033[0m")
@@ -424,7 +423,7 @@ class CLI(Cmd):
             elif parts[1] == "generic":
                 print("\033[32mInitializing Generic platform support...\033[0m")
                 try:
-                    generic_add_account()
+                    get_service_function('generic', 'add_account')()
                     print("\033[32mGeneric platform support added successfully. Please restart the app.\033[0m")
                 except Exception as e:
                     print(f"\033[31mError while adding Generic platform support: {e}\033[0m")
@@ -437,7 +436,7 @@ class CLI(Cmd):
                     password = parts[3]
 
                     try:
-                        qobuz_add_account(email, password)
+                        get_service_function('qobuz', 'add_account')(email, password)
                         print("\033[32mQobuz account added successfully. Please restart the app.\033[0m")
                     except Exception as e:
                         print(f"\033[31mError while adding Qobuz account: {e}\033[0m")
@@ -449,7 +448,7 @@ class CLI(Cmd):
                     print("\033[32mAdding SoundCloud account with provided OAuth token...\033[0m")
                     oauth_token = parts[2]
                     try:
-                        soundcloud_add_account(oauth_token)
+                        get_service_function('soundcloud', 'add_account')(oauth_token)
                         print("\033[32mSoundCloud account added successfully. Please restart the app.\033[0m")
                     except Exception as e:
                         print(f"\033[31mError while adding SoundCloud account: {e}\033[0m")
@@ -460,7 +459,7 @@ class CLI(Cmd):
                 print("\033[32mLogin service started, select 'OnTheSpot' under devices in the Spotify Desktop App.\033[0m")
 
                 def add_spotify_account_worker():
-                    session = spotify_new_session()
+                    session = get_service_function('spotify', 'new_session')()
                     if session:
                         print("\033[32mAccount added, please restart the app.\n\033[0m")
                     else:
@@ -474,10 +473,10 @@ class CLI(Cmd):
 
                 def add_tidal_account_worker():
                     try:
-                        device_code, verification_url = tidal_add_account_pt1()
+                        device_code, verification_url = get_service_function('tidal', 'add_account_pt1')()
                         print(f"\033[32mPlease visit the following URL to complete login: {verification_url}\033[0m")
 
-                        result = tidal_add_account_pt2(device_code)
+                        result = get_service_function('tidal', 'add_account_pt2')(device_code)
                         if result:
                             print("\033[32mTidal account added successfully. Please restart the app.\033[0m")
 
@@ -493,7 +492,7 @@ class CLI(Cmd):
                 print("\033[32mInitializing YouTube Music account login...\033[0m")
 
                 try:
-                    youtube_music_add_account()
+                    get_service_function('youtube_music', 'add_account')()
                     print("\033[32mYouTube Music public account added successfully. Please restart the app.\033[0m")
                 except Exception as e:
                     print(f"\033[31mError while adding YouTube Music account: {e}\033[0m")
@@ -684,6 +683,8 @@ class CLI(Cmd):
     def do_exit(self, arg):
         """Exit the CLI application."""
         print("Exiting the CLI application.")
+        config.flush()
+        flush_logs()
         os._exit(0)
 
 
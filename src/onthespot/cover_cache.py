@@ -0,0 +1,137 @@
+"""
+Content addressed cache for cover art.
+
+Covers are keyed by a hash of their URL and stored decoded and re-encoded in
+the requested format, so tracks from the same album or playlist only fetch
+and convert an image once. The cache directory is kept under
+`cover_cache_size_mb` by evicting the least recently used files. Every lookup
+touches the file it returns, and files used within `IN_USE_SECONDS` are never
+evicted so callers can still copy the cover they were handed.
+"""
+import os
+import threading
+import time
+from hashlib import sha1
+from io import BytesIO
+import requests
+from .otsconfig import config
+from .runtimedata import get_logger
+
+logger = get_logger("cover_cache")
+
+# Covers hash onto a fixed set of locks so concurrent workers fetch each image
+# only once without keeping a lock per cover around
+COVER_LOCK_STRIPES = 64
+IN_USE_SECONDS = 60
+
+_cover_locks = [threading.Lock() for _ in range(COVER_LOCK_STRIPES)]
+_cache_size = None
+_cache_size_lock = threading.Lock()
+
+
+def _cover_cache_dir():
+    return os.path.join(config.get('_cache_dir'), 'covers')
+
+
+def _normalize_format(image_format):
+    image_format = (image_format or 'png').lower()
+    if image_format in ('jpg', 'jpeg'):
+        return 'JPEG', 'jpg'
+    return image_format.upper(), image_format
+
+
+def get_cover_path(image_url, image_format):
+    """Return the path of the cached cover for `image_url`, fetching it if needed."""
+    pil_format, extension = _normalize_format(image_format)
+    key = sha1(image_url.encode()).hexdigest()
+    cover_path = os.path.join(_cover_cache_dir(), f'{key}.{extension}')
+
+    if _touch(cover_path):
+        logger.debug(f"Cover cache hit for {image_url}")
+        return cover_path
+
+    with _cover_locks[int(key[:8], 16) % COVER_LOCK_STRIPES]:
+        # Another worker may have fetched it while we waited
+        if _touch(cover_path):
+            return cover_path
+
+        from PIL import Image
+        logger.info(f"Fetching cover image {image_url}")
+        response = requests.get(image_url, timeout=30)
+        response.raise_for_status()
+        img = Image.open(BytesIO(response.content))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        buf = BytesIO()
+        img.save(buf, format=pil_format)
+        data = buf.getvalue()
+
+        os.makedirs(os.path.dirname(cover_path), exist_ok=True)
+        temp_path = f'{cover_path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as cover:
+            cover.write(data)
+        os.replace(temp_path, cover_path)
+
+    _add_to_cache_size(len(data), keep=cover_path)
+    return cover_path
+
+
+def get_cover_data(image_url, image_format):
+    with open(get_cover_path(image_url, image_format), 'rb') as cover:
+        return cover.read()
+
+
+def clear_cover_cache():
+    global _cache_size
+    cache_dir = _cover_cache_dir()
+    with _cache_size_lock:
+        if os.path.isdir(cache_dir):
+            for entry in os.scandir(cache_dir):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        _cache_size = 0
+
+
+def _touch(cover_path):
+    # The modification time doubles as the LRU timestamp
+    try:
+        os.utime(cover_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _add_to_cache_size(size, keep=None):
+    global _cache_size
+    max_size = config.get('cover_cache_size_mb', 200) * 1024 * 1024
+    with _cache_size_lock:
+        if _cache_size is None:
+            _cache_size = sum(entry.stat().st_size for entry in os.scandir(_cover_cache_dir()) if entry.is_file())
+        else:
+            _cache_size += size
+        if _cache_size <= max_size:
+            return
+
+        # Evict least recently used covers down to 90% of the cap, sparing
+        # `keep` and covers other workers may still be copying
+        in_use_since = time.time() - IN_USE_SECONDS
+        entries = sorted(
+            (entry for entry in os.scandir(_cover_cache_dir())
+             if entry.is_file() and entry.path != keep and entry.stat().st_mtime < in_use_since),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        target = max_size * 0.9
+        removed = 0
+        for entry in entries:
+            if _cache_size <= target:
+                break
+            try:
+                entry_size = entry.stat().st_size
+                os.remove(entry.path)
+                _cache_size -= entry_size
+                removed += 1
+            except OSError:
+                continue
+        logger.info(f"Cover cache over {config.get('cover_cache_size_mb', 200)}MB, evicted {removed} covers")
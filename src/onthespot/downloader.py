@@ -1,5 +1,6 @@
 import glob
 import re
+from functools import partial
 import requests
 import subprocess
 import threading
@@ -7,22 +8,17 @@ import time
 import traceback
 import os
 import queue
-from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
-from librespot.metadata import TrackId, EpisodeId
-from yt_dlp import YoutubeDL
 from .accounts import get_account_token
-from .api.apple_music import apple_music_get_track_metadata, apple_music_get_decryption_key, apple_music_get_lyrics, apple_music_get_webplayback_info
-from .api.bandcamp import bandcamp_get_track_metadata
-from .api.deezer import deezer_get_track_metadata, get_song_info_from_deezer_website, genurlkey, calcbfkey, decryptfile
-from .api.qobuz import qobuz_get_track_metadata, qobuz_get_file_url
-from .api.soundcloud import soundcloud_get_track_metadata
-from .api.spotify import spotify_get_track_metadata, spotify_get_podcast_episode_metadata, spotify_get_lyrics
-from .api.tidal import tidal_get_track_metadata, tidal_get_lyrics, tidal_get_file_url
-from .api.youtube_music import youtube_music_get_track_metadata
-from .api.crunchyroll import crunchyroll_get_episode_metadata, crunchyroll_get_decryption_key, crunchyroll_get_mpd_info, crunchyroll_close_stream
-from .api.generic import generic_get_track_metadata
+from .http_download import download_resumable, discard_item_partial, discard_partial, is_partial_file
+from .item_timing import record_completed, record_span, reset_timings, span
 from .otsconfig import config
-from .runtimedata import get_logger, download_queue, download_queue_lock, account_pool, temp_download_path, increment_failure_count, reset_failure_count, album_download_locks, album_download_locks_lock
+from .library_index import clone_file, identity_keys, library_index
+from .playlist_sync import record_track
+from .recovery import record_completion
+from .scheduler import CLAIMED_STATUS, metadata_slot, select_next_item
+from .services import get_service_function
+from .staging import get_staging_mover, get_staging_root
+from .runtimedata import get_logger, download_queue, download_queue_lock, account_pool, temp_download_path, increment_failure_count, reset_failure_count
 from . import runtimedata
 from .utils import format_item_path, convert_audio_format, embed_metadata, set_music_thumbnail, fix_mp3_metadata, add_to_m3u_file, strip_metadata, convert_video_format
 
@@ -66,6 +62,33 @@ def build_final_file_path(base_path, item_type, default_format, item_service=Non
     return base_path
 
 
+def find_ogg_resume_offset(path):
+    """
+    Return the end offset of the last complete Ogg page in `path`, 0 if there is none.
+    Interrupted Spotify streams are resumed from there so the new stream continues on a page boundary.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    offset = 0
+    with open(path, 'rb') as file:
+        # Page header: capture pattern, version, type, granule, serial, sequence, crc, segment count
+        while offset + 27 <= size:
+            file.seek(offset)
+            header = file.read(27)
+            if header[:4] != b'OggS':
+                break
+            segment_table = file.read(header[26])
+            if len(segment_table) < header[26]:
+                break
+            page_end = offset + 27 + header[26] + sum(segment_table)
+            if page_end > size:
+                break
+            offset = page_end
+    return offset
+
+
 class RetryWorker:
     def __init__(self):
         self.thread = threading.Thread(target=self.run)
@@ -78,27 +101,18 @@ class RetryWorker:
 
 
     def run(self):
-        from .runtimedata import get_consecutive_failures
         while self.is_running:
             if download_queue:
-                # First, check if there are any failed downloads
+                # First, check if there are any failed downloads, recovery gave up on some of them for good
                 has_failed_downloads = False
                 failed_count = 0
-                with download_queue_lock:
-                    for local_id in download_queue.keys():
-                        if download_queue[local_id]['item_status'] == "Failed":
-                            has_failed_downloads = True
-                            failed_count += 1
-
-                # If failures are accumulating, back off to let hard restart happen
-                current_failure_count = get_consecutive_failures()
-                if current_failure_count >= 3:
-                    logger.warning(f"High consecutive failure count ({current_failure_count}), backing off to allow hard restart")
-                    time.sleep(10)
-                    continue
+                for local_id, item in download_queue.entries():
+                    if item['item_status'] == "Failed" and not item.get('_recovery_gave_up'):
+                        has_failed_downloads = True
+                        failed_count += 1
 
                 # If there are failed downloads, force reconnect all Spotify accounts
-                if has_failed_downloads:
+                if has_failed_downloads and any(account.get('service') == 'spotify' for account in account_pool):
                     logger.info(f"Found {failed_count} failed downloads - forcing Spotify account reconnection before retry")
                     from .api.spotify import spotify_re_init_session
 
@@ -121,7 +135,7 @@ class RetryWorker:
                 # Now retry the failed downloads
                 with download_queue_lock:
                     for local_id in download_queue.keys():
-                        if download_queue[local_id]['item_status'] == "Failed":
+                        if download_queue[local_id]['item_status'] == "Failed" and not download_queue[local_id].get('_recovery_gave_up'):
                             logger.debug(f'Retrying : {local_id}')
                             download_queue[local_id]['item_status'] = "Waiting"
             if config.get('retry_worker_delay') > 0:
@@ -139,6 +153,9 @@ class DownloadWorker:
     def __init__(self):
         self.thread = threading.Thread(target=self.run)
         self.is_running = True
+        # Looked up by the watchdog's recovery to find the worker and account of a stalled item
+        self.current_item = None
+        self.current_account = None
 
 
     def start(self):
@@ -148,6 +165,10 @@ class DownloadWorker:
 
     def readd_item_to_download_queue(self, item):
         """Re-add item to download queue - optimized to avoid delete/recreate"""
+        if item.get('_superseded'):
+            # Recovery requeued a copy of the item, the queue entry belongs to it
+            return
+        self._release_identity(item)
         with download_queue_lock:
             try:
                 local_id = item['local_id']
@@ -230,6 +251,8 @@ class DownloadWorker:
         Try to get a Spotify stream, with fallback to other accounts if one fails.
         Returns (stream, token, account_index) on success, raises exception on complete failure.
         """
+        from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
+        from librespot.metadata import TrackId, EpisodeId
         from .api.spotify import spotify_re_init_session
         
         if tried_accounts is None:
@@ -363,11 +386,147 @@ class DownloadWorker:
         return final_path
 
 
+    def _tag_audio_file(self, item, item_metadata, file_path):
+        """Embed metadata and cover art, with playlist specific album tags for playlist items."""
+        if not config.get('raw_media_download'):
+            # Override metadata for playlist tracks
+            if item.get('parent_category') == 'playlist':
+                item_metadata['album'] = item.get('playlist_name', item_metadata.get('album'))
+                item_metadata['album_name'] = item.get('playlist_name', item_metadata.get('album'))
+                item_metadata['album_artists'] = 'Various Artists'
+                item_metadata['album_type'] = 'compilation'  # This triggers compilation=1 in embed_metadata
+                item_metadata['disc_number'] = 1
+                item_metadata['total_discs'] = 1
+                item_metadata['parent_category'] = 'playlist'  # Pass to set_music_thumbnail for cover.jpg handling
+                # Use playlist cover instead of track's album cover
+                if item.get('playlist_image_url'):
+                    item_metadata['playlist_image_url'] = item.get('playlist_image_url')
+                logger.info(f"Playlist track: setting album to '{item_metadata['album']}', album_artist='Various Artists', disc=1/1, and album_type='compilation'")
+
+            with span(item, 'tagging'):
+                embed_metadata(item, item_metadata)
+
+            # Thumbnail
+            logger.debug(f"Checking thumbnail settings: save_album_cover={config.get('save_album_cover')}, embed_cover={config.get('embed_cover')}")
+            if config.get('save_album_cover') or config.get('embed_cover'):
+                item['item_status'] = 'Setting Thumbnail'
+                self.update_progress(item, "Setting Thumbnail", 99)
+                with span(item, 'thumbnail'):
+                    set_music_thumbnail(file_path, item_metadata)
+            else:
+                logger.info("Skipping thumbnail: both save_album_cover and embed_cover are disabled")
+
+            if os.path.splitext(file_path)[1] == '.mp3':
+                with span(item, 'tagging'):
+                    fix_mp3_metadata(file_path)
+        else:
+            if config.get('save_album_cover'):
+                item['item_status'] = 'Setting Thumbnail'
+                self.update_progress(item, "Setting Thumbnail", 99)
+                with span(item, 'thumbnail'):
+                    set_music_thumbnail(file_path, item_metadata)
+
+
+    def _release_identity(self, item):
+        """Drop the item's claim on its recording and hand the result to items waiting for it."""
+        keys = item.pop('_identity_keys', None)
+        if not keys:
+            return
+        path = item.get('file_path') if item['item_status'] == 'Downloaded' else None
+        for follower in library_index.release(keys, path):
+            follower(path)
+
+
+    def _requeue_follower(self, item, source_path):
+        """
+        Hand an item that waited for another worker's download of its recording back to the queue.
+        Any worker picks it up and copies `source_path`, or downloads it itself if the owner failed.
+        """
+        item['_duplicate_source'] = source_path
+        self.update_progress(item, "Waiting", 0)
+        self.readd_item_to_download_queue(item)
+
+
+    def _satisfy_duplicate(self, item, item_metadata, target_path, account_index, source_path):
+        """Complete `item` from an already downloaded copy of the same recording."""
+        try:
+            item['item_status'] = 'Copying'
+            self.update_progress(item, "Copying", 99)
+            # Tags are rewritten on the copy, only untouched raw files may share the inode
+            allow_hardlink = config.get('raw_media_download') and not config.get('save_album_cover')
+            with span(item, 'copy'):
+                method = clone_file(source_path, target_path, allow_hardlink=allow_hardlink)
+            logger.info(f"Reused {source_path} for '{item['item_id']}' via {method}, skipping download")
+            item['file_path'] = target_path
+            if not config.get('raw_media_download'):
+                # The copy still carries the tags and cover of the item it was downloaded for
+                with span(item, 'tagging'):
+                    strip_metadata(item)
+            self._tag_audio_file(item, item_metadata, target_path)
+            self._complete_item(item, item_metadata, account_index, reused=True)
+        except Exception as e:
+            logger.error(f"Failed to reuse {source_path} for '{item['item_id']}': {e}\nTraceback: {traceback.format_exc()}")
+            item['item_status'] = 'Failed'
+            self.update_progress(item, "Failed", 0)
+        self.readd_item_to_download_queue(item)
+
+
+    def _complete_item(self, item, item_metadata, account_index, reused=False):
+        """
+        Mark a finished item as downloaded, add it to its playlist M3U and count it in the statistics.
+        Items `reused` from another download's file add no downloaded data.
+        """
+        item['item_status'] = 'Downloaded'
+        # The transfer finished, a partial kept by an earlier attempt was resumed
+        item.pop('_partial_path', None)
+        logger.info("Item Successfully Downloaded")
+        item['progress'] = 100
+        self.update_progress(item, "Downloaded", 100)
+        record_completed(item)
+        record_completion()
+        reset_failure_count(account_index)  # Reset failure counter on successful download
+
+        if item.get('playlist_sync_key'):
+            record_track(item, item_metadata)
+
+        # Track completed playlist item and write M3U if playlist is complete
+        if config.get('create_m3u_file') and item.get('parent_category') == 'playlist':
+            try:
+                add_to_m3u_file(item, item_metadata)
+            except Exception as m3u_error:
+                logger.error(f"Failed to track playlist item for M3U: {str(m3u_error)}\nTraceback: {traceback.format_exc()}")
+
+        try:
+            # Counters are batched in memory and written by the debounced config flush
+            if not reused:
+                config.increment('total_downloaded_data', os.path.getsize(item['file_path']))
+            config.increment('total_downloaded_items')
+            config.save()
+        except Exception:
+            pass
+
+
+    def _finish_staged_item(self, item, item_metadata, account_index, move_started, library_path):
+        # Called by the staging mover once the file is in the library
+        record_span(item, 'move', time.perf_counter() - move_started)
+        item['file_path'] = library_path
+        self._complete_item(item, item_metadata, account_index)
+        self.readd_item_to_download_queue(item)
+
+
+    def _fail_staged_item(self, item, error):
+        item['item_status'] = 'Failed'
+        self.update_progress(item, "Failed", 0)
+        self.readd_item_to_download_queue(item)
+
+
     def run(self):
         last_heartbeat = time.time()
         heartbeat_interval = 60  # Log every 60 seconds
         
         while self.is_running:
+            self.current_item = None
+            self.current_account = None
             try:
                 # Periodic heartbeat logging
                 if time.time() - last_heartbeat > heartbeat_interval:
@@ -381,34 +540,14 @@ class DownloadWorker:
                     with runtimedata.batch_queue_processing_lock:
                         is_batch_processing = runtimedata.batch_queue_processing
                     
-                    if is_batch_processing:
-                        time.sleep(0.2)
-                        continue
-                    
                     if download_queue:
                         with download_queue_lock:
-                            # Sort queue by album to group album tracks together
-                            # Priority: album_name, track_number, then insertion order
-                            available_items = [
-                                (local_id, item) for local_id, item in download_queue.items()
-                                if item['available'] and item['item_status'] == 'Waiting'
-                            ]
-                            
-                            if not available_items:
-                                time.sleep(0.2)
-                                continue
-                            
-                            # Sort by playlist number (if playlist item), then album name, then track number
-                            available_items.sort(key=lambda x: (
-                                int(x[1].get('playlist_number', 0) or 0) if x[1].get('parent_category') == 'playlist' else 999999,  # Playlist items first, by number
-                                x[1].get('album_name') or '\uffff',  # Then group by album
-                                int(x[1].get('track_number') or 9999),  # Then by track number
-                                x[0]  # Maintain insertion order as tiebreaker
-                            ))
-                            
-                            # Get the first available item
-                            local_id, item = available_items[0]
-                            download_queue[local_id]['available'] = False
+                            # Interactive requests don't wait for a bulk import to finish queueing
+                            selected = select_next_item(('interactive',) if is_batch_processing else None)
+                        if not selected:
+                            time.sleep(0.2)
+                            continue
+                        local_id, item = selected
                     else:
                         time.sleep(0.2)
                         continue
@@ -432,32 +571,27 @@ class DownloadWorker:
                     time.sleep(0.2)
                     continue
 
-                item['item_status'] = "Downloading"
-                self.update_progress(item, "Downloading", 1)
+                self.current_item = item
+                # A user retried an item recovery gave up on, the retry worker may retry it again
+                item.pop('_recovery_gave_up', None)
+                reset_timings(item)
+                self.update_progress(item, CLAIMED_STATUS, 1)
                 
                 logger.info(f"Starting download for track ID: {item_id} from service: {item_service}")
 
-                # Update progress before potentially blocking operations
-                self.update_progress(item, "Downloading", 2)
-                token = get_account_token(item_service, rotate=config.get("rotate_active_account_number"))
+                with span(item, 'token'):
+                    token = get_account_token(item_service, rotate=config.get("rotate_active_account_number"))
                 # Get account index for failure tracking
                 account_index = self._find_account_index(item_service, token) if token else None
+                self.current_account = account_index
 
                 try:
-                    # For Spotify albums, we'll pass the album lock to the metadata function
-                    # so it can minimize the critical section
-                    album_lock_ctx = None
-                    if item_service == "spotify" and item.get('parent_category') == 'album' and item.get('parent_id'):
-                        album_key = f"{item_service}:{item.get('parent_id')}"
-                        with album_download_locks_lock:
-                            if album_key not in album_download_locks:
-                                album_download_locks[album_key] = threading.Lock()
-                            album_lock_ctx = album_download_locks[album_key]
-                    
-                    if album_lock_ctx:
-                        item_metadata = globals()[f"{item_service}_get_{item_type}_metadata"](token, item_id, album_lock=album_lock_ctx)
-                    else:
-                        item_metadata = globals()[f"{item_service}_get_{item_type}_metadata"](token, item_id)
+                    # Waiting for a slot is progress as far as the watchdog is concerned
+                    with span(item, 'metadata'), metadata_slot(item_service, on_wait=partial(self.update_progress, item, CLAIMED_STATUS, 1)):
+                        if item['item_status'] == CLAIMED_STATUS:
+                            item['item_status'] = 'Downloading'
+                        self.update_progress(item, "Downloading", 2)
+                        item_metadata = get_service_function(item_service, f"get_{item_type}_metadata")(token, item_id)
 
                     # album number shim from enumerated items, i hate youtube
                     if item_service == 'youtube_music' and item.get('parent_category') == 'album':
@@ -502,13 +636,13 @@ class DownloadWorker:
                     temp_file_path = os.path.join(directory, '~' + file_name)
 
                     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    logger.info(f"DEBUG full file_path: {file_path}")
+                    logger.debug(f"Full file_path: {file_path}")
 
                     # Skip download if file exists under different extension
                     file_directory = os.path.dirname(file_path)
                     target_filename = os.path.basename(file_path)
 
-                    logger.info(f"Checking for existing files matching: '{target_filename}.*' in {file_directory}")
+                    logger.debug(f"Checking for existing files matching: '{target_filename}.*' in {file_directory}")
 
                     # Check if directory exists first to avoid exception overhead
                     if os.path.isdir(file_directory):
@@ -536,6 +670,10 @@ class DownloadWorker:
                             if entry_base == target_filename:
                                 logger.info(f"MATCH FOUND! File '{entry.name}' matches target '{target_filename}' - Skipping download and metadata rewrite")
                                 item['file_path'] = entry.path
+                                if item_type == 'track':
+                                    library_index.record(identity_keys(item, item_metadata), entry.path)
+                                if item.get('playlist_sync_key'):
+                                    record_track(item, item_metadata)
 
                                 # Set status to Already Exists first
                                 if item['item_status'] in ('Downloading', 'Setting Thumbnail', 'Adding To M3U', 'Getting Lyrics'):
@@ -575,9 +713,42 @@ class DownloadWorker:
                     self.readd_item_to_download_queue(item)
                     continue
 
+                # Recordings already in the library, or being downloaded by another worker, are copied instead
+                if item_type == 'track' and item_service != 'generic' and config.get('deduplicate_library'):
+                    keys = identity_keys(item, item_metadata)
+                    target_path = build_final_file_path(file_path, item_type, None, item_service=item_service)
+                    extension = os.path.splitext(target_path)[1]
+                    # Items released by the download they waited for carry its file as a hint
+                    existing_path = item.pop('_duplicate_source', None)
+                    if not (existing_path and os.path.isfile(existing_path)):
+                        existing_path = library_index.find(keys, extension) if extension else None
+                    if existing_path and existing_path != target_path:
+                        self._satisfy_duplicate(item, item_metadata, target_path, account_index, existing_path)
+                        continue
+                    if extension:
+                        owner = library_index.claim(keys, item['local_id'], partial(self._requeue_follower, item))
+                        if owner:
+                            # Stays unavailable to workers until the owner releases it
+                            logger.info(f"'{item_id}' is already being downloaded as {owner}, waiting for it")
+                            item['item_status'] = 'Waiting'
+                            self.update_progress(item, "Waiting", 0)
+                            continue
+                        item['_identity_keys'] = keys
+
+                # With staging enabled audio is downloaded and processed on local scratch space,
+                # the mover places the finished file at library_file_path's directory
+                library_file_path = None
+                staging_root = get_staging_root()
+                if staging_root and item_service != 'generic' and item_type in ('track', 'podcast_episode'):
+                    library_file_path = file_path
+                    file_path = os.path.join(staging_root, os.path.relpath(file_path, dl_root))
+                    temp_file_path = os.path.join(os.path.dirname(file_path), '~' + os.path.basename(file_path))
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
                 try:
                     # Audio
                     if item_service == "spotify":
+                        from librespot.audio.decoders import AudioQuality
 
                         default_format = ".ogg"
                         temp_file_path += default_format
@@ -597,35 +768,24 @@ class DownloadWorker:
                         max_download_retries = 3
                         download_retry_count = 0
                         download_successful = False
+                        # Bytes kept from an interrupted attempt and the stream size they belong to
+                        resume_offset = 0
+                        resume_total_size = None
 
                         while download_retry_count < max_download_retries and not download_successful:
                             stream = None  # Initialize for finally block
                             try:
-                                # For Spotify albums, reacquire album lock for stream acquisition
-                                # For non-album items, no lock needed
-                                if item.get('parent_category') == 'album' and item.get('parent_id'):
-                                    stream_album_key = f"{item_service}:{item.get('parent_id')}"
-                                    with album_download_locks_lock:
-                                        if stream_album_key not in album_download_locks:
-                                            album_download_locks[stream_album_key] = threading.Lock()
-                                        stream_album_lock = album_download_locks[stream_album_key]
-                                    
-                                    # Acquire album lock for stream initialization with timeout
-                                    logger.debug(f"Reacquiring album lock for stream: {stream_album_key}")
-                                    lock_acquired = stream_album_lock.acquire(timeout=60)
-                                    if not lock_acquired:
-                                        raise RuntimeError(f"Failed to acquire album lock for {stream_album_key} after 60s timeout - possible deadlock")
-                                    try:
-                                        logger.debug(f"Acquired album lock, getting stream: {stream_album_key}")
-                                        # Get stream (with account fallback)
-                                        stream, token, _ = self._try_get_spotify_stream(item, item_id, item_type, token, quality)
-                                        logger.debug(f"Stream acquired, released lock: {stream_album_key}")
-                                    finally:
-                                        stream_album_lock.release()
-                                else:
-                                    # Non-album items don't need locking
+                                # Get stream (with account fallback)
+                                with span(item, 'stream_open'):
                                     stream, token, _ = self._try_get_spotify_stream(item, item_id, item_type, token, quality)
 
+                                total_size = stream.input_stream.size
+                                if resume_offset and total_size != resume_total_size:
+                                    # Another account may serve a different quality, that is a different file
+                                    logger.info(f"Stream size changed from {resume_total_size} to {total_size}, restarting download from scratch")
+                                    resume_offset = 0
+                                resume_total_size = total_size
+
                                 # Validate stream is working with initial test read
                                 stall_timeout = config.get("download_stall_timeout")
                                 test_data = None
@@ -634,14 +794,20 @@ class DownloadWorker:
                                 def test_stream_read():
                                     nonlocal test_data, test_error
                                     try:
+                                        if resume_offset:
+                                            # Continue after the last complete Ogg page of the previous attempt
+                                            skipped = stream.input_stream.stream().skip(resume_offset)
+                                            if skipped != resume_offset:
+                                                raise RuntimeError(f"Resumed stream is corrupted: skipped {skipped} of {resume_offset} bytes")
                                         # Try to read first chunk to verify stream is alive
                                         test_data = stream.input_stream.stream().read(1024)
                                     except Exception as e:
                                         test_error = e
                                 
                                 test_thread = threading.Thread(target=test_stream_read, daemon=True)
-                                test_thread.start()
-                                test_thread.join(timeout=5)  # 5 second timeout for initial stream validation
+                                with span(item, 'stream_open'):
+                                    test_thread.start()
+                                    test_thread.join(timeout=5)  # 5 second timeout for initial stream validation
                                 
                                 if test_thread.is_alive():
                                     raise Exception("Stream validation failed: initial read blocked (session likely dead)")
@@ -652,11 +818,18 @@ class DownloadWorker:
                                 if test_data is None:
                                     raise Exception("Stream validation failed: no data returned")
 
-                                total_size = stream.input_stream.size
-                                downloaded = len(test_data)  # Account for test read
+                                if resume_offset:
+                                    if test_data[:4] != b'OggS':
+                                        raise RuntimeError(f"Resumed stream is corrupted: no Ogg page at byte {resume_offset}")
+                                    logger.info(f"Resuming Spotify download at byte {resume_offset} of {total_size}")
+
+                                downloaded = resume_offset + len(test_data)  # Account for kept bytes and test read
                                 last_progress_time = time.time()
 
-                                with open(temp_file_path, 'wb') as file:
+                                with span(item, 'transfer'), open(temp_file_path, 'r+b' if resume_offset else 'wb') as file:
+                                    # Drop any partial page after the resume point
+                                    file.seek(resume_offset)
+                                    file.truncate()
                                     # Write initial test data
                                     file.write(test_data)
                                     
@@ -741,12 +914,7 @@ class DownloadWorker:
                                 logger.debug(f"Download validation: actual={actual_file_size}, expected={total_size}, counter={downloaded}, min={min_acceptable}")
 
                                 if actual_file_size < min_acceptable:
-                                    # File is definitely corrupted - clean it up
-                                    try:
-                                        os.remove(temp_file_path)
-                                        logger.debug(f"Removed corrupted temp file: {temp_file_path}")
-                                    except:
-                                        pass
+                                    # The retry resumes after the complete pages or removes the file
                                     raise RuntimeError(
                                         f"Download verification FAILED: actual file size {actual_file_size} bytes "
                                         f"is below minimum {min_acceptable} bytes (expected ~{total_size}). "
@@ -796,8 +964,15 @@ class DownloadWorker:
                                             except Exception as session_err:
                                                 logger.error(f"Failed to recreate session: {session_err}")
 
-                                        # Clean up partial file (stream cleanup in finally block)
-                                        if os.path.exists(temp_file_path):
+                                        # Keep complete Ogg pages so the next stream only fetches the missing data,
+                                        # corrupted files start over (stream cleanup in finally block)
+                                        resume_offset = 0
+                                        if (config.get('spotify_resume_downloads') and resume_total_size
+                                                and not any(x in error_str.lower() for x in ['corrupted', 'invalid ogg header'])):
+                                            resume_offset = find_ogg_resume_offset(temp_file_path)
+                                        if resume_offset:
+                                            logger.info(f"Keeping {resume_offset} of {resume_total_size} bytes for resume")
+                                        elif os.path.exists(temp_file_path):
                                             try:
                                                 os.remove(temp_file_path)
                                             except Exception:
@@ -835,7 +1010,9 @@ class DownloadWorker:
                                     gc.collect()
 
                     elif item_service == 'deezer':
-                        song = get_song_info_from_deezer_website(token, item['item_id'])
+                        from .api.deezer import get_song_info_from_deezer_website, genurlkey, calcbfkey, DeezerStreamDecryptor
+                        with span(item, 'stream_open'):
+                            song = get_song_info_from_deezer_website(token, item['item_id'])
 
                         song_quality = 1
                         song_format = 'MP3_128'
@@ -869,20 +1046,21 @@ class DownloadWorker:
 
                         while download_retry_count < max_download_retries and not download_successful:
                             try:
-                                track_data = token['session'].post(
-                                    "https://media.deezer.com/v1/get_url",
-                                    json={
-                                        'license_token': token['license_token'],
-                                        'media': [{
-                                            'type': "FULL",
-                                            'formats': [
-                                                { 'cipher': "BF_CBC_STRIPE", 'format': song_format }
-                                            ]
-                                        }],
-                                        'track_tokens': [song["TRACK_TOKEN"]]
-                                    },
-                                    headers = headers
-                                ).json()
+                                with span(item, 'stream_open'):
+                                    track_data = token['session'].post(
+                                        "https://media.deezer.com/v1/get_url",
+                                        json={
+                                            'license_token': token['license_token'],
+                                            'media': [{
+                                                'type': "FULL",
+                                                'formats': [
+                                                    { 'cipher': "BF_CBC_STRIPE", 'format': song_format }
+                                                ]
+                                            }],
+                                            'track_tokens': [song["TRACK_TOKEN"]]
+                                        },
+                                        headers = headers
+                                    ).json()
 
                                 try:
                                     logger.debug(track_data)
@@ -899,52 +1077,17 @@ class DownloadWorker:
 
                                 final_file_path = self._ensure_playlist_entry(item, item_metadata, file_path, default_format, final_file_path) or final_file_path
 
-                                stall_timeout = config.get("download_stall_timeout")
-                                # Timeout tuple: (connect timeout, read timeout)
-                                # Both set to stall_timeout to ensure requests don't hang
-                                request_timeout = (stall_timeout, stall_timeout)
-
-                                file = requests.get(url, stream=True, timeout=request_timeout)
-
-                                if file.status_code == 200:
-                                    total_size = int(file.headers.get('content-length', 0))
-                                    downloaded = 0
-                                    data_chunks = b''
-                                    last_progress_time = time.time()
-
-                                    for data in file.iter_content(chunk_size=config.get("download_chunk_size")):
-                                        # Check for stalled download
-                                        if time.time() - last_progress_time > stall_timeout:
-                                            raise Exception(f"Download stalled (no progress for {stall_timeout}s), reconnecting...")
-
-                                        downloaded += len(data)
-                                        data_chunks += data
-
-                                        if downloaded != total_size:
-                                            if item['item_status'] == 'Cancelled':
-                                                raise Exception("Download cancelled by user.")
-                                            progress_pct = int((downloaded / total_size) * 100)
-                                            self.update_progress(item, "Downloading", progress_pct)
-                                            last_progress_time = time.time()  # Update progress time when data received
-
-                                    key = calcbfkey(song["SNG_ID"])
-
-                                    self.update_progress(item, "Decrypting", 99)
-                                    with open(temp_file_path, "wb") as fo:
-                                        decryptfile(data_chunks, key, fo)
-                                        # Ensure all data is flushed to disk before closing
-                                        fo.flush()
-                                        os.fsync(fo.fileno())
-
-                                    download_successful = True
-                                    logger.info(f"Deezer download completed successfully after {download_retry_count + 1} attempt(s)")
+                                # Blocks are decrypted as they arrive, the partial file stays block aligned for resuming
+                                key = calcbfkey(song["SNG_ID"])
+                                with span(item, 'transfer'):
+                                    download_resumable(
+                                        url, temp_file_path, item,
+                                        lambda progress_pct: self.update_progress(item, "Downloading", progress_pct),
+                                        decryptor_factory=lambda offset: DeezerStreamDecryptor(key, offset)
+                                    )
 
-                                else:
-                                    logger.info(f"Deezer download attempts failed: {file.status_code}")
-                                    item['item_status'] = "Failed"
-                                    self.update_progress(item, "Failed", 0)
-                                    self.readd_item_to_download_queue(item)
-                                    break
+                                download_successful = True
+                                logger.info(f"Deezer download completed successfully after {download_retry_count + 1} attempt(s)")
 
                             except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
                                 # Timeout or connection errors are always recoverable
@@ -977,6 +1120,7 @@ class DownloadWorker:
                                     raise
 
                     elif item_service in ("soundcloud", "youtube_music"):
+                        from yt_dlp import YoutubeDL
                         item_url = item_metadata['item_url']
                         ydl_opts = {}
                         if item_service == "soundcloud":
@@ -1004,13 +1148,15 @@ class DownloadWorker:
                                 bitrate = f"{info_dict.get('abr')}k"
                                 default_format = f".{info_dict.get('audio_ext')}"
                             final_file_path = self._ensure_playlist_entry(item, item_metadata, file_path, default_format, final_file_path) or final_file_path
-                            video.download(item_url)
+                            with span(item, 'transfer'):
+                                video.download(item_url)
 
                     elif item_service in ("bandcamp", "qobuz", "tidal"):
                         if item_service in ("qobuz", "tidal"):
                             default_format = '.flac'
                             bitrate = "1411k"
-                            file_url = globals()[f"{item_service}_get_file_url"](token, item_id)
+                            with span(item, 'stream_open'):
+                                file_url = get_service_function(item_service, "get_file_url")(token, item_id)
                         elif item_service == 'bandcamp':
                             default_format = '.mp3'
                             bitrate = "128k"
@@ -1025,37 +1171,12 @@ class DownloadWorker:
 
                         while download_retry_count < max_download_retries and not download_successful:
                             try:
-                                stall_timeout = config.get("download_stall_timeout")
-                                # Timeout tuple: (connect timeout, read timeout)
-                                # Both set to stall_timeout to ensure requests don't hang
-                                request_timeout = (stall_timeout, stall_timeout)
-
-                                response = requests.get(file_url, stream=True, timeout=request_timeout)
-                                total_size = int(response.headers.get('Content-Length', 0))
-                                downloaded = 0
-                                data_chunks = b''
-                                last_progress_time = time.time()
-                                with open(temp_file_path, 'wb') as file:
-                                    for data in response.iter_content(chunk_size=config.get("download_chunk_size", 1024)):
-                                        # Check for stalled download
-                                        if time.time() - last_progress_time > stall_timeout:
-                                            raise Exception(f"Download stalled (no progress for {stall_timeout}s), reconnecting...")
-
-                                        if data:
-                                            downloaded += len(data)
-                                            data_chunks += data
-                                            file.write(data)
-
-                                            if total_size > 0 and downloaded != total_size:
-                                                if item['item_status'] == 'Cancelled':
-                                                    raise Exception("Download cancelled by user.")
-                                                progress_pct = int((downloaded / total_size) * 100)
-                                                self.update_progress(item, "Downloading", progress_pct)
-                                                last_progress_time = time.time()  # Update progress time when data received
-
-                                    # Ensure all data is flushed to disk before closing
-                                    file.flush()
-                                    os.fsync(file.fileno())
+                                # Interrupted attempts leave a partial file that is resumed with a Range request
+                                with span(item, 'transfer'):
+                                    download_resumable(
+                                        file_url, temp_file_path, item,
+                                        lambda progress_pct: self.update_progress(item, "Downloading", progress_pct)
+                                    )
 
                                 download_successful = True
                                 logger.info(f"{item_service} download completed successfully after {download_retry_count + 1} attempt(s)")
@@ -1066,12 +1187,6 @@ class DownloadWorker:
                                 if download_retry_count < max_download_retries:
                                     logger.warning(f"{item_service} download connection/timeout error (attempt {download_retry_count}/{max_download_retries}): {e}")
                                     logger.info(f"Reconnecting and retrying {item_service} download...")
-                                    # Clean up partial file
-                                    if os.path.exists(temp_file_path):
-                                        try:
-                                            os.remove(temp_file_path)
-                                        except Exception:
-                                            pass
                                     # Wait a bit before retrying
                                     time.sleep(2)
                                     continue
@@ -1086,12 +1201,6 @@ class DownloadWorker:
                                     if download_retry_count < max_download_retries:
                                         logger.warning(f"{item_service} download interrupted (attempt {download_retry_count}/{max_download_retries}): {error_str}")
                                         logger.info(f"Reconnecting and retrying {item_service} download...")
-                                        # Clean up partial file
-                                        if os.path.exists(temp_file_path):
-                                            try:
-                                                os.remove(temp_file_path)
-                                            except Exception:
-                                                pass
                                         # Wait a bit before retrying
                                         time.sleep(2)
                                         continue
@@ -1103,9 +1212,12 @@ class DownloadWorker:
                                     raise
 
                     elif item_service == "apple_music":
+                        from yt_dlp import YoutubeDL
+                        from .api.apple_music import apple_music_get_decryption_key, apple_music_get_webplayback_info
                         default_format = '.m4a'
                         bitrate = "256k"
-                        webplayback_info = apple_music_get_webplayback_info(token, item_id)
+                        with span(item, 'stream_open'):
+                            webplayback_info = apple_music_get_webplayback_info(token, item_id)
 
                         stream_url = None
                         for asset in webplayback_info["assets"]:
@@ -1116,7 +1228,8 @@ class DownloadWorker:
                             logger.error(f'Apple music playback info invalid: {webplayback_info}')
                             continue
 
-                        decryption_key = apple_music_get_decryption_key(token, stream_url, item_id)
+                        with span(item, 'stream_open'):
+                            decryption_key = apple_music_get_decryption_key(token, stream_url, item_id)
                         final_file_path = self._ensure_playlist_entry(item, item_metadata, file_path, default_format, final_file_path) or final_file_path
 
                         ydl_opts = {}
@@ -1129,7 +1242,8 @@ class DownloadWorker:
                         ydl_opts['noprogress'] = True
                         ydl_opts['progress_hooks'] = [lambda d: self.yt_dlp_progress_hook(item, d)]
                         with YoutubeDL(ydl_opts) as video:
-                            video.download(stream_url)
+                            with span(item, 'transfer'):
+                                video.download(stream_url)
 
                         self.update_progress(item, "Decrypting", 99)
 
@@ -1145,10 +1259,11 @@ class DownloadWorker:
                             "+faststart",
                             decrypted_temp_file_path
                         ]
-                        if os.name == 'nt':
-                            subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
-                        else:
-                            subprocess.check_call(command, shell=False)
+                        with span(item, 'decrypt'):
+                            if os.name == 'nt':
+                                subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
+                            else:
+                                subprocess.check_call(command, shell=False)
 
                         if os.path.exists(temp_file_path):
                             os.remove(temp_file_path)
@@ -1156,6 +1271,8 @@ class DownloadWorker:
 
                     # Video
                     elif item_service == "crunchyroll":
+                        from yt_dlp import YoutubeDL
+                        from .api.crunchyroll import crunchyroll_get_decryption_key, crunchyroll_get_mpd_info, crunchyroll_close_stream
                         ydl_opts = {}
                         ydl_opts['quiet'] = True
                         ydl_opts['no_warnings'] = True
@@ -1163,6 +1280,8 @@ class DownloadWorker:
                         ydl_opts['fixup'] = 'never'
                         ydl_opts['allowed_extractors'] = ['generic']
                         ydl_opts['noprogress'] = True
+                        # DASH fragments are fetched in parallel like segmented HTTP downloads
+                        ydl_opts['concurrent_fragment_downloads'] = max(1, config.get('download_segments'))
                         ydl_opts['progress_hooks'] = [lambda d: self.yt_dlp_progress_hook(item, d)]
 
                         # Extract preferred language
@@ -1194,7 +1313,8 @@ class DownloadWorker:
                                         'decryption_key': decryption_key,
                                         'language': version['audio_locale']
                                     })
-                                    video.download(mpd_url)
+                                    with span(item, 'transfer'):
+                                        video.download(mpd_url)
 
                                 token = get_account_token(item_service)
                                 headers['Authorization'] = f'Bearer {token}'
@@ -1210,7 +1330,8 @@ class DownloadWorker:
                                         'type': 'audio',
                                         'language': version['audio_locale']
                                     })
-                                    audio.download(mpd_url)
+                                    with span(item, 'transfer'):
+                                        audio.download(mpd_url)
 
                                 crunchyroll_close_stream(token, item_id, stream_token)
 
@@ -1257,10 +1378,11 @@ class DownloadWorker:
                                 "+faststart",
                                 decrypted_temp_file_path
                             ]
-                            if os.name == 'nt':
-                                subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
-                            else:
-                                subprocess.check_call(command, shell=False)
+                            with span(item, 'decrypt'):
+                                if os.name == 'nt':
+                                    subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
+                                else:
+                                    subprocess.check_call(command, shell=False)
 
                             if os.path.exists(encrypted_file['path']):
                                 os.remove(encrypted_file['path'])
@@ -1291,6 +1413,7 @@ class DownloadWorker:
                                     })
 
                     elif item_service == 'generic':
+                        from yt_dlp import YoutubeDL
                         temp_file_path = ''
                         ydl_opts = {}
                         ydl_opts['format'] = (f'(bestvideo[height<={config.get("preferred_video_resolution")}][ext=mp4]+bestaudio[ext=m4a])/'
@@ -1307,7 +1430,8 @@ class DownloadWorker:
                         ydl_opts['progress_hooks'] = [lambda d: self.yt_dlp_progress_hook(item, d)]
                         with YoutubeDL(ydl_opts) as video:
                             item['file_path'] = video.prepare_filename(video.extract_info(item_id, download=False))
-                            video.download(item_id)
+                            with span(item, 'transfer'):
+                                video.download(item_id)
 
                 except RuntimeError as e:
                     error_str = str(e).lower()
@@ -1336,6 +1460,10 @@ class DownloadWorker:
                     self.readd_item_to_download_queue(item)
                     continue
 
+                if item.get('_superseded'):
+                    logger.info(f"Dropping download of '{item_id}', recovery requeued it after a stall")
+                    continue
+
                 if item_service != 'generic':
                     item['progress'] = 99
                     # Audio Formatting
@@ -1344,7 +1472,8 @@ class DownloadWorker:
                         if item_service in ("apple_music", "spotify", "tidal") and config.get('download_lyrics'):
                             item['item_status'] = 'Getting Lyrics'
                             self.update_progress(item, "Getting Lyrics", 99)
-                            extra_metadata = globals()[f"{item_service}_get_lyrics"](token, item_id, item_type, item_metadata, file_path)
+                            with span(item, 'lyrics'):
+                                extra_metadata = get_service_function(item_service, "get_lyrics")(token, item_id, item_type, item_metadata, file_path)
                             if isinstance(extra_metadata, dict):
                                 item_metadata.update(extra_metadata)
 
@@ -1355,8 +1484,10 @@ class DownloadWorker:
                         os.rename(temp_file_path, file_path)
                         item['file_path'] = file_path
 
-                        # Small delay for filesystem sync (helps in edge cases)
-                        time.sleep(0.1)
+                        # Small delay for filesystem sync (helps in edge cases), staged files are
+                        # renamed on local scratch space and fsynced by the mover
+                        if not library_file_path:
+                            time.sleep(0.1)
 
                         # Validate file after download
                         if not os.path.exists(file_path):
@@ -1373,40 +1504,10 @@ class DownloadWorker:
 
                             if config.get('use_custom_file_bitrate'):
                                 bitrate = config.get("file_bitrate")
-                            convert_audio_format(file_path, bitrate, default_format)
-
-                            # Override metadata for playlist tracks
-                            if item.get('parent_category') == 'playlist':
-                                item_metadata['album'] = item.get('playlist_name', item_metadata.get('album'))
-                                item_metadata['album_name'] = item.get('playlist_name', item_metadata.get('album'))
-                                item_metadata['album_artists'] = 'Various Artists'
-                                item_metadata['album_type'] = 'compilation'  # This triggers compilation=1 in embed_metadata
-                                item_metadata['disc_number'] = 1
-                                item_metadata['total_discs'] = 1
-                                item_metadata['parent_category'] = 'playlist'  # Pass to set_music_thumbnail for cover.jpg handling
-                                # Use playlist cover instead of track's album cover
-                                if item.get('playlist_image_url'):
-                                    item_metadata['playlist_image_url'] = item.get('playlist_image_url')
-                                logger.info(f"Playlist track: setting album to '{item_metadata['album']}', album_artist='Various Artists', disc=1/1, and album_type='compilation'")
-
-                            embed_metadata(item, item_metadata)
-
-                            # Thumbnail
-                            logger.debug(f"Checking thumbnail settings: save_album_cover={config.get('save_album_cover')}, embed_cover={config.get('embed_cover')}")
-                            if config.get('save_album_cover') or config.get('embed_cover'):
-                                item['item_status'] = 'Setting Thumbnail'
-                                self.update_progress(item, "Setting Thumbnail", 99)
-                                set_music_thumbnail(file_path, item_metadata)
-                            else:
-                                logger.info("Skipping thumbnail: both save_album_cover and embed_cover are disabled")
+                            with span(item, 'conversion'):
+                                convert_audio_format(file_path, bitrate, default_format)
 
-                            if os.path.splitext(file_path)[1] == '.mp3':
-                                fix_mp3_metadata(file_path)
-                        else:
-                            if config.get('save_album_cover'):
-                                item['item_status'] = 'Setting Thumbnail'
-                                self.update_progress(item, "Setting Thumbnail", 99)
-                                set_music_thumbnail(file_path, item_metadata)
+                        self._tag_audio_file(item, item_metadata, file_path)
 
                         # M3U
                         if config.get('create_m3u_file') and item.get('parent_category') == 'playlist' and not item.get('_m3u_written'):
@@ -1432,34 +1533,36 @@ class DownloadWorker:
                                 output_format = config.get("show_file_format")
                             elif item_type == "movie":
                                 output_format = config.get("movie_file_format")
-                            convert_video_format(item, file_path, output_format, video_files, item_metadata)
+                            with span(item, 'conversion'):
+                                convert_video_format(item, file_path, output_format, video_files, item_metadata)
                             item['file_path'] = file_path + '.' + output_format
                         else:
                             item['file_path'] = file_path + '.mp4'
 
-                item['item_status'] = 'Downloaded'
-                logger.info("Item Successfully Downloaded")
-                item['progress'] = 100
-                self.update_progress(item, "Downloaded", 100)
-                reset_failure_count(account_index)  # Reset failure counter on successful download
-                
-                # Track completed playlist item and write M3U if playlist is complete
-                if config.get('create_m3u_file') and item.get('parent_category') == 'playlist':
-                    try:
-                        add_to_m3u_file(item, item_metadata)
-                    except Exception as m3u_error:
-                        logger.error(f"Failed to track playlist item for M3U: {str(m3u_error)}\nTraceback: {traceback.format_exc()}")
-                
-                try:
-                    config.set('total_downloaded_data', config.get('total_downloaded_data') + os.path.getsize(item['file_path']))
-                    config.set('total_downloaded_items', config.get('total_downloaded_items') + 1)
-                    config.save()
-                except Exception:
-                    pass
+                if library_file_path:
+                    # The worker moves on, the item completes once the mover placed it in the library
+                    item['item_status'] = 'Moving'
+                    self.update_progress(item, "Moving", 99)
+                    get_staging_mover().enqueue(
+                        file_path, os.path.dirname(library_file_path),
+                        partial(self._finish_staged_item, item, item_metadata, account_index, time.perf_counter()),
+                        partial(self._fail_staged_item, item)
+                    )
+                    time.sleep(config.get("download_delay"))
+                    continue
+
+                self._complete_item(item, item_metadata, account_index)
                 time.sleep(config.get("download_delay"))
                 self.readd_item_to_download_queue(item)
                 continue
             except Exception as e:
+                if item.get('_superseded'):
+                    # The requeued copy owns the queue entry and the files now, unless recovery gave up on it
+                    logger.info(f"Stopped download of '{item.get('item_id')}' after recovery requeued it: {e}")
+                    if item.get('_recovery_gave_up') and temp_file_path:
+                        discard_partial(temp_file_path)
+                    continue
+
                 error_str = str(e).lower()
                 # Session/auth errors are more serious - count them more heavily
                 is_session_error = any(x in error_str for x in [
@@ -1505,6 +1608,17 @@ class DownloadWorker:
                     if temp_files:
                         logger.info(f"Found {len(temp_files)} temp files to clean up: {temp_files}")
 
+                # Keep partial transfers so the retry can resume them, unless the user cancelled
+                if item['item_status'] == 'Cancelled':
+                    if temp_file_path:
+                        discard_partial(temp_file_path)
+                    discard_item_partial(item)
+                else:
+                    cleanup_paths = [path for path in cleanup_paths if not is_partial_file(path)]
+                    if temp_file_path:
+                        # Removed with the item if it leaves the queue before a retry resumes it
+                        item['_partial_path'] = temp_file_path
+
                 # Remove all identified files
                 for cleanup_path in set(cleanup_paths):  # Use set to avoid duplicates
                     if cleanup_path and os.path.exists(cleanup_path):
@@ -0,0 +1,382 @@
+"""
+Resumable HTTP downloads.
+
+Bytes of an unfinished transfer are kept in `<temp file>.part` next to a
+`<temp file>.part.json` sidecar that records the size and validators of the
+response they came from. The next attempt, including an item retry after a
+hard restart, requests only the missing bytes with a `Range` header and
+starts over if the server now returns a different file. A failed item keeps
+its partial until it is retried, leaves the download queue or recovery gives
+up on it.
+
+Files above `segmented_download_min_size_mb` can be split into
+`download_segments` Range requests that run in parallel over a pooled session
+and write into a preallocated partial file. Per segment progress is kept in
+the sidecar so those resume as well.
+
+Response bodies are read straight into one preallocated buffer per transfer,
+so memory per worker stays constant regardless of the file size.
+
+Offsets, `Content-Length` and `Range` all count bytes on the wire, so bodies
+are requested and stored without content encoding. A server that compresses
+the body anyway is downloaded in one piece and decoded, without resuming.
+"""
+import json
+import os
+import re
+import threading
+import time
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from .otsconfig import config
+from .runtimedata import download_queue, get_logger
+
+logger = get_logger("http_download")
+
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+CONTENT_RANGE_REGEX = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+STATE_SAVE_INTERVAL = 1.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_download_session():
+    """Shared session for media downloads, sized for every worker running all its segments."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = max(10, config.get('maximum_download_workers') * max(1, config.get('download_segments', 1)))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def partial_paths(temp_file_path):
+    return temp_file_path + PART_SUFFIX, temp_file_path + STATE_SUFFIX
+
+
+def discard_partial(temp_file_path):
+    for path in partial_paths(temp_file_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def is_partial_file(path):
+    return path.endswith(PART_SUFFIX) or path.endswith(STATE_SUFFIX)
+
+
+def discard_item_partial(item):
+    """Remove the partial transfer a failed item kept for its next attempt."""
+    temp_file_path = item.pop('_partial_path', None)
+    if temp_file_path:
+        discard_partial(temp_file_path)
+
+
+# Items that leave the queue never come back for their partial transfer
+download_queue.on_remove = discard_item_partial
+
+
+def _load_state(temp_file_path):
+    part_path, state_path = partial_paths(temp_file_path)
+    try:
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+        return os.path.getsize(part_path), state
+    except (OSError, ValueError):
+        discard_partial(temp_file_path)
+        return 0, None
+
+
+def _save_state(temp_file_path, state):
+    state_path = partial_paths(temp_file_path)[1]
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+
+
+def _response_state(response, total_size):
+    return {
+        'total_size': total_size,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+
+
+def _open(url, headers, offset, state, session, timeout, end=None, probe=False):
+    request_headers = dict(headers or {})
+    request_headers.setdefault('Accept-Encoding', 'identity')
+    if offset or end is not None:
+        request_headers['Range'] = f'bytes={offset}-{"" if end is None else end}'
+        # Servers answer 200 with the full body if the file changed since the partial was written
+        validator = state.get('etag') or state.get('last_modified')
+        if validator:
+            request_headers['If-Range'] = validator
+    elif probe:
+        # An open range reveals whether the server can split the file, at no extra request
+        request_headers['Range'] = 'bytes=0-'
+    return session.get(url, headers=request_headers, stream=True, timeout=timeout)
+
+
+def _content_encoded(response):
+    return response.headers.get('Content-Encoding', 'identity').lower() not in ('', 'identity')
+
+
+def _read_chunks(response, decode=False):
+    """
+    Yield views of a single reusable buffer filled from the raw response body.
+    Each view is only valid until the next one is requested.
+    """
+    buffer = bytearray(config.get("download_chunk_size", 1024))
+    view = memoryview(buffer)
+    raw = response.raw
+    raw.decode_content = decode
+    while True:
+        try:
+            size = raw.readinto(buffer)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except ProtocolError as e:
+            raise Exception(f"Incomplete download: connection broken ({e})")
+        if not size:
+            return
+        yield view[:size]
+
+
+def _segments_enabled(decryptor_factory):
+    # Decrypted streams depend on block order, they always use a single connection
+    return decryptor_factory is None and config.get('download_segments', 1) > 1
+
+
+def _log_speed(temp_file_path, transferred, started, segments=1):
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info(
+        f"Downloaded {os.path.basename(temp_file_path)}: {transferred / (1024 * 1024):.1f} MB in {elapsed:.1f}s "
+        f"({transferred / elapsed / (1024 * 1024):.2f} MB/s, {segments} connection(s))"
+    )
+
+
+def _resume_matches(response, offset, state):
+    if _content_encoded(response):
+        return False
+    match = CONTENT_RANGE_REGEX.match(response.headers.get('Content-Range', ''))
+    if not match or int(match.group(1)) != offset:
+        return False
+    if match.group(3) != '*' and state.get('total_size') and int(match.group(3)) != state['total_size']:
+        return False
+    etag = response.headers.get('ETag')
+    if etag and state.get('etag') and etag != state['etag']:
+        return False
+    return True
+
+
+def download_resumable(url, temp_file_path, item, progress_callback, headers=None, session=None, decryptor_factory=None):
+    """
+    Download `url` into `temp_file_path`, continuing a previous partial transfer if possible.
+
+    `decryptor_factory(offset)` may return an object with `update(data)` and `finalize()`
+    that transforms the stream. `update` must only return whole cipher blocks so the
+    partial file always ends on a boundary the next attempt can resume from.
+    Raises on stalls, cancellation and short reads, the partial file is kept for the next attempt.
+    """
+    session = session or get_download_session()
+    stall_timeout = config.get("download_stall_timeout")
+    # Timeout tuple: (connect timeout, read timeout)
+    request_timeout = (stall_timeout, stall_timeout)
+    part_path = partial_paths(temp_file_path)[0]
+    started = time.time()
+
+    offset, state = _load_state(temp_file_path)
+    if state and state.get('segments'):
+        return _download_segments(url, temp_file_path, item, progress_callback, headers, session, state)
+
+    response = _open(url, headers, offset, state, session, request_timeout, probe=_segments_enabled(decryptor_factory))
+
+    if offset and response.status_code == 416 and state.get('total_size') == offset:
+        # Everything was already transferred before the interruption
+        response.close()
+        total_size = offset
+    else:
+        if offset and not (response.status_code == 206 and _resume_matches(response, offset, state)):
+            if response.status_code != 200:
+                response.close()
+                discard_partial(temp_file_path)
+                response = _open(url, headers, 0, None, session, request_timeout)
+            logger.info(f"Server did not resume {os.path.basename(temp_file_path)} at byte {offset}, starting over")
+            offset = 0
+        response.raise_for_status()
+
+        if offset:
+            total_size = state.get('total_size') or 0
+            logger.info(f"Resuming {os.path.basename(temp_file_path)} at byte {offset} of {total_size}")
+        elif _content_encoded(response):
+            # Content-Length counts the encoded bytes, progress follows the raw stream
+            total_size = int(response.headers.get('Content-Length', 0))
+            logger.info(f"Server sent {os.path.basename(temp_file_path)} with Content-Encoding {response.headers['Content-Encoding']}, downloading without resume")
+            discard_partial(temp_file_path)
+        else:
+            total_size = int(response.headers.get('Content-Length', 0))
+            state = _response_state(response, total_size)
+            segment_count = config.get('download_segments', 1)
+            # Without a Content-Length there is nothing to split, the file comes in one stream
+            if (response.status_code == 206 and _segments_enabled(decryptor_factory) and total_size > 0
+                    and total_size >= config.get('segmented_download_min_size_mb', 20) * 1024 * 1024):
+                segment_size = -(-total_size // segment_count)
+                state['segments'] = [
+                    [start, min(start + segment_size, total_size) - 1, 0]
+                    for start in range(0, total_size, segment_size)
+                ]
+                _save_state(temp_file_path, state)
+                return _download_segments(url, temp_file_path, item, progress_callback, headers, session, state, response)
+            _save_state(temp_file_path, state)
+
+        encoded = _content_encoded(response)
+        decryptor = decryptor_factory(offset) if decryptor_factory else None
+        downloaded = offset
+        received = offset
+        last_progress_time = time.time()
+        with open(part_path, 'r+b' if offset else 'wb') as file:
+            file.seek(offset)
+            file.truncate()
+            for data in _read_chunks(response, decode=encoded):
+                # Check for stalled download
+                if time.time() - last_progress_time > stall_timeout:
+                    raise Exception(f"Download stalled (no progress for {stall_timeout}s), reconnecting...")
+
+                downloaded += len(data)
+                received = response.raw.tell() if encoded else downloaded
+                file.write(decryptor.update(data) if decryptor else data)
+
+                if total_size > 0 and received != total_size:
+                    if item['item_status'] == 'Cancelled':
+                        raise Exception("Download cancelled by user.")
+                    progress_callback(int((received / total_size) * 100))
+                    last_progress_time = time.time()  # Update progress time when data received
+
+            if total_size and received != total_size:
+                raise Exception(f"Incomplete download: received {received} of {total_size} bytes")
+            if decryptor:
+                file.write(decryptor.finalize())
+
+            # Ensure all data is flushed to disk before closing
+            file.flush()
+            os.fsync(file.fileno())
+
+    os.replace(part_path, temp_file_path)
+    discard_partial(temp_file_path)
+    _log_speed(temp_file_path, downloaded - offset, started)
+    return total_size
+
+
+def _download_segments(url, temp_file_path, item, progress_callback, headers, session, state, first_response=None):
+    """
+    Fetch the `[start, end, done]` segments of `state` in parallel into the preallocated partial file.
+    `first_response` is an already open `bytes=0-` response that serves the first segment.
+    """
+    stall_timeout = config.get("download_stall_timeout")
+    request_timeout = (stall_timeout, stall_timeout)
+    part_path = partial_paths(temp_file_path)[0]
+    total_size = state['total_size']
+    segments = state['segments']
+    started = time.time()
+    initial = sum(segment[2] for segment in segments)
+
+    if first_response is not None or not os.path.exists(part_path):
+        with open(part_path, 'wb') as file:
+            file.truncate(total_size)
+    else:
+        logger.info(f"Resuming {os.path.basename(temp_file_path)} with {initial} of {total_size} bytes in {len(segments)} segments")
+
+    stop = threading.Event()
+    errors = []
+    restart = []
+
+    def fetch(index, response):
+        start, end, done = segments[index]
+        position = start + done
+        try:
+            if response is None:
+                response = _open(url, headers, position, state, session, request_timeout, end=end)
+                if response.status_code != 206 or not _resume_matches(response, position, state):
+                    # The server ignored the range or the file changed, segments can't be combined
+                    restart.append(index)
+                    stop.set()
+                    return
+            # Each segment owns its own file handle and byte range, writes never overlap
+            with open(part_path, 'r+b') as file:
+                file.seek(position)
+                for data in _read_chunks(response):
+                    if stop.is_set():
+                        return
+                    # The first segment rides on an open ended range, cut it at the segment end
+                    data = data[:end + 1 - position]
+                    file.write(data)
+                    position += len(data)
+                    segments[index][2] = position - start
+                    if position > end:
+                        break
+            if position <= end:
+                raise Exception(f"Incomplete download: segment {index} stopped at byte {position} of {end + 1}")
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if response is not None:
+                response.close()
+
+    threads = []
+    for index, (start, end, done) in enumerate(segments):
+        if start + done > end:
+            continue
+        response = first_response if index == 0 and first_response is not None else None
+        thread = threading.Thread(target=fetch, args=(index, response), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    last_downloaded = initial
+    last_progress_time = time.time()
+    last_save_time = time.time()
+    try:
+        while True:
+            alive = [thread for thread in threads if thread.is_alive()]
+            if not alive:
+                break
+            alive[0].join(timeout=0.5)
+
+            if item['item_status'] == 'Cancelled':
+                raise Exception("Download cancelled by user.")
+
+            now = time.time()
+            downloaded = sum(segment[2] for segment in segments)
+            if downloaded != last_downloaded:
+                last_downloaded = downloaded
+                last_progress_time = now
+                progress_callback(int((downloaded / total_size) * 100))
+            elif now - last_progress_time > stall_timeout:
+                raise Exception(f"Download stalled (no progress for {stall_timeout}s), reconnecting...")
+
+            if now - last_save_time > STATE_SAVE_INTERVAL:
+                _save_state(temp_file_path, state)
+                last_save_time = now
+
+        if restart:
+            discard_partial(temp_file_path)
+            raise Exception(f"Incomplete download: server did not honour the range of segment {restart[0]}, restarting")
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        if os.path.exists(partial_paths(temp_file_path)[1]):
+            _save_state(temp_file_path, state)
+
+    with open(part_path, 'r+b') as file:
+        # Ensure all data is flushed to disk before closing
+        os.fsync(file.fileno())
+    os.replace(part_path, temp_file_path)
+    discard_partial(temp_file_path)
+    _log_speed(temp_file_path, total_size - initial, started, len(segments))
+    return total_size
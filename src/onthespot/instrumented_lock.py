@@ -0,0 +1,152 @@
+"""
+Opt-in contention statistics for the global locks in runtimedata.
+
+With `instrument_locks` enabled the named locks are `InstrumentedLock`s: they
+record how long threads waited to acquire them and how long they were held,
+which call sites held them longest and which thread holds them right now.
+The statistics are served by /api/locks. Disabled, the plain locks are used
+and nothing is recorded.
+"""
+import os
+import sys
+import threading
+import time
+
+TOP_CALL_SITES = 10
+
+_locks = []
+_locks_registry_lock = threading.Lock()
+
+
+def _call_site():
+    # First frame outside of this module, the code that asked for the lock
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class InstrumentedLock:
+    """`threading.Lock` that records acquire waits, hold times, holders by call site and the owner."""
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.owner = None
+        self.owner_site = None
+        self.acquired_at = None
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_hold = 0.0
+        self.max_hold = 0.0
+        # call site -> [acquisitions, total hold, max hold, total wait]
+        self.call_sites = {}
+        # Guards adding call sites against get_stats copying them, the lock itself can't be used for that
+        self._stats_lock = threading.Lock()
+
+
+    def acquire(self, blocking=True, timeout=-1):
+        site = _call_site()
+        start = time.perf_counter()
+        if not self._lock.acquire(False):
+            if not blocking or not self._lock.acquire(True, timeout):
+                return False
+            waited = time.perf_counter() - start
+            self.contended += 1
+        else:
+            waited = 0.0
+        # Everything below runs while holding the lock, so it needs no further synchronisation
+        self.owner = threading.current_thread().name
+        self.owner_site = site
+        self.acquired_at = time.perf_counter()
+        self.acquisitions += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        site_stats = self.call_sites.get(site)
+        if site_stats is None:
+            with self._stats_lock:
+                site_stats = self.call_sites[site] = [0, 0.0, 0.0, 0.0]
+        site_stats[0] += 1
+        site_stats[3] += waited
+        return True
+
+
+    def release(self):
+        held = time.perf_counter() - self.acquired_at if self.acquired_at else 0.0
+        site_stats = self.call_sites.get(self.owner_site)
+        if site_stats is not None:
+            site_stats[1] += held
+            site_stats[2] = max(site_stats[2], held)
+        self.total_hold += held
+        self.max_hold = max(self.max_hold, held)
+        self.owner = None
+        self.owner_site = None
+        self.acquired_at = None
+        self._lock.release()
+
+
+    def locked(self):
+        return self._lock.locked()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+    def get_stats(self):
+        acquired_at = self.acquired_at
+        with self._stats_lock:
+            call_sites = [(site, list(site_stats)) for site, site_stats in self.call_sites.items()]
+        call_sites = sorted(call_sites, key=lambda entry: entry[1][1], reverse=True)[:TOP_CALL_SITES]
+        return {
+            'name': self.name,
+            'locked': self.locked(),
+            'owner': self.owner,
+            'owner_site': self.owner_site,
+            'held_for_ms': (time.perf_counter() - acquired_at) * 1000 if acquired_at else None,
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'total_wait_ms': self.total_wait * 1000,
+            'max_wait_ms': self.max_wait * 1000,
+            'total_hold_ms': self.total_hold * 1000,
+            'max_hold_ms': self.max_hold * 1000,
+            'top_holders': [{
+                'call_site': site,
+                'acquisitions': count,
+                'total_hold_ms': total_hold * 1000,
+                'max_hold_ms': max_hold * 1000,
+                'total_wait_ms': total_wait * 1000
+            } for site, (count, total_hold, max_hold, total_wait) in call_sites]
+        }
+
+
+def make_lock(name, instrumented):
+    """A plain lock, or a registered InstrumentedLock when `instrumented`."""
+    if not instrumented:
+        return threading.Lock()
+    lock = InstrumentedLock(name)
+    with _locks_registry_lock:
+        _locks.append(lock)
+    return lock
+
+
+def lock_owner(lock):
+    """'thread at call site' of an instrumented lock's holder, None if unknown or free."""
+    owner = getattr(lock, 'owner', None)
+    if owner is None:
+        return None
+    return f"{owner} at {lock.owner_site}"
+
+
+def get_lock_stats():
+    with _locks_registry_lock:
+        locks = list(_locks)
+    return [lock.get_stats() for lock in locks]
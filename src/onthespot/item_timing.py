@@ -0,0 +1,101 @@
+"""
+Per item stage timings.
+
+Download workers wrap the stages of an item, from token and metadata lookup
+through the transfer to conversion, tagging and the move into the library, in
+`span(item, stage)`. The milliseconds spent in each stage are summed in the
+item's `timings`, so retries within one attempt add up, and show in the
+download queue. Completed items feed per service samples for percentile reports
+and a short history of recent completions, both served by /api/stage_timings.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from .otsconfig import config
+
+# Display order, services only record the stages they go through
+STAGES = ('token', 'metadata', 'stream_open', 'transfer', 'decrypt', 'copy', 'lyrics', 'conversion', 'tagging', 'thumbnail', 'move')
+PERCENTILES = (50, 90, 99)
+HISTORY_SIZE = 200
+
+_samples = {}
+_history = deque(maxlen=HISTORY_SIZE)
+_stats_lock = threading.Lock()
+
+
+def reset_timings(item):
+    item['timings'] = {}
+
+
+def record_span(item, stage, seconds):
+    # Replaced rather than updated in place, queue snapshots may share the old dict
+    timings = dict(item.get('timings') or {})
+    timings[stage] = timings.get(stage, 0) + round(seconds * 1000)
+    item['timings'] = timings
+
+
+@contextmanager
+def span(item, stage):
+    """Add the time spent in the block to `stage` of the item, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(item, stage, time.perf_counter() - start)
+
+
+def record_completed(item):
+    """Add a downloaded item's timings to the samples of its service and the history."""
+    timings = item.get('timings')
+    if not timings:
+        return
+    service = item.get('item_service')
+    total = sum(timings.values())
+    with _stats_lock:
+        stages = _samples.setdefault(service, {})
+        for stage, duration in list(timings.items()) + [('total', total)]:
+            samples = stages.get(stage)
+            if samples is None or samples.maxlen != config.get('stage_timing_samples'):
+                samples = stages[stage] = deque(samples or (), maxlen=config.get('stage_timing_samples'))
+            samples.append(duration)
+        _history.append({
+            'local_id': item.get('local_id'),
+            'item_service': service,
+            'item_type': item.get('item_type'),
+            'item_name': item.get('item_name'),
+            'finished_at': time.time(),
+            'total_ms': total,
+            'timings': dict(timings)
+        })
+
+
+def _percentile(ordered, percent):
+    # Nearest rank, exact for the small samples kept here
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[rank - 1]
+
+
+def get_stage_stats(service=None):
+    """`{service: {stage: {count, p50_ms, p90_ms, p99_ms, max_ms}}}` over the latest samples."""
+    with _stats_lock:
+        services = {name: {stage: sorted(samples) for stage, samples in stages.items()}
+                    for name, stages in _samples.items() if service in (None, name)}
+    stats = {}
+    for name, stages in services.items():
+        stats[name] = {}
+        for stage in STAGES + ('total',):
+            ordered = stages.get(stage)
+            if not ordered:
+                continue
+            stage_stats = {'count': len(ordered), 'max_ms': ordered[-1]}
+            for percent in PERCENTILES:
+                stage_stats[f'p{percent}_ms'] = _percentile(ordered, percent)
+            stats[name][stage] = stage_stats
+    return stats
+
+
+def get_recent_timings(service=None, limit=50):
+    with _stats_lock:
+        history = [entry for entry in _history if service in (None, entry['item_service'])]
+    return history[-limit:][::-1]
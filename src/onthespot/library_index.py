@@ -0,0 +1,160 @@
+"""
+Identity index of downloaded tracks.
+
+Every finished track is recorded under its service id and, when known, its
+ISRC. Items that resolve to a recording which is already in the library, or
+which another worker is downloading right now, are satisfied from that file
+instead of being transferred and converted again.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from .otsconfig import cache_dir
+from .runtimedata import get_logger
+
+logger = get_logger("library_index")
+
+# ioctl request number of FICLONE on Linux, clones a file by sharing its extents
+FICLONE = 0x40049409
+
+
+def identity_keys(item, item_metadata):
+    keys = [f"{item['item_service']}:{item['item_id']}"]
+    isrc = item_metadata.get('isrc')
+    if isrc:
+        keys.append(f"isrc:{str(isrc).strip().upper()}")
+    return keys
+
+
+def clone_file(source_path, target_path, allow_hardlink=False):
+    """
+    Materialise `source_path` at `target_path` as cheaply as the filesystem allows.
+    Hardlinks share the inode, so they are only used when the copy is never modified in place.
+    Returns the method used.
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    if allow_hardlink:
+        try:
+            os.link(source_path, target_path)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return 'reflink'
+        except OSError:
+            # Filesystem without copy on write support, fall through to a plain copy
+            pass
+
+    shutil.copyfile(source_path, target_path)
+    return 'copy'
+
+
+class LibraryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        # identity key -> {'owner': local_id, 'followers': [callback, ...]}
+        self.in_flight = {}
+
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as index_file:
+                self.entries = json.load(index_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+
+    def _save(self):
+        # Written next to the target and renamed so a crash never leaves a truncated index
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.library_index.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as index_file:
+                json.dump(self.entries, index_file)
+            os.replace(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def find(self, keys, extension):
+        """Path of an existing library file for any of `keys` with the given extension."""
+        with self.lock:
+            self._load()
+            for key in keys:
+                path = self.entries.get(key)
+                if not path:
+                    continue
+                if not os.path.isfile(path):
+                    # The file was moved or deleted outside of OnTheSpot
+                    del self.entries[key]
+                    continue
+                if os.path.splitext(path)[1].lower() == extension.lower():
+                    return path
+        return None
+
+
+    def record(self, keys, path):
+        with self.lock:
+            self._load()
+            changed = False
+            for key in keys:
+                if self.entries.get(key) != path:
+                    self.entries[key] = path
+                    changed = True
+            if changed:
+                try:
+                    self._save()
+                except OSError as e:
+                    logger.error(f"Failed to save library index: {e}")
+
+
+    def claim(self, keys, local_id, follower):
+        """
+        Claim `keys` for the download of `local_id`.
+        Returns None if the caller owns the download, otherwise the owner's local_id;
+        `follower(path)` is then called once the owner finished, with None if it failed.
+        """
+        with self.lock:
+            for key in keys:
+                claim = self.in_flight.get(key)
+                if claim and claim['owner'] != local_id:
+                    claim['followers'].append(follower)
+                    return claim['owner']
+            claim = {'owner': local_id, 'followers': []}
+            for key in keys:
+                self.in_flight[key] = claim
+            return None
+
+
+    def release(self, keys, path=None):
+        """End the claim on `keys`, recording `path` if the download succeeded. Returns the waiting followers."""
+        # Record before dropping the claim so no other item starts a download in between
+        if path:
+            self.record(keys, path)
+        followers = []
+        with self.lock:
+            for key in keys:
+                claim = self.in_flight.pop(key, None)
+                if claim:
+                    for follower in claim['followers']:
+                        if follower not in followers:
+                            followers.append(follower)
+                    claim['followers'] = []
+        return followers
+
+
+library_index = LibraryIndex(os.path.join(cache_dir(), 'library_index.json'))
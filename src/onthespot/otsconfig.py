@@ -1,9 +1,21 @@
+import atexit
 import json
 import os
+import stat
+import tempfile
+import threading
 import uuid
 from shutil import which
 
 
+# Seconds to coalesce config changes before they are written to disk
+SAVE_DEBOUNCE_SECONDS = 2
+
+# Mode a config file created by open() would get, read once while imports are single threaded
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
 def config_dir():
     if os.path.exists(os.environ.get('ONTHESPOTDIR', '')):
         return os.environ['ONTHESPOTDIR']
@@ -33,6 +45,10 @@ class Config:
         if cfg_path is None or not os.path.isfile(cfg_path):
             cfg_path = os.path.join(config_dir(), "otsconfig.json")
         self.__cfg_path = cfg_path
+        self.__lock = threading.RLock()
+        self.__flush_lock = threading.Lock()
+        self.__flush_timer = None
+        self.__dirty = False
         self.ext_ = ".exe" if os.name == "nt" else ""
         self.session_uuid = str(uuid.uuid4())
         self.__template_data = {
@@ -109,14 +125,18 @@ class Config:
             "check_for_updates": True, # Check for updates
             "illegal_character_replacement": "-", # Character used to replace illegal characters or values in path
             "raw_media_download": False, # Skip media conversion and metadata writing
+            "deduplicate_library": True, # Copy tracks already downloaded under the same ISRC or service id instead of downloading them again
             "rotate_active_account_number": False, # Rotate active account for parsing and downloading tracks
             "download_delay": 3, # Seconds to wait before next download attempt
             "download_chunk_size": 50000, # Chunk size in bytes to download in
+            "download_segments": 1, # Parallel Range requests per large file, 1 downloads over a single connection
+            "segmented_download_min_size_mb": 20, # Only files at least this large are split into segments
             "maximum_queue_workers": 1, # Maximum number of queue workers
             "maximum_download_workers": 2, # Maximum number of download workers
             "enable_retry_worker": False, # Enable retry worker, automatically retries failed downloads after a set time
             "retry_worker_delay": 10, # Amount of time to wait before retrying failed downloads, in minutes
             "download_stall_timeout": 5, # Seconds of no progress before reconnecting and restarting download
+            "spotify_resume_downloads": True, # Resume interrupted Spotify streams after the last complete Ogg page instead of restarting
             "api_retry_max_attempts": 3, # Max retries on API rate limit (429)
             "api_retry_default_delay": 1, # Default delay (seconds) when Retry-After is missing
 
@@ -142,6 +162,7 @@ class Config:
 
             # Audio Download Settings
             "audio_download_path": os.path.join(os.path.expanduser("~"), "Music", "OnTheSpot"), # Root dir for audio downloads
+            "staging_download_path": "", # Local scratch dir for downloading and tagging audio, finished files are moved into the library in the background. Empty disables staging
             "track_file_format": "mp3", # Song track media format
             "track_path_formatter": "Tracks" + os.path.sep + "{album_artist}" + os.path.sep + "[{year}] {album}" + os.path.sep + "{track_number}. {name}", # Track path format string
             "podcast_file_format": "mp3", # Podcast track media format
@@ -149,11 +170,33 @@ class Config:
             "use_playlist_path": False, # Use playlist path
             "playlist_path_formatter": "Playlists" + os.path.sep + "{playlist_name} by {playlist_owner}" + os.path.sep + "{playlist_number}. {name} - {artist}", # Playlist path format string
             "create_m3u_file": False, # Create m3u based playlist
+            "incremental_playlist_sync": False, # Re-queued Spotify playlists only download tracks added since the last sync
+            "priority_weights": {"interactive": 12, "normal": 3, "bulk": 1}, # Share of download workers for single items, albums and bulk imports when all are waiting
+            "user_weights": {}, # Download share of web users relative to each other, users not listed get 1
+            "user_queue_quota": 0, # Max items a web user can have waiting or downloading, the rest stays pending (0 = unlimited)
+            "user_queue_quota_overrides": {}, # Per user exceptions to user_queue_quota
+            "service_max_concurrent_downloads": {"deezer": 3, "youtube_music": 3, "generic": 3}, # Downloads per service at once, services not listed are only bound by the worker count
+            "service_max_concurrent_metadata": {"deezer": 4, "youtube_music": 4, "generic": 4}, # Metadata requests per service at once
+            "pending_high_water": 2000, # Pending items before parsing pauses and further items spill to disk
+            "pending_low_water": 500, # Pending items at which spilled items are reloaded and parsing resumes
+            "download_queue_high_water": 1000, # Unfinished download queue items before pending items are held back
+            "stage_timing_samples": 500, # Completed items per service kept for the stage timing percentiles at /api/stage_timings
+            "instrument_locks": False, # Record wait and hold times of the global locks for /api/locks, applies after a restart
+            "profiler_interval_ms": 10, # Stack sampling interval of the profiler at /api/profiler
+            "profiler_max_seconds": 300, # Profiler sessions stop on their own after this long
+            "recovery_max_requeues": 2, # Times a stalled download is requeued before it is marked as failed
+            "recovery_escalation_seconds": 60, # Time a worker gets to let go of a cancelled stalled download before it is replaced
+            "recovery_max_actions": 10, # Recovery steps within recovery_window_seconds before falling back to a hard restart
+            "recovery_window_seconds": 600,
+            "watchlist": [], # Sources synced on a schedule, managed from the settings page
+            "watchlist_default_interval_minutes": 1440, # Polling interval of newly watched sources
+            "watchlist_min_spacing_seconds": 60, # Minimum time between two watch list runs, spreads API load
             "m3u_path_formatter": "M3U" + os.path.sep + "{playlist_name} by {playlist_owner}", # M3U name format string
             "extinf_separator": "; ", # M3U EXTINF metadata separator
             "extinf_label": "{playlist_number}. {artist} - {name}", # M3U EXTINF path
             "save_album_cover": False, # Save album covers to a file
             "album_cover_format": "png", # Album cover format
+            "cover_cache_size_mb": 200, # Maximum size of the shared cover art cache in MB
             "file_bitrate": "320k", # Converted file bitrate
             "file_hertz": 44100, # Converted file hertz
             "use_custom_file_bitrate": True, # Use bitrate specified by file bitrate
@@ -228,8 +271,7 @@ class Config:
                 fallback_path = os.path.abspath(os.path.join(os.path.expanduser('~'), '.config', 'otsconfig.json'))
                 self.__cfg_path = fallback_path
                 os.makedirs(os.path.dirname(self.__cfg_path), exist_ok=True)
-            with open(self.__cfg_path, "w") as cf:
-                cf.write(json.dumps(self.__template_data, indent=4))
+            self.__write(json.dumps(self.__template_data, indent=4))
             self.__config = self.__template_data
         # Make Download Dirs
         try:
@@ -294,26 +336,108 @@ class Config:
 
 
     def set(self, key, value):
-        if type(value) in [list, dict]:
-            self.__config[key] = value.copy()
-        else:
+        with self.__lock:
+            if type(value) in [list, dict]:
+                self.__config[key] = value.copy()
+            else:
+                self.__config[key] = value
+        return value
+
+
+    def increment(self, key, amount=1):
+        """Add to a numeric value in memory, used for statistics counters."""
+        with self.__lock:
+            value = self.get(key, 0) + amount
             self.__config[key] = value
+            self.__dirty = True
         return value
 
 
+    def as_dict(self):
+        """A copy of the config as it would be written to disk, for rendering pages without reading the file."""
+        with self.__lock:
+            data = {key: value for key, value in self.__template_data.items() if not key.startswith('_')}
+            data.update(self.__config)
+        return data
+
+
     def save(self):
-        os.makedirs(os.path.dirname(self.__cfg_path), exist_ok=True)
-        for key in list(set(self.__template_data).difference(set(self.__config))):
-            if not key.startswith('_'):
-                self.set(key, self.__template_data[key])
-        with open(self.__cfg_path, "w") as cf:
-            cf.write(json.dumps(self.__config, indent=4))
+        """
+        Schedule a write of the config to disk.
+
+        Changes are coalesced and flushed by a background timer so callers on
+        the download path never block on file I/O. Use flush() when the
+        change has to be on disk before continuing.
+        """
+        with self.__lock:
+            self.__dirty = True
+            if self.__flush_timer is None:
+                self.__flush_timer = threading.Timer(SAVE_DEBOUNCE_SECONDS, self.__background_flush)
+                self.__flush_timer.daemon = True
+                self.__flush_timer.start()
+
+
+    def flush(self):
+        """Write pending config changes to disk immediately."""
+        with self.__flush_lock:
+            with self.__lock:
+                if self.__flush_timer is not None:
+                    self.__flush_timer.cancel()
+                    self.__flush_timer = None
+                if not self.__dirty:
+                    return
+                for key in list(set(self.__template_data).difference(set(self.__config))):
+                    if not key.startswith('_'):
+                        self.__config[key] = self.__template_data[key]
+                data = json.dumps(self.__config, indent=4)
+                self.__dirty = False
+            try:
+                self.__write(data)
+            except OSError:
+                with self.__lock:
+                    self.__dirty = True
+                raise
+
+
+    def __background_flush(self):
+        try:
+            self.flush()
+        except OSError as e:
+            print(f'Failed to save config to "{self.__cfg_path}": {e}')
+
+
+    def __write(self, data):
+        # Write to a temp file in the same directory and rename it over the
+        # config so a crash can never leave a truncated file behind
+        cfg_dir = os.path.dirname(self.__cfg_path)
+        os.makedirs(cfg_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.otsconfig-', suffix='.tmp', dir=cfg_dir)
+        try:
+            # mkstemp creates the file as 0600, keep the mode of the config it replaces
+            try:
+                mode = stat.S_IMODE(os.stat(self.__cfg_path).st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            os.chmod(tmp_path, mode)
+            with os.fdopen(fd, "w") as cf:
+                cf.write(data)
+                cf.flush()
+                os.fsync(cf.fileno())
+            os.replace(tmp_path, self.__cfg_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
 
 
     def reset(self):
-        with open(self.__cfg_path, "w") as cf:
-            cf.write(json.dumps(self.__template_data, indent=4))
-        self.__config = self.__template_data
+        with self.__flush_lock:
+            with self.__lock:
+                self.__write(json.dumps(self.__template_data, indent=4))
+                self.__config = self.__template_data
+                self.__dirty = False
 
 
     def migration(self):
@@ -393,3 +517,4 @@ class Config:
 
 
 config = Config()
+atexit.register(config.flush)
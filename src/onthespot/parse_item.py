@@ -2,20 +2,14 @@ import re
 import time
 import traceback
 from .accounts import get_account_token
-from .api.apple_music import apple_music_get_album_track_ids, apple_music_get_artist_album_ids, apple_music_get_playlist_data
-from .api.bandcamp import bandcamp_get_album_track_ids, bandcamp_get_artist_album_ids
-from .api.deezer import deezer_parse_url, deezer_get_album_track_ids, deezer_get_artist_album_ids, deezer_get_playlist_data
-from .api.qobuz import qobuz_get_album_track_ids, qobuz_get_artist_album_ids, qobuz_get_label_album_ids, qobuz_get_playlist_data
-from .api.soundcloud import soundcloud_parse_url,  soundcloud_get_artist_album_ids, soundcloud_get_album_track_ids, soundcloud_get_playlist_data
-from .api.spotify import spotify_get_album_track_ids, spotify_get_artist_album_ids, spotify_get_playlist_items, spotify_get_playlist_data, spotify_get_liked_songs, spotify_get_your_episodes, spotify_get_podcast_episode_ids
-from .api.tidal import tidal_get_album_track_ids, tidal_get_artist_album_ids, tidal_get_playlist_data, tidal_get_mix_data
-from .api.youtube_music import youtube_music_get_channel_track_ids, youtube_music_get_playlist_data
-from .api.generic import generic_get_track_metadata
-from .api.crunchyroll import crunchyroll_get_show_episode_ids
-from .runtimedata import account_pool, get_logger, parsing, download_queue, pending, parsing_lock, pending_lock
+from .backpressure import add_pending, expansion_paused, refill_pending
+from .services import get_service_function
+from .runtimedata import account_pool, get_logger, parsing, download_queue, parsing_lock
 import onthespot.runtimedata as runtimedata
+from . import playlist_sync
 from .utils import format_local_id
 from .otsconfig import config
+from .scheduler import INTERACTIVE_CATEGORIES
 
 logger = get_logger('parse_item')
 # Audio
@@ -32,7 +26,11 @@ YOUTUBE_MUSIC_URL_REGEX = re.compile(r"https?://music.youtube.com/(watch\?v=(?P<
 #YOUTUBE_URL_REGEX = re.compile(r"https?://(www.|music.)?youtube.com/(watch\?v=(?P<video_id>[a-zA-Z0-9_-]+)|channel/(?P<channel_id>[a-zA-Z0-9_-]+)|playlist\?list=(?P<playlist_id>[a-zA-Z0-9_-]+))")
 CRUNCHYROLL_URL_REGEX = re.compile(r"https?://(www.)?crunchyroll.com/(?P<type>watch|series)/(musicvideo/)?(?P<id>[-A-Z0-9]+)/(?P<title>[-a-z0-9]+)")
 
-def parse_url(url):
+def identify_url(url):
+    """
+    Return `(item_service, item_type, item_id)` for `url`. Links that are handed off
+    elsewhere return True, unsupported links return False.
+    """
     # Audio
     if re.match(APPLE_MUSIC_URL_REGEX, url):
         match = re.search(APPLE_MUSIC_URL_REGEX, url)
@@ -59,7 +57,7 @@ def parse_url(url):
         item_service = 'deezer'
 
     elif re.match(DEEZER_SHARE_URL_REGEX, url):
-        deezer_parse_url(url)
+        get_service_function('deezer', 'parse_url')(url)
         return True
 
     elif re.match(QOBUZ_URL_REGEX, url):
@@ -72,7 +70,7 @@ def parse_url(url):
 
     elif re.match(SOUNDCLOUD_URL_REGEX, url):
         token = get_account_token('soundcloud')
-        item_type, item_id = soundcloud_parse_url(url, token)
+        item_type, item_id = get_service_function('soundcloud', 'parse_url')(url, token)
         item_service = "soundcloud"
 
     elif re.match(SPOTIFY_URL_REGEX, url):
@@ -138,7 +136,7 @@ def parse_url(url):
             if generic_enabled:
                 logger.info(f'Unable to parse url falling back to yt-dlp: {url}')
                 # Check if yt-dlp can parse track
-                item_metadata = generic_get_track_metadata('', url)
+                item_metadata = get_service_function('generic', 'get_track_metadata')('', url)
                 # Returns false if playlist, currently not supported
                 if item_metadata:
                     item_service = 'generic'
@@ -152,20 +150,90 @@ def parse_url(url):
         except Exception as e:
             logger.info(f'Error Possibly Invalid Url: {url}, "{e}"')
             return False
+    return item_service, item_type, item_id
+
+
+def parse_url(url, user=None):
+    """Queue `url` for parsing, `user` is the web user that submitted it."""
+    parsed = identify_url(url)
+    if isinstance(parsed, bool):
+        return parsed
+    item_service, item_type, item_id = parsed
     with parsing_lock:
         parsing[item_id] = {
             'item_url': url,
             'item_service': item_service,
             'item_type': item_type,
-            'item_id': item_id
+            'item_id': item_id,
+            'user': user
         }
 
 
+def sync_spotify_playlist(token, playlist_id, user=None, priority=None):
+    """
+    Queue only the tracks of a Spotify playlist that are not in the library since the last sync.
+    Returns the playlist info with the number of `queued` and `total` tracks, or None if the snapshot could not be fetched.
+    """
+    playlist_info = get_service_function('spotify', 'get_playlist_snapshot')(token, playlist_id)
+    if not playlist_info or not playlist_info.get('snapshot_id'):
+        return None
+
+    key = playlist_sync.sync_key('spotify', playlist_id)
+    if playlist_info['snapshot_id'] == playlist_sync.get_snapshot_id(key):
+        logger.info(f"Playlist '{playlist_info['name']}' unchanged since the last sync")
+        tracks = None
+    else:
+        items = get_service_function('spotify', 'get_playlist_items')(token, playlist_id)
+        tracks = [[item['track']['id'], item['track']['type']] for item in items if item.get('track') and item['track'].get('id')]
+
+    missing, changed, total_items = playlist_sync.update(key, playlist_info, tracks)
+    for index, item_id, item_type in missing:
+        local_id = format_local_id(item_id)
+        add_pending(local_id, {
+            'local_id': local_id,
+            'item_service': 'spotify',
+            'item_type': item_type,
+            'item_id': item_id,
+            'user': user,
+            'parent_category': 'playlist',
+            'playlist_name': playlist_info['name'],
+            'playlist_by': playlist_info['owner'],
+            'playlist_number': str(index + 1),
+            'playlist_total': total_items,
+            'playlist_image_url': playlist_info['image_url'],
+            'playlist_sync_key': key,
+            'priority': priority
+        })
+    logger.info(f"Synced playlist '{playlist_info['name']}': {len(missing)} of {total_items} tracks queued")
+    playlist_info['queued'] = len(missing)
+    playlist_info['total'] = total_items
+
+    # With nothing queued no download will complete the playlist, reflect reorders and removals now
+    if changed and not missing:
+        playlist_sync.write_m3u(key)
+    return playlist_info
+
+
+def _next_parsing_id():
+    # While pending is over its high water mark only single items are expanded, they add one item each
+    if not expansion_paused():
+        return next(iter(parsing))
+    with parsing_lock:
+        for item_id, item in parsing.items():
+            if item['item_type'] in INTERACTIVE_CATEGORIES:
+                return item_id
+    return None
+
+
 def parsingworker():
     while True:
+        refill_pending()
         if parsing:
             try:
-                item_id = next(iter(parsing))
+                item_id = _next_parsing_id()
+                if item_id is None:
+                    time.sleep(0.2)
+                    continue
                 with parsing_lock:
                     item = parsing.pop(item_id)
                 logger.info(f"Parsing: {item}")
@@ -174,6 +242,7 @@ def parsingworker():
                 current_type = item['item_type']
                 current_id = item['item_id']
                 current_url = item['item_url']
+                current_user = item.get('user')
                 token = get_account_token(current_service)
 
                 # Check if token is valid
@@ -192,39 +261,44 @@ def parsingworker():
                         
                         try:
                             logger.info(f"Starting to parse playlist: {current_id}")
-                            items = spotify_get_playlist_items(token, current_id)
-                            playlist_name, playlist_by, playlist_image_url = spotify_get_playlist_data(token, current_id)
-                            total_items = len(items)
-                            logger.info(f"Playlist '{playlist_name}' has {total_items} items, adding to pending queue...")
+                            playlist_info = None
+                            if config.get('incremental_playlist_sync'):
+                                playlist_info = sync_spotify_playlist(token, current_id, current_user)
+                            if playlist_info:
+                                playlist_name, playlist_by, playlist_image_url = playlist_info['name'], playlist_info['owner'], playlist_info['image_url']
+                            else:
+                                items = get_service_function('spotify', 'get_playlist_items')(token, current_id)
+                                playlist_name, playlist_by, playlist_image_url = get_service_function('spotify', 'get_playlist_data')(token, current_id)
+                                total_items = len(items)
+                                logger.info(f"Playlist '{playlist_name}' has {total_items} items, adding to pending queue...")
                             
-                            for index, item in enumerate(items):
-                                try:
-                                    item_id = item['track']['id']
-                                    item_type = item['track']['type']
-                                    local_id = format_local_id(item_id)
-                                    with pending_lock:
-                                        pending[local_id] = {
+                                for index, item in enumerate(items):
+                                    try:
+                                        item_id = item['track']['id']
+                                        item_type = item['track']['type']
+                                        local_id = format_local_id(item_id)
+                                        add_pending(local_id, {
                                             'local_id': local_id,
                                             'item_service': 'spotify',
                                             'item_type': item_type,
                                             'item_id': item_id,
+                                            'user': current_user,
                                             'parent_category': 'playlist',
                                             'playlist_name': playlist_name,
                                             'playlist_by': playlist_by,
                                             'playlist_number': str(index + 1),
                                             'playlist_total': total_items,
                                             'playlist_image_url': playlist_image_url
-                                            }
-                                except TypeError:
-                                    logger.error(f'TypeError for {item}')
-                            logger.info(f"Finished adding {total_items} items from playlist '{playlist_name}' to pending queue")
+                                        })
+                                    except TypeError:
+                                        logger.error(f'TypeError for {item}')
+                                logger.info(f"Finished adding {total_items} items from playlist '{playlist_name}' to pending queue")
                             
                             # Download playlist cover after adding all items
                             if playlist_image_url and config.get('save_album_cover'):
-                                import requests
-                                from PIL import Image
-                                from io import BytesIO
                                 import os
+                                import shutil
+                                from .cover_cache import get_cover_path
                                 from .utils import sanitize_data
                                 
                                 try:
@@ -247,10 +321,7 @@ def parsingworker():
                                     
                                     cover_path = os.path.join(full_playlist_dir, 'cover.jpg')
                                     logger.info(f"Downloading playlist cover for '{playlist_name}' to: {cover_path}")
-                                    img = Image.open(BytesIO(requests.get(playlist_image_url).content))
-                                    if img.mode != 'RGB':
-                                        img = img.convert('RGB')
-                                    img.save(cover_path, format='JPEG')
+                                    shutil.copyfile(get_cover_path(playlist_image_url, 'jpg'), cover_path)
                                     logger.info(f"Saved playlist cover: {cover_path}")
                                 except Exception as e:
                                     logger.error(f"Failed to save playlist cover: {e}")
@@ -265,24 +336,24 @@ def parsingworker():
                         
                         try:
                             logger.info("Starting to parse liked_songs")
-                            tracks = spotify_get_liked_songs(token)
+                            tracks = get_service_function('spotify', 'get_liked_songs')(token)
                             total_tracks = len(tracks)
                             logger.info(f"Liked Songs has {total_tracks} items, adding to pending queue...")
                             for index, track in enumerate(tracks):
                                 item_id = track['track']['id']
                                 local_id = format_local_id(item_id)
-                                with pending_lock:
-                                    pending[local_id] = {
-                                        'local_id': local_id,
-                                        'item_service': 'spotify',
-                                        'item_type': 'track',
-                                        'item_id': item_id,
-                                        'parent_category': 'playlist',
-                                        'playlist_name': 'Liked Songs',
-                                        'playlist_by': 'me',
-                                        'playlist_number': str(index + 1),
-                                        'playlist_total': total_tracks
-                                        }
+                                add_pending(local_id, {
+                                    'local_id': local_id,
+                                    'item_service': 'spotify',
+                                    'item_type': 'track',
+                                    'item_id': item_id,
+                                    'user': current_user,
+                                    'parent_category': 'playlist',
+                                    'playlist_name': 'Liked Songs',
+                                    'playlist_by': 'me',
+                                    'playlist_number': str(index + 1),
+                                    'playlist_total': total_tracks
+                                })
                             logger.info(f"Finished adding {total_tracks} items from Liked Songs to pending queue")
                         finally:
                             # Always clear batch parse flag
@@ -295,25 +366,25 @@ def parsingworker():
                         
                         try:
                             logger.info("Starting to parse your_episodes")
-                            tracks = spotify_get_your_episodes(token)
+                            tracks = get_service_function('spotify', 'get_your_episodes')(token)
                             total_tracks = len(tracks)
                             logger.info(f"Your Episodes has {total_tracks} items, adding to pending queue...")
                             for index, track in enumerate(tracks):
                                 item_id = track['episode']['id']
                                 if item_id:
                                     local_id = format_local_id(item_id)
-                                    with pending_lock:
-                                        pending[local_id] = {
-                                            'local_id': local_id,
-                                            'item_service': 'spotify',
-                                            'item_type': 'podcast_episode',
-                                            'item_id': item_id,
-                                            'parent_category': 'playlist',
-                                            'playlist_name': 'Your Episodes',
-                                            'playlist_by': 'me',
-                                            'playlist_number': str(index + 1),
-                                            'playlist_total': total_tracks
-                                            }
+                                    add_pending(local_id, {
+                                        'local_id': local_id,
+                                        'item_service': 'spotify',
+                                        'item_type': 'podcast_episode',
+                                        'item_id': item_id,
+                                        'user': current_user,
+                                        'parent_category': 'playlist',
+                                        'playlist_name': 'Your Episodes',
+                                        'playlist_by': 'me',
+                                        'playlist_number': str(index + 1),
+                                        'playlist_total': total_tracks
+                                    })
                             logger.info(f"Finished adding {total_tracks} items from Your Episodes to pending queue")
                         finally:
                             # Always clear batch parse flag
@@ -327,19 +398,19 @@ def parsingworker():
                     
                     try:
                         logger.info(f"Starting to parse artist: {current_id}")
-                        track_ids = youtube_get_channel_track_ids(token, current_id)
+                        track_ids = get_service_function('youtube_music', 'get_channel_track_ids')(token, current_id)
                         total_items = len(track_ids)
                         logger.info(f"Artist has {total_items} items, adding to pending queue...")
                         for track_id in track_ids:
                             local_id = format_local_id(track_id)
-                            with pending_lock:
-                                pending[local_id] = {
-                                    'local_id': local_id,
-                                    'item_service': current_service,
-                                    'item_type': 'track',
-                                    'item_id': track_id,
-                                    'parent_category': 'album'
-                                    }
+                            add_pending(local_id, {
+                                'local_id': local_id,
+                                'item_service': current_service,
+                                'item_type': 'track',
+                                'item_id': track_id,
+                                'user': current_user,
+                                'parent_category': 'album'
+                            })
                         logger.info(f"Finished adding {total_items} items from artist to pending queue")
                     finally:
                         # Always clear batch parse flag
@@ -357,18 +428,19 @@ def parsingworker():
                     playlist_number = item.get('playlist_number')
                     playlist_total = item.get('playlist_total')
                     
-                    with pending_lock:
-                        pending[local_id] = {
-                            'local_id': local_id,
-                            'item_service': current_service,
-                            'item_type': current_type,
-                            'item_id': item_id,
-                            'parent_category': parent_category,
-                            'playlist_name': playlist_name,
-                            'playlist_by': playlist_by,
-                            'playlist_number': playlist_number,
-                            'playlist_total': playlist_total
-                            }
+                    add_pending(local_id, {
+                        'local_id': local_id,
+                        'item_service': current_service,
+                        'item_type': current_type,
+                        'item_id': item_id,
+                        'user': current_user,
+                        'parent_category': parent_category,
+                        'playlist_name': playlist_name,
+                        'playlist_by': playlist_by,
+                        'playlist_number': playlist_number,
+                        'playlist_total': playlist_total,
+                        'priority': item.get('priority')
+                    })
                     continue
 
                 elif current_type in ["podcast", "audiobook"]:
@@ -377,19 +449,19 @@ def parsingworker():
                     
                     try:
                         logger.info(f"Starting to parse {current_type}: {current_id}")
-                        item_ids = globals()[f"{current_service}_get_{current_type}_episode_ids"](token, current_id)
+                        item_ids = get_service_function(current_service, f"get_{current_type}_episode_ids")(token, current_id)
                         total_items = len(item_ids)
                         logger.info(f"{current_type} has {total_items} items, adding to pending queue...")
                         for item_id in item_ids:
                             local_id = format_local_id(item_id)
-                            with pending_lock:
-                                pending[local_id] = {
-                                    'local_id': local_id,
-                                    'item_service': current_service,
-                                    'item_type': 'podcast_episode',
-                                    'item_id': item_id,
-                                    'parent_category': current_type
-                                    }
+                            add_pending(local_id, {
+                                'local_id': local_id,
+                                'item_service': current_service,
+                                'item_type': 'podcast_episode',
+                                'item_id': item_id,
+                                'user': current_user,
+                                'parent_category': current_type
+                            })
                         logger.info(f"Finished adding {total_items} items from {current_type} to pending queue")
                     finally:
                         # Always clear batch parse flag
@@ -406,10 +478,10 @@ def parsingworker():
                         playlist_by = ''
                         if current_type == "album":
                             logger.info(f"Starting to parse album: {current_id}")
-                            track_ids = globals()[f"{current_service}_get_{current_type}_track_ids"](token, current_id)
+                            track_ids = get_service_function(current_service, f"get_{current_type}_track_ids")(token, current_id)
                         else:
                             logger.info(f"Starting to parse {current_type}: {current_id}")
-                            playlist_name, playlist_by, track_ids = globals()[f"{current_service}_get_{current_type}_data"](token, current_id)
+                            playlist_name, playlist_by, track_ids = get_service_function(current_service, f"get_{current_type}_data")(token, current_id)
                         if current_type == 'mix':
                             current_type = 'playlist'
                         if current_service == 'youtube' and not playlist_by:
@@ -419,19 +491,20 @@ def parsingworker():
                         logger.info(f"{current_type} has {total_items} items, adding to pending queue...")
                         for index, track_id in enumerate(track_ids):
                             local_id = format_local_id(track_id)
-                            with pending_lock:
-                                pending[local_id] = {
-                                    'local_id': local_id,
-                                    'item_service': current_service,
-                                    'item_type': 'track',
-                                    'item_id': track_id,
-                                    'parent_category': current_type,
-                                    'parent_id': current_id if current_type == 'album' else '',  # Store album_id for locking
-                                    'playlist_name': playlist_name,
-                                    'playlist_by': playlist_by,
-                                    'playlist_number': str(index + 1),
-                                    'playlist_total': total_items
-                                    }
+                            add_pending(local_id, {
+                                'local_id': local_id,
+                                'item_service': current_service,
+                                'item_type': 'track',
+                                'item_id': track_id,
+                                'user': current_user,
+                                'parent_category': current_type,
+                                'parent_id': current_id if current_type == 'album' else '',  # Album the track was queued from
+                                'playlist_name': playlist_name,
+                                'playlist_by': playlist_by,
+                                'playlist_number': str(index + 1),
+                                'playlist_total': total_items,
+                                'priority': item.get('priority')
+                            })
                         logger.info(f"Finished adding {total_items} items from {current_type} to pending queue")
                     finally:
                         # Always clear batch parse flag
@@ -440,7 +513,7 @@ def parsingworker():
                     continue
 
                 elif current_type in ["artist", "label"]:
-                    item_ids = globals()[f"{current_service}_get_{current_type}_album_ids"](token, current_id)
+                    item_ids = get_service_function(current_service, f"get_{current_type}_album_ids")(token, current_id)
                     for item_id in item_ids:
                         local_id = format_local_id(item_id)
                         with parsing_lock:
@@ -448,21 +521,24 @@ def parsingworker():
                                 'item_url': '',
                                 'item_service': current_service,
                                 'item_type': 'album',
-                                'item_id': item_id
+                                'item_id': item_id,
+                                'user': current_user,
+                                # Albums of a discography are a bulk import
+                                'priority': 'bulk'
                             }
 
                 elif current_type in ['show', 'season']:
-                    item_ids = globals()[f"{current_service}_get_{current_type}_episode_ids"](token, current_id)
+                    item_ids = get_service_function(current_service, f"get_{current_type}_episode_ids")(token, current_id)
                     for item_id in item_ids:
                         local_id = format_local_id(item_id)
-                        with pending_lock:
-                            pending[local_id] = {
-                                'local_id': local_id,
-                                'item_service': current_service,
-                                'item_type': 'episode',
-                                'item_id': item_id,
-                                'parent_category': current_type
-                                }
+                        add_pending(local_id, {
+                            'local_id': local_id,
+                            'item_service': current_service,
+                            'item_type': 'episode',
+                            'item_id': item_id,
+                            'user': current_user,
+                            'parent_category': current_type
+                        })
                     continue
             except Exception as e:
                 logger.error(f"Unknown Exception: {str(e)}\nTraceback: {traceback.format_exc()}")
@@ -0,0 +1,167 @@
+"""
+Incremental playlist sync.
+
+For every synced playlist the last seen snapshot id, the ordered track list
+and the M3U entries of the tracks that finished are kept in the cache
+directory. Re-queuing a playlist whose snapshot did not change only costs the
+request that fetched the snapshot id; otherwise the new track list is diffed
+against the stored one and only tracks without a file in the library are
+queued again. The M3U is rewritten from the stored entries, so it follows
+reorders and removals without touching tracks that are already in place.
+
+Finished tracks are appended to a per playlist entries log instead of rewriting
+the state, which is folded back into the state by `update()` and `write_m3u()`.
+"""
+import json
+import os
+import tempfile
+import threading
+from .otsconfig import cache_dir, config
+from .runtimedata import get_logger
+from .utils import build_playlist_entry, write_playlist_m3u
+
+logger = get_logger("playlist_sync")
+
+# One lock per playlist, so syncing one playlist never waits on another
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+def _key_lock(key):
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def sync_key(service, playlist_id):
+    return f"{service}:{playlist_id}"
+
+
+def _state_path(key):
+    return os.path.join(cache_dir(), 'playlist_sync', key.replace(':', '_') + '.json')
+
+
+def _entries_log_path(key):
+    return _state_path(key)[:-len('.json')] + '.entries.jsonl'
+
+
+def _load_state(key):
+    try:
+        with open(_state_path(key), 'r', encoding='utf-8') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    try:
+        with open(_entries_log_path(key), 'r', encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    item_id, entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                state['entries'][item_id] = entry
+    except OSError:
+        pass
+    return state
+
+
+def _save_state(key, state):
+    # Written next to the target and renamed so a crash never leaves a truncated state
+    path = _state_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.sync.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _compact(key, state):
+    # The state now holds every logged entry, so the log can start over
+    _save_state(key, state)
+    try:
+        os.remove(_entries_log_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def get_snapshot_id(key):
+    state = _load_state(key)
+    return state.get('snapshot_id') if state else None
+
+
+def update(key, playlist_info, tracks=None):
+    """
+    Store the playlist as of `playlist_info['snapshot_id']` and return the tracks still to download.
+
+    `tracks` is the current ordered list of `[item_id, item_type]`, or None when the snapshot
+    is unchanged and the stored list still applies. Returns `(missing, changed, total)`: the
+    `(index, item_id, item_type)` of tracks without a file in the library, whether the
+    order or membership of the playlist changed since the last sync, and the track count.
+    """
+    with _key_lock(key):
+        state = _load_state(key) or {'tracks': [], 'entries': {}}
+        changed = False
+        if tracks is not None:
+            tracks = [list(track) for track in tracks]
+            current_ids = {item_id for item_id, _ in tracks}
+            previous_ids = {item_id for item_id, _ in state['tracks']}
+            changed = tracks != state['tracks']
+            logger.info(
+                f"Playlist '{playlist_info['name']}' changed: {len(current_ids - previous_ids)} added, "
+                f"{len(previous_ids - current_ids)} removed, {len(tracks)} tracks"
+            )
+            state['tracks'] = tracks
+            state['entries'] = {item_id: entry for item_id, entry in state['entries'].items() if item_id in current_ids}
+
+        state.update({
+            'snapshot_id': playlist_info['snapshot_id'],
+            'name': playlist_info['name'],
+            'owner': playlist_info['owner'],
+            'image_url': playlist_info.get('image_url', '')
+        })
+        _compact(key, state)
+
+        missing = []
+        seen = set()
+        for index, (item_id, item_type) in enumerate(state['tracks']):
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            entry = state['entries'].get(item_id)
+            if not entry or not os.path.isfile(entry['file_path']):
+                missing.append((index, item_id, item_type))
+    return missing, changed, len(state['tracks'])
+
+
+def record_track(item, item_metadata):
+    """Remember the file of a finished track of a synced playlist."""
+    key = item['playlist_sync_key']
+    line = json.dumps([item['item_id'], build_playlist_entry(item, item_metadata)])
+    with _key_lock(key):
+        if not os.path.isfile(_state_path(key)):
+            return
+        with open(_entries_log_path(key), 'a', encoding='utf-8') as log_file:
+            log_file.write(line + '\n')
+
+
+def write_m3u(key):
+    """Rewrite the M3U of a synced playlist in its current order from the recorded entries."""
+    with _key_lock(key):
+        state = _load_state(key)
+        if state and os.path.exists(_entries_log_path(key)):
+            _compact(key, state)
+    if not state or not config.get('create_m3u_file'):
+        return None
+
+    item_entries = []
+    for index, (item_id, _) in enumerate(state['tracks']):
+        entry = state['entries'].get(item_id)
+        if entry:
+            item_entries.append(dict(entry, playlist_number=str(index + 1)))
+    if not item_entries:
+        return None
+    return write_playlist_m3u(state['name'], state['owner'], item_entries)
@@ -0,0 +1,205 @@
+"""
+Live diagnosis of a running instance, driven from the admin endpoints under /api/profiler.
+
+`SamplingProfiler` samples the stacks of all threads via `sys._current_frames()`
+at a fixed interval and counts them in the collapsed format flame graph tools
+read (`thread;outer;...;inner count`). It runs for at most
+`profiler_max_seconds` so a forgotten session cannot keep costing time.
+Memory tracing starts tracemalloc with a baseline snapshot, diffs against it on
+request and stops it again, since tracemalloc slows down every allocation.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import linecache
+from .otsconfig import config
+from .runtimedata import get_logger
+
+logger = get_logger("profiler")
+
+_MEMORY_FILTERS = (
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+)
+
+_profiler = None
+_profiler_lock = threading.Lock()
+_memory_baseline = None
+_memory_lock = threading.Lock()
+
+
+class SamplingProfiler(threading.Thread):
+    def __init__(self, interval, duration, include_lines=False):
+        super().__init__(name='SamplingProfiler', daemon=True)
+        self.interval = interval
+        self.duration = duration
+        self.include_lines = include_lines
+        self.stacks = {}
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.is_running = True
+
+
+    def _frame_label(self, frame, leaf):
+        code = frame.f_code
+        label = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        if leaf or self.include_lines:
+            label += f":{frame.f_lineno}"
+        return label
+
+
+    def _collapse(self, thread_name, frame):
+        labels = [self._frame_label(frame, True)]
+        frame = frame.f_back
+        while frame is not None:
+            labels.append(self._frame_label(frame, False))
+            frame = frame.f_back
+        labels.append(thread_name.replace(';', ':').replace(' ', '_'))
+        return ';'.join(reversed(labels))
+
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while self.is_running and time.monotonic() < deadline:
+            start = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = self._collapse(names.get(thread_id, str(thread_id)), frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            del frame
+            self.samples += 1
+            self.sampling_time += time.perf_counter() - start
+            time.sleep(self.interval)
+        self.is_running = False
+        self.stopped_at = time.time()
+        logger.info(f"Sampling profiler stopped after {self.samples} samples")
+
+
+    def stop(self):
+        self.is_running = False
+        self.join(timeout=5)
+
+
+    def get_status(self):
+        elapsed = (self.stopped_at or time.time()) - self.started_at
+        return {
+            'running': self.is_running,
+            'interval_ms': self.interval * 1000,
+            'max_seconds': self.duration,
+            'started_at': self.started_at,
+            'stopped_at': self.stopped_at,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            # Share of wall time the sampler itself spent walking stacks
+            'overhead': self.sampling_time / elapsed if elapsed > 0 else 0.0
+        }
+
+
+def start_profiler(interval_ms=None, max_seconds=None, include_lines=False):
+    """Start a new sampling session, dropping the stacks of the previous one."""
+    global _profiler
+    interval_ms = interval_ms or config.get('profiler_interval_ms')
+    max_seconds = min(max_seconds or config.get('profiler_max_seconds'), config.get('profiler_max_seconds'))
+    if interval_ms < 1:
+        raise ValueError("interval_ms must be at least 1")
+    with _profiler_lock:
+        if _profiler is not None and _profiler.is_running:
+            raise ValueError("Profiler is already running")
+        _profiler = SamplingProfiler(interval_ms / 1000, max_seconds, include_lines)
+        _profiler.start()
+    logger.info(f"Sampling profiler started, every {interval_ms} ms for at most {max_seconds} s")
+    return _profiler.get_status()
+
+
+def stop_profiler():
+    with _profiler_lock:
+        profiler = _profiler
+    if profiler is None:
+        return None
+    if profiler.is_running:
+        profiler.stop()
+    return profiler.get_status()
+
+
+def get_profiler_status():
+    with _profiler_lock:
+        profiler = _profiler
+    return profiler.get_status() if profiler is not None else None
+
+
+def collapsed_stacks():
+    """Stacks of the current or last session as `frames count` lines, heaviest first."""
+    with _profiler_lock:
+        profiler = _profiler
+    if profiler is None:
+        return ''
+    stacks = dict(profiler.stacks)
+    lines = [f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda entry: entry[1], reverse=True)]
+    return '\n'.join(lines) + ('\n' if lines else '')
+
+
+def start_memory_tracing(frames=1):
+    """Start tracemalloc and take the baseline later diffs are compared to."""
+    global _memory_baseline
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        _memory_baseline = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+    logger.info(f"Memory tracing started with {tracemalloc.get_tracemalloc_memory() / 1024:.1f} KiB of tracemalloc overhead")
+    return get_memory_status()
+
+
+def memory_diff(limit=10, rebase=False):
+    """Top `limit` allocation changes by line since the baseline, optionally making now the new baseline."""
+    global _memory_baseline
+    with _memory_lock:
+        if _memory_baseline is None or not tracemalloc.is_tracing():
+            raise ValueError("Memory tracing is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+        stats = snapshot.compare_to(_memory_baseline, 'lineno')
+        if rebase:
+            _memory_baseline = snapshot
+    top = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        top.append({
+            'file': frame.filename,
+            'line': frame.lineno,
+            'code': linecache.getline(frame.filename, frame.lineno).strip(),
+            'size_kib': stat.size / 1024,
+            'size_diff_kib': stat.size_diff / 1024,
+            'count': stat.count,
+            'count_diff': stat.count_diff
+        })
+    return {
+        'top': top,
+        'total_diff_kib': sum(stat.size_diff for stat in stats) / 1024,
+        **get_memory_status()
+    }
+
+
+def stop_memory_tracing():
+    global _memory_baseline
+    with _memory_lock:
+        _memory_baseline = None
+        tracemalloc.stop()
+    logger.info("Memory tracing stopped")
+    return get_memory_status()
+
+
+def get_memory_status():
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+    return {
+        'tracing': tracing,
+        'traced_kib': current / 1024,
+        'peak_kib': peak / 1024
+    }
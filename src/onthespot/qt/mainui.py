@@ -19,8 +19,10 @@ from ..api.tidal import tidal_add_account_pt1, tidal_add_account_pt2, tidal_get_
 from ..api.youtube_music import youtube_music_add_account, youtube_music_get_track_metadata
 from ..api.generic import generic_add_account, generic_get_track_metadata, generic_list_extractors
 from ..api.crunchyroll import crunchyroll_add_account, crunchyroll_get_episode_metadata
+from ..backpressure import spill_store
 from ..downloader import DownloadWorker, RetryWorker
 from ..otsconfig import config, cache_dir
+from ..queue_item import QueueItem, as_queue_item
 from ..runtimedata import account_pool, download_queue, download_queue_lock, get_init_tray, parsing, parsing_lock, pending, pending_lock, get_logger, temp_download_path, register_worker, kill_all_workers, set_worker_restart_callback
 from .dl_progressbtn import DownloadActionsButtons
 from .settings import load_config, save_config
@@ -63,7 +65,7 @@ class QueueWorker(QObject):
                 except Exception as e:
                     logger.error(f"Unknown Exception for {item}: {str(e)}\nTraceback: {traceback.format_exc()}")
                     with pending_lock:
-                        pending[local_id] = item
+                        pending[local_id] = as_queue_item(item)
             else:
                 time.sleep(0.2)
 
@@ -561,7 +563,7 @@ class MainWindow(QMainWindow):
         self.update_table_visibility()
 
         with download_queue_lock:
-            download_queue[item['local_id']] = {
+            download_queue[item['local_id']] = QueueItem({
                 'local_id': item['local_id'],
                 'available': True,
                 "item_service": item["item_service"],
@@ -588,7 +590,7 @@ class MainWindow(QMainWindow):
                         "delete": delete_btn
                         }
                     }
-                }
+                })
 
 
     def update_item_in_download_list(self, item, status, progress):
@@ -656,6 +658,7 @@ class MainWindow(QMainWindow):
             parsing.clear()
         with pending_lock:
             pending.clear()
+            spill_store.clear()
         with download_queue_lock:
             row_count = self.tbl_dl_progress.rowCount()
             while row_count > 0:
@@ -0,0 +1,285 @@
+"""
+Compact records for pending and download queue items.
+
+A queue item used to be a plain dict with about 25 keys, each entry costing a
+hash table slot and often a private copy of a repeated string. `QueueItem`
+stores the known keys in `__slots__` and interns the values that repeat across
+the queue (service, type, status, category and lane), while keys only some
+consumers set, like the Qt widgets under `gui`, go to a small extra dict.
+It behaves like a mutable mapping, so `item['key']`, `item.get()`, `in`,
+`dict(item)` work as before; `json.dumps(..., default=QueueItem.to_dict)`
+serialises queues of them.
+
+`DownloadQueue` is the download queue itself. Every change to it or to the
+status and other fields of one of its items bumps a version, and readers that
+only look at the queue take a snapshot that is rebuilt at most once per
+version, without `download_queue_lock`. Progress updates, which arrive many
+times a second per download, are plain attribute writes that leave the
+version alone; `progress()` reads them live for the items being worked on.
+The lock is left to changes of the queue's structure and to workers claiming
+items.
+"""
+import itertools
+import json
+import sys
+from collections.abc import MutableMapping
+
+FIELDS = (
+    'local_id',
+    'available',
+    'item_service',
+    'item_type',
+    'item_id',
+    'item_status',
+    'item_url',
+    'file_path',
+    'item_name',
+    'item_by',
+    'parent_category',
+    'parent_id',
+    'playlist_name',
+    'playlist_by',
+    'playlist_number',
+    'playlist_total',
+    'playlist_image_url',
+    'playlist_sync_key',
+    'priority',
+    'user',
+    'track_number',
+    'album_name',
+    'item_album_name',
+    'item_thumbnail',
+    'progress',
+    'last_update_time',
+    'timings',
+    '_m3u_written'
+)
+# Values shared by many items, interned so every item points at one string
+INTERNED_FIELDS = frozenset(('item_service', 'item_type', 'item_status', 'parent_category', 'priority', 'user'))
+# Written continuously while an item downloads, served by progress() instead of bumping the version
+PROGRESS_FIELDS = frozenset(('progress', 'last_update_time', 'timings'))
+
+_FIELD_SET = frozenset(FIELDS)
+_UNSET = object()
+
+_changes = itertools.count(1)
+_version = 0
+
+
+def touch():
+    """Record a change to the download queue or one of its items."""
+    global _version
+    _version = next(_changes)
+
+
+def queue_version():
+    return _version
+
+
+class QueueItem(MutableMapping):
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key, _UNSET)
+            if value is _UNSET:
+                raise KeyError(key)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            if key in INTERNED_FIELDS and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+            if key in PROGRESS_FIELDS:
+                return
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        touch()
+
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+            if not self._extra:
+                self._extra = None
+        touch()
+
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            yield from list(self._extra)
+
+
+    def __len__(self):
+        return sum(1 for key in FIELDS if hasattr(self, key)) + (len(self._extra) if self._extra else 0)
+
+
+    def get(self, key, default=None):
+        # Hot path of every consumer, skips the KeyError round trip of Mapping.get
+        if key in _FIELD_SET:
+            return getattr(self, key, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+
+    def to_dict(self):
+        data = {}
+        for key in FIELDS:
+            value = getattr(self, key, _UNSET)
+            if value is not _UNSET:
+                data[key] = value
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+
+    def copy(self):
+        # Shallow, like dict.copy
+        return QueueItem(self.to_dict())
+
+
+    def __repr__(self):
+        return f"QueueItem({self.to_dict()!r})"
+
+
+def as_queue_item(item):
+    """`item` as a QueueItem, converting plain dicts."""
+    return item if isinstance(item, QueueItem) else QueueItem(item)
+
+
+def _plain(item):
+    return item.to_dict() if isinstance(item, QueueItem) else dict(item)
+
+
+class DownloadQueue(dict):
+    """
+    Dict of local_id to item whose readers don't need `download_queue_lock`.
+    `entries()` is a point in time list of the live items, `snapshot()` and
+    `snapshot_json()` are copies that must not be modified. The progress in a
+    snapshot may be behind, `progress()` has the current one.
+    `on_remove(item)` is called for every item that leaves the queue.
+    """
+    __slots__ = ('_snapshot', '_snapshot_json', 'on_remove')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._snapshot = (None, {})
+        self._snapshot_json = (None, '{}')
+        self.on_remove = None
+
+
+    def _removed(self, items):
+        if self.on_remove is not None:
+            for item in items:
+                self.on_remove(item)
+
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        touch()
+
+
+    def __delitem__(self, key):
+        item = dict.get(self, key)
+        super().__delitem__(key)
+        touch()
+        self._removed((item,))
+
+
+    def pop(self, key, *default):
+        present = key in self
+        value = super().pop(key, *default)
+        touch()
+        if present:
+            self._removed((value,))
+        return value
+
+
+    def popitem(self):
+        entry = super().popitem()
+        touch()
+        self._removed((entry[1],))
+        return entry
+
+
+    def clear(self):
+        items = list(self.values())
+        super().clear()
+        touch()
+        self._removed(items)
+
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        touch()
+
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        touch()
+        return value
+
+
+    def entries(self):
+        """`(local_id, item)` pairs of the live items, safe to iterate while the queue changes."""
+        # dict.copy is a single C call under the GIL, it never sees the dict mid-resize
+        return list(dict.copy(self).items())
+
+
+    def snapshot(self):
+        """`(version, {local_id: item_dict})` as of the latest change, shared between readers."""
+        version = queue_version()
+        cached = self._snapshot
+        if cached[0] == version:
+            return cached
+        # A change while copying bumps the version again, so the next reader rebuilds
+        cached = (version, {local_id: _plain(item) for local_id, item in self.entries()})
+        self._snapshot = cached
+        return cached
+
+
+    def progress(self):
+        """`{local_id: {progress, timings}}` of the items workers hold right now, read live."""
+        return {
+            local_id: {'progress': item.get('progress'), 'timings': item.get('timings')}
+            for local_id, item in self.entries() if not item.get('available', True)
+        }
+
+
+    def snapshot_json(self):
+        """The snapshot serialised as served by /api/download_queue."""
+        version, entries = self.snapshot()
+        cached = self._snapshot_json
+        if cached[0] != version:
+            cached = (version, json.dumps(entries, sort_keys=True))
+            self._snapshot_json = cached
+        return cached[1]
@@ -0,0 +1,323 @@
+"""
+Graduated recovery from stalls, used by the watchdog and the failure counter.
+
+Each problem is tracked as an incident, and the cheapest step that can fix it
+is tried first:
+
+- A download without progress is cancelled and a fresh copy of the item is
+  requeued. The copy is held back until the worker of the stalled download
+  let go of it, so the two never write the same partial file. If the copy
+  stalls too, the session of the account it used is reinitialised. After
+  `recovery_max_requeues` requeues the item fails for good, the retry worker
+  leaves it alone until a user retries it.
+- A worker still blocked on the cancelled item after
+  `recovery_escalation_seconds` is retired and replaced by a new one.
+- An account reaching the consecutive failure threshold gets its session
+  reinitialised.
+- Stuck batch flags are cleared.
+- A `download_queue_lock` that stays unavailable across two watchdog checks,
+  or more than `recovery_max_actions` recovery steps within
+  `recovery_window_seconds`, still trigger the hard restart as the last resort.
+
+Every incident records its steps and the throughput it cost: the downloads the
+completion rate of the preceding `BASELINE_SECONDS` would have finished during
+the incident, minus those that did. Incidents are served by /api/incidents.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+from .library_index import library_index
+from .otsconfig import config
+from .queue_item import QueueItem
+from . import runtimedata
+from .runtimedata import account_pool, download_queue, download_queue_lock, get_logger, register_worker, reset_failure_count
+from .scheduler import FINISHED_STATUSES
+from .services import get_service_module
+
+logger = get_logger("recovery")
+
+BASELINE_SECONDS = 300
+INCIDENT_LOG_SIZE = 100
+
+_incidents = deque(maxlen=INCIDENT_LOG_SIZE)
+_open_incidents = {}
+_stuck_workers = {}
+_actions = deque(maxlen=1000)
+_completions = deque(maxlen=10000)
+_incident_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def record_completion():
+    """Count a finished download towards the throughput baseline."""
+    _completions.append(time.time())
+
+
+def _completed_between(start, end):
+    return sum(1 for completed_at in list(_completions) if start <= completed_at < end)
+
+
+def _open_incident(kind, target, started_at=None, **details):
+    """The open incident of `kind` for `target` and whether it was just created."""
+    now = time.time()
+    started_at = min(started_at or now, now)
+    with _lock:
+        incident = _open_incidents.get((kind, target))
+        if incident is not None:
+            return incident, False
+        baseline = _completed_between(started_at - BASELINE_SECONDS, started_at) / BASELINE_SECONDS
+        incident = {
+            'id': next(_incident_ids),
+            'kind': kind,
+            'target': target,
+            'started_at': started_at,
+            'detected_at': now,
+            'resolved_at': None,
+            'outcome': None,
+            'steps': [],
+            'baseline_per_minute': baseline * 60,
+            **details
+        }
+        _open_incidents[(kind, target)] = incident
+        _incidents.append(incident)
+    logger.warning(f"Incident #{incident['id']}: {kind} for {target}")
+    return incident, True
+
+
+def _step(incident, action, detail='', counted=True):
+    # Only steps that changed something count towards recovery_max_actions
+    with _lock:
+        incident['steps'].append({'action': action, 'at': time.time(), 'detail': detail})
+        if counted:
+            _actions.append(time.time())
+    logger.warning(f"Incident #{incident['id']} ({incident['kind']} for {incident['target']}): {action}{f' - {detail}' if detail else ''}")
+
+
+def _resolve(incident, outcome):
+    now = time.time()
+    with _lock:
+        if _open_incidents.get((incident['kind'], incident['target'])) is not incident:
+            return
+        del _open_incidents[(incident['kind'], incident['target'])]
+    duration = now - incident['started_at']
+    completed = _completed_between(incident['started_at'], now)
+    expected = incident['baseline_per_minute'] / 60 * duration
+    incident.update({
+        'resolved_at': now,
+        'outcome': outcome,
+        'duration_s': duration,
+        'during_per_minute': completed / duration * 60 if duration > 0 else 0.0,
+        'lost_items': max(0.0, expected - completed)
+    })
+    logger.info(f"Incident #{incident['id']} resolved ({outcome}) after {duration:.0f}s, about {incident['lost_items']:.1f} downloads lost")
+
+
+def _hard_restart(reason):
+    """The last resort, restarting the whole process through the callback the web app registers."""
+    with _lock:
+        open_incidents = list(_open_incidents.values())
+    for incident in open_incidents:
+        _step(incident, 'hard_restart', reason, counted=False)
+    callback = runtimedata.watchdog_restart_callback
+    if callback is None:
+        logger.error(f"Hard restart needed ({reason}) but no restart callback is registered")
+        return
+    callback(reason)
+
+
+def _check_action_budget():
+    window = config.get('recovery_window_seconds')
+    now = time.time()
+    with _lock:
+        recent = sum(1 for action_at in _actions if now - action_at <= window)
+    if recent > config.get('recovery_max_actions'):
+        _hard_restart(f"{recent} recovery steps within {window}s")
+
+
+def _find_worker(item):
+    with runtimedata.worker_threads_lock:
+        workers = list(runtimedata.worker_threads)
+    for worker in workers:
+        if getattr(worker, 'current_item', None) is item:
+            return worker
+    return None
+
+
+def _worker_alive(worker):
+    thread = worker if isinstance(worker, threading.Thread) else getattr(worker, 'thread', None)
+    return thread is not None and thread.is_alive()
+
+
+def _restart_worker(incident, worker):
+    """Retire `worker`, it exits once its blocked call returns, and start a replacement."""
+    worker.is_running = False
+    replacement = type(worker)()
+    replacement.start()
+    with runtimedata.worker_threads_lock:
+        if worker in runtimedata.worker_threads:
+            runtimedata.worker_threads.remove(worker)
+    register_worker(replacement)
+    _step(incident, 'restart_worker', worker.__class__.__name__)
+
+
+def _reinit_session(incident, service, account_index):
+    if service is None or account_index is None or not 0 <= account_index < len(account_pool):
+        _step(incident, 'reinit_session', 'skipped, account unknown', counted=False)
+        return False
+    re_init = getattr(get_service_module(service), f'{service}_re_init_session', None)
+    if re_init is None:
+        _step(incident, 'reinit_session', f'skipped, {service} keeps no session', counted=False)
+        return False
+    try:
+        re_init(account_pool[account_index], force=True)
+    except Exception as e:
+        _step(incident, 'reinit_session', f'account {account_index} failed: {e}')
+        return False
+    _step(incident, 'reinit_session', f'account {account_index}')
+    return True
+
+
+def _supersede(local_id, item, status, hold=False, **fields):
+    """
+    Replace a stalled item in the queue by a fresh copy with `status` and `fields` and cancel the stalled one.
+    A copy that is `hold` stays unavailable to workers until _release_replacement.
+    """
+    replacement = QueueItem({key: value for key, value in item.items() if not key.startswith('_') or key in ('_m3u_written', '_partial_path')})
+    replacement.update({'item_status': status, 'available': not hold, 'progress': 0, 'last_update_time': time.time(), 'timings': {}, **fields})
+    # The worker holding the stalled item checks this before touching the queue or its files again
+    item['_superseded'] = True
+    with download_queue_lock:
+        if download_queue.get(local_id) is item:
+            download_queue[local_id] = replacement
+    # Transfer loops stop at their next chunk
+    item['item_status'] = 'Cancelled'
+    # Items waiting for this recording download it themselves, the copy claims it anew
+    keys = item.pop('_identity_keys', None)
+    if keys:
+        for follower in library_index.release(keys):
+            follower(None)
+    return replacement
+
+
+def _release_replacement(incident, replacement):
+    with download_queue_lock:
+        current = download_queue.get(incident['target'])
+        if current is not replacement or replacement['item_status'] != 'Waiting' or replacement['available']:
+            return
+        replacement['available'] = True
+    _step(incident, 'release_item', 'the stalled worker let go of the item', counted=False)
+
+
+def recover_stalled_item(local_id, item):
+    """Requeue a download without progress, reinitialising its account's session if it stalls again."""
+    incident, new = _open_incident('stalled_item', local_id, started_at=item.get('last_update_time'),
+                                   item_name=item.get('item_name'), item_service=item.get('item_service'), requeues=0)
+    worker = _find_worker(item)
+    if not new:
+        # The requeued copy stalled as well, the account's session is the next suspect
+        _reinit_session(incident, item.get('item_service'), getattr(worker, 'current_account', None))
+
+    replacement = None
+    if incident['requeues'] >= config.get('recovery_max_requeues'):
+        # Flagged so the retry worker doesn't start the cycle over, and the stalled
+        # worker discards the partial transfer once its blocked call returns
+        item['_recovery_gave_up'] = True
+        _supersede(local_id, item, 'Failed', _recovery_gave_up=True)
+        _step(incident, 'fail_item', f"stalled {incident['requeues'] + 1} times")
+        _resolve(incident, 'failed')
+    else:
+        # The stalled worker may still write to the item's partial file, the copy waits for it
+        replacement = _supersede(local_id, item, 'Waiting', hold=worker is not None and _worker_alive(worker))
+        incident['requeues'] += 1
+        _step(incident, 'requeue_item', item.get('item_name') or '')
+
+    if worker is not None:
+        with _lock:
+            _stuck_workers[incident['id']] = {
+                'incident': incident,
+                'worker': worker,
+                'item': item,
+                'replacement': replacement,
+                'since': time.time(),
+                'restarted': False
+            }
+    _check_action_budget()
+
+
+def recover_account(account_index, failures):
+    """Reinitialise the session of an account that reached the consecutive failure threshold."""
+    incident, _ = _open_incident('account_failures', account_index, failures=failures)
+    service = account_pool[account_index]['service'] if 0 <= account_index < len(account_pool) else None
+    _reinit_session(incident, service, account_index)
+    reset_failure_count(account_index)
+    _check_action_budget()
+
+
+def recover_stuck_flags(flags):
+    incident, _ = _open_incident('stuck_flags', ', '.join(flags))
+    _step(incident, 'clear_flags')
+    _resolve(incident, 'cleared')
+    _check_action_budget()
+
+
+def report_lock(name, acquired, owner=None):
+    """Watchdog probe result for `name`, a lock unavailable on two checks in a row is a deadlock."""
+    if acquired:
+        with _lock:
+            incident = _open_incidents.get(('lock_timeout', name))
+        if incident is not None:
+            _resolve(incident, 'released')
+        return
+    incident, new = _open_incident('lock_timeout', name, owner=owner)
+    if not new:
+        _hard_restart(f"{name} unavailable since {time.ctime(incident['detected_at'])}, held by {owner or 'unknown'}")
+
+
+def review_incidents(stuck_timeout):
+    """
+    Release requeued copies whose stalled worker let go, replace workers still blocked on
+    cancelled items and close incidents whose problem is gone.
+    """
+    now = time.time()
+    with _lock:
+        open_incidents = list(_open_incidents.values())
+        stuck_workers = list(_stuck_workers.items())
+
+    for incident_id, stuck in stuck_workers:
+        worker = stuck['worker']
+        if getattr(worker, 'current_item', None) is not stuck['item'] or not _worker_alive(worker):
+            with _lock:
+                _stuck_workers.pop(incident_id, None)
+            if stuck['replacement'] is not None:
+                _release_replacement(stuck['incident'], stuck['replacement'])
+        elif not stuck['restarted'] and now - stuck['since'] > config.get('recovery_escalation_seconds'):
+            # The retired thread keeps the copy held back until its blocked call returns
+            stuck['restarted'] = True
+            _restart_worker(stuck['incident'], worker)
+
+    for incident in open_incidents:
+        if incident['kind'] == 'stalled_item':
+            current = download_queue.get(incident['target'])
+            if current is None:
+                _resolve(incident, 'removed')
+            elif current['item_status'] in FINISHED_STATUSES:
+                _resolve(incident, 'completed' if current['item_status'] in ('Downloaded', 'Already Exists') else current['item_status'].lower())
+        elif incident['kind'] == 'account_failures':
+            # Any download finishing after the session was reinitialised counts as recovered
+            if _completed_between(incident['detected_at'], now):
+                _resolve(incident, 'recovered')
+            elif now - incident['detected_at'] > max(stuck_timeout, config.get('recovery_window_seconds')):
+                _resolve(incident, 'expired')
+
+
+def get_incidents(limit=50):
+    with _lock:
+        incidents = [dict(incident, steps=list(incident['steps'])) for incident in _incidents]
+        open_count = len(_open_incidents)
+    resolved = [incident for incident in incidents if incident['resolved_at'] is not None]
+    return {
+        'open': open_count,
+        'lost_items': sum(incident['lost_items'] for incident in resolved),
+        'incidents': incidents[::-1][:limit]
+    }
@@ -1,12 +1,15 @@
-import linecache
+import atexit
 import logging
 import os
+import queue
 import sys
-import tracemalloc
-from functools import wraps
-from logging.handlers import RotatingFileHandler
+import time
+import traceback
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from threading import Lock
+from .instrumented_lock import make_lock
 from .otsconfig import config
+from .queue_item import DownloadQueue
 
 log_formatter = logging.Formatter(
     '[%(asctime)s :: %(name)s :: %(pathname)s -> %(lineno)s:%(funcName)20s() :: %(levelname)s] -> %(message)s'
@@ -21,31 +24,30 @@ stdout_handler = logging.StreamHandler(sys.stdout)
 log_handler.setFormatter(log_formatter)
 stdout_handler.setFormatter(log_formatter)
 
+# Instrumented locks report contention at /api/locks, read once since the locks are created here
+_instrument_locks = config.get('instrument_locks')
+
 account_pool = []
 temp_download_path = []
 parsing = {}
 pending = {}
-download_queue = {}
-parsing_lock = Lock()
-pending_lock = Lock()
-download_queue_lock = Lock()
+download_queue = DownloadQueue()
+parsing_lock = make_lock('parsing_lock', _instrument_locks)
+pending_lock = make_lock('pending_lock', _instrument_locks)
+download_queue_lock = make_lock('download_queue_lock', _instrument_locks)
 
 # System notifications for web UI
 system_notifications = []
-system_notifications_lock = Lock()
-
-# Album download locks to prevent concurrent downloads from same album
-album_download_locks = {}
-album_download_locks_lock = Lock()
+system_notifications_lock = make_lock('system_notifications_lock', _instrument_locks)
 
 # Batch parsing state (for playlists/albums that add multiple items)
 batch_parse_in_progress = False
-batch_parse_lock = Lock()
+batch_parse_lock = make_lock('batch_parse_lock', _instrument_locks)
 batch_parse_start_time = None  # Track when flag was set
 
 # Batch queue processing state (when QueueWorker is adding many items to download queue)
 batch_queue_processing = False
-batch_queue_processing_lock = Lock()
+batch_queue_processing_lock = make_lock('batch_queue_processing_lock', _instrument_locks)
 batch_queue_processing_start_time = None  # Track when flag was set
 
 # Timeout for batch operations (in seconds)
@@ -53,13 +55,13 @@ BATCH_OPERATION_TIMEOUT = 30
 
 # Worker management
 worker_threads = []
-worker_threads_lock = Lock()
+worker_threads_lock = make_lock('worker_threads_lock', _instrument_locks)
 worker_restart_callback = None  # Function to call to restart workers (soft restart)
 watchdog_restart_callback = None  # Function to call for hard restart when stuck
-worker_restart_lock = Lock()  # Prevent multiple simultaneous restarts
+worker_restart_lock = make_lock('worker_restart_lock', _instrument_locks)  # Prevent multiple simultaneous restarts
 worker_restart_in_progress = False
 account_consecutive_failures = {}  # Track failures per account index
-consecutive_failures_lock = Lock()
+consecutive_failures_lock = make_lock('consecutive_failures_lock', _instrument_locks)
 MAX_FAILURE_TRACKING_SIZE = 100  # Prevent unbounded growth
 
 init_tray = False
@@ -76,11 +78,145 @@ def get_init_tray():
 
 loglevel = int(os.environ.get("LOG_LEVEL", 20))
 
+# Log records are handed to a background listener so worker threads never
+# format records or touch the disk. The buffer is bounded, when it is full
+# records are dropped and counted instead of blocking the caller.
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# DEBUG records from a single call site are limited to LOG_SAMPLE_BURST per
+# LOG_SAMPLE_WINDOW seconds, other levels are never sampled. Suppressed records
+# are reported per call site once their window has passed.
+LOG_SAMPLE_BURST = int(os.environ.get("LOG_SAMPLE_BURST", 20))
+LOG_SAMPLE_WINDOW = 1.0
+
+
+class SamplingFilter(logging.Filter):
+    """Rate limit high-frequency DEBUG messages per call site."""
+    def __init__(self, burst, window):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.lock = Lock()
+        self.call_sites = {}
+        self.sampled = 0
+        self.last_report = time.monotonic()
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed = self.call_sites.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                # Suppressed records of the previous window are reported by take_suppressed()
+                self.call_sites[key] = (now, 1, suppressed)
+                return True
+            if count < self.burst:
+                self.call_sites[key] = (window_start, count + 1, suppressed)
+                return True
+            self.call_sites[key] = (window_start, count, suppressed + 1)
+            self.sampled += 1
+            return False
+
+    def take_suppressed(self):
+        """`[(pathname, lineno, count)]` of suppressed records not reported yet, checked once per window."""
+        now = time.monotonic()
+        if now - self.last_report < self.window:
+            return []
+        with self.lock:
+            self.last_report = now
+            reports = []
+            for key, (window_start, count, suppressed) in list(self.call_sites.items()):
+                if not suppressed:
+                    if now - window_start >= self.window:
+                        del self.call_sites[key]
+                    continue
+                reports.append((*key, suppressed))
+                self.call_sites[key] = (window_start, count, 0)
+            return reports
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks, records are dropped when the buffer is full."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.drop_lock = Lock()
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        # Only merge the arguments here since they may change once the call
+        # returns, formatting and tracebacks are left to the listener thread
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+                self.unreported += 1
+            return
+        for log_filter in self.filters:
+            if isinstance(log_filter, SamplingFilter):
+                for pathname, lineno, suppressed in log_filter.take_suppressed():
+                    self.enqueue(logging.makeLogRecord({
+                        'name': 'runtimedata',
+                        'levelno': logging.INFO,
+                        'levelname': 'INFO',
+                        'msg': f"Suppressed {suppressed} messages from {os.path.basename(pathname)}:{lineno}",
+                    }))
+        if self.unreported:
+            with self.drop_lock:
+                unreported, self.unreported = self.unreported, 0
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'runtimedata',
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f"Log buffer full, dropped {unreported} log records",
+                }))
+            except queue.Full:
+                with self.drop_lock:
+                    self.unreported += unreported
+
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_sampling_filter = SamplingFilter(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW)
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(log_sampling_filter)
+log_listener = QueueListener(log_queue, log_handler, stdout_handler, respect_handler_level=True)
+log_listener.start()
+
+
+def flush_logs():
+    """Drain the log buffer, call before the process exits."""
+    global log_listener
+    if log_listener is None:
+        return
+    listener, log_listener = log_listener, None
+    listener.stop()
+
+
+atexit.register(flush_logs)
+
+
+def get_log_stats():
+    return {
+        'queued': log_queue.qsize(),
+        'capacity': LOG_QUEUE_SIZE,
+        'dropped': queue_handler.dropped,
+        'sampled': log_sampling_filter.sampled
+    }
+
 
 def get_logger(name):
     logger = logging.getLogger(name)
-    logger.addHandler(log_handler)
-    logger.addHandler(stdout_handler)
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
     logger.setLevel(loglevel)
     return logger
 
@@ -97,49 +233,6 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_exception
 
-def log_function_memory(wrap_func):
-    tracemalloc.start()
-    top_limit = 10
-    def display_top(snapshot, snapshot_log_prefix, key_type='lineno'):
-        snapshot = snapshot.filter_traces((
-            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
-            tracemalloc.Filter(False, "<unknown>"),
-        ))
-        top_stats = snapshot.statistics(key_type)
-
-        logger_.debug(f"{snapshot_log_prefix} Top {top_limit} lines")
-        for index, stat in enumerate(top_stats[:top_limit], 1):
-            frame = stat.traceback[0]
-            logger_.debug("#%s: %s:%s: %.1f KiB"
-                % (index, frame.filename, frame.lineno, stat.size / 1024))
-            line = linecache.getline(frame.filename, frame.lineno).strip()
-            if line:
-                logger_.debug(f"{snapshot_log_prefix} -- {line}"  )
-
-        other = top_stats[top_limit:]
-        if other:
-            size = sum(stat.size for stat in other)
-            logger_.debug("%s other: %.1f KiB" % (len(other), size / 1024))
-        total = sum(stat.size for stat in top_stats)
-        logger_.debug("Total allocated size: %.1f KiB" % (total / 1024))
-
-    @wraps(wrap_func)
-    def snapshot_function_call(*args, **kwargs):
-        prefix = f"{wrap_func.__name__}: "
-        before_func = tracemalloc.take_snapshot()
-        logger_.debug(f"Snapshotting before {wrap_func.__name__} call")
-        ret_val = wrap_func(*args, **kwargs)
-        display_top(before_func, prefix)
-        logger_.debug(f"Snapshotting after {wrap_func.__name__} call")
-        after_func = tracemalloc.take_snapshot()
-        display_top(after_func, prefix)
-        top_stats = after_func.compare_to(before_func, 'lineno')
-        logger_.debug(f"{prefix} Top {top_limit} differences")
-        for stat in top_stats[:10]:
-            logger_.debug(f"{prefix}{stat}")
-        return ret_val
-    return snapshot_function_call
-
 
 def register_worker(worker):
     """Register a worker thread for management"""
@@ -191,10 +284,10 @@ def kill_all_workers():
 
 
 def increment_failure_count(account_index=None):
-    """Increment consecutive failure counter for an account and trigger restart if threshold reached"""
+    """Increment consecutive failure counter for an account and recover the account if threshold reached"""
     global account_consecutive_failures, worker_restart_callback
 
-    # Threshold for triggering worker restart (per account)
+    # Threshold for reinitialising the account's session
     FAILURE_THRESHOLD = 3
 
     with consecutive_failures_lock:
@@ -221,36 +314,13 @@ def increment_failure_count(account_index=None):
             account_info = f"account {account_index} ({account_uuid})"
 
     if current_count >= FAILURE_THRESHOLD:
-        global worker_restart_in_progress
-        
-        # Check if restart already in progress
-        with worker_restart_lock:
-            if worker_restart_in_progress:
-                logger_.warning(f"Restart already in progress, skipping duplicate restart trigger for {account_info}")
-                return
-            worker_restart_in_progress = True
-        
+        logger_.error(f"🚨 Consecutive failures for {account_info} reached {current_count}, reinitialising its session")
+        # Imported here, recovery depends on this module
+        from .recovery import recover_account
         try:
-            logger_.error(f"🚨 CRITICAL: Consecutive failures for {account_info} reached {current_count}, triggering HARD RESTART...")
-
-            # Reset all counters before restart to avoid repeated restarts
-            reset_failure_count()
-
-            # Trigger hard restart if callback is set
-            if watchdog_restart_callback:
-                try:
-                    logger_.error("Executing hard restart callback now...")
-                    watchdog_restart_callback()
-                except Exception as e:
-                    logger_.error(f"Failed to restart workers: {e}\nTraceback: {traceback.format_exc()}")
-            else:
-                logger_.error("No watchdog restart callback registered!")
-        finally:
-            # Clear restart flag after some time
-            import time
-            time.sleep(5)  # Give restart time to complete
-            with worker_restart_lock:
-                worker_restart_in_progress = False
+            recover_account(account_index, current_count)
+        except Exception as e:
+            logger_.error(f"Failed to recover {account_info}: {e}\nTraceback: {traceback.format_exc()}")
     else:
         account_info = f"account {account_index}" if account_index >= 0 else "unknown account"
         if account_index >= 0 and account_index < len(account_pool):
@@ -351,42 +421,31 @@ def set_batch_queue_processing_flag(value):
 
 
 def check_and_clear_stuck_flags():
-    """Check if batch operation flags are stuck and trigger hard restart if timeout exceeded"""
+    """Clear batch operation flags stuck longer than the timeout, returns the names of the cleared flags"""
     import time
     global batch_parse_in_progress, batch_parse_start_time
     global batch_queue_processing, batch_queue_processing_start_time
-    global watchdog_restart_callback
     
-    should_restart = False
+    cleared = []
     
     # Check batch_parse_in_progress flag
     with batch_parse_lock:
         if batch_parse_in_progress and batch_parse_start_time:
             elapsed = time.time() - batch_parse_start_time
             if elapsed > BATCH_OPERATION_TIMEOUT:
-                logger_.error(f"⚠️ STUCK FLAG DETECTED: batch_parse_in_progress has been True for {elapsed:.1f}s (timeout: {BATCH_OPERATION_TIMEOUT}s)")
-                logger_.error("System is unresponsive - triggering HARD RESTART to recover")
+                logger_.error(f"⚠️ STUCK FLAG DETECTED: batch_parse_in_progress has been True for {elapsed:.1f}s (timeout: {BATCH_OPERATION_TIMEOUT}s), clearing it")
                 batch_parse_in_progress = False
                 batch_parse_start_time = None
-                should_restart = True
+                cleared.append('batch_parse_in_progress')
     
     # Check batch_queue_processing flag
     with batch_queue_processing_lock:
         if batch_queue_processing and batch_queue_processing_start_time:
             elapsed = time.time() - batch_queue_processing_start_time
             if elapsed > BATCH_OPERATION_TIMEOUT:
-                logger_.error(f"⚠️ STUCK FLAG DETECTED: batch_queue_processing has been True for {elapsed:.1f}s (timeout: {BATCH_OPERATION_TIMEOUT}s)")
-                logger_.error("System is unresponsive - triggering HARD RESTART to recover")
+                logger_.error(f"⚠️ STUCK FLAG DETECTED: batch_queue_processing has been True for {elapsed:.1f}s (timeout: {BATCH_OPERATION_TIMEOUT}s), clearing it")
                 batch_queue_processing = False
                 batch_queue_processing_start_time = None
-                should_restart = True
-    
-    # Trigger hard restart if any flag was stuck
-    if should_restart and watchdog_restart_callback:
-        try:
-            logger_.error("🔄 WATCHDOG: Executing hard restart due to stuck flags...")
-            watchdog_restart_callback()
-        except Exception as e:
-            logger_.error(f"Watchdog failed to restart: {e}")
+                cleared.append('batch_queue_processing')
     
-    return should_restart
+    return cleared
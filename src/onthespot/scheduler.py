@@ -0,0 +1,337 @@
+"""
+Selection of the next download queue item.
+
+Items belong to one of three priority lanes. Single items somebody asked for
+are `interactive`, albums are `normal` and playlists, discographies and other
+bulk imports run in the `bulk` lane. Lanes with waiting items share the
+download workers by smooth weighted round robin on `priority_weights`, so a
+large import keeps moving while interactive requests start almost at once.
+Within a lane the web users that submitted items take turns by deficit round
+robin on `user_weights`, so one user's large import can't starve the others,
+and each user's items keep the playlist, album and track order.
+
+Services can be limited to a number of concurrent downloads and metadata
+requests. Items of a saturated service are passed over, so the workers keep
+the other services busy instead of queueing up behind the throttled one.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from .otsconfig import config
+from .runtimedata import download_queue, download_queue_lock, pending, pending_lock, get_logger
+
+logger = get_logger("scheduler")
+
+PRIORITIES = ('interactive', 'normal', 'bulk')
+# Parent categories of items that were requested one by one
+INTERACTIVE_CATEGORIES = ('track', 'podcast_episode', 'episode', 'movie')
+FINISHED_STATUSES = ('Downloaded', 'Already Exists', 'Failed', 'Cancelled', 'Unavailable', 'Deleted')
+# Status of an item a worker claimed that waits for its metadata request to get a slot
+CLAIMED_STATUS = 'Waiting for metadata'
+# Statuses of items that are transferring from their service, conversion and moving don't count
+SERVICE_BUSY_STATUSES = (CLAIMED_STATUS, 'Downloading', 'Downloading Subtitles', 'Getting Lyrics')
+
+
+def default_priority(item):
+    parent_category = item.get('parent_category')
+    if parent_category in INTERACTIVE_CATEGORIES:
+        return 'interactive'
+    if parent_category == 'album':
+        return 'normal'
+    return 'bulk'
+
+
+def item_priority(item):
+    priority = item.get('priority')
+    return priority if priority in PRIORITIES else default_priority(item)
+
+
+def item_user(item):
+    """Web user that submitted the item, None for the CLI, the watch list and restored queues."""
+    return item.get('user')
+
+
+def user_quota(user):
+    """Max items `user` can have waiting or downloading, None if unlimited."""
+    if user is None:
+        return None
+    quota = config.get('user_queue_quota_overrides').get(user, config.get('user_queue_quota'))
+    return int(quota) if quota else None
+
+
+def _order_key(entry):
+    local_id, item = entry
+    return (
+        int(item.get('playlist_number', 0) or 0) if item.get('parent_category') == 'playlist' else 999999,  # Playlist items by number
+        item.get('album_name') or '\uffff',  # Then group by album
+        int(item.get('track_number') or 9999),  # Then by track number
+        local_id  # Maintain insertion order as tiebreaker
+    )
+
+
+class Scheduler:
+    def __init__(self):
+        self.credits = {priority: 0 for priority in PRIORITIES}
+        # Per lane the deficit of every user with waiting items, in round robin order
+        self.deficits = {priority: {} for priority in PRIORITIES}
+
+
+    def _pick_lane(self, lanes):
+        # Smooth weighted round robin: every waiting lane earns its weight, the richest lane
+        # is served and pays the total back, which interleaves lanes instead of bursting them
+        weights = config.get('priority_weights')
+        for priority in self.credits:
+            if priority not in lanes:
+                # An idle lane must not bank credit for a burst when it comes back
+                self.credits[priority] = 0
+        total = 0
+        for priority in lanes:
+            weight = max(1, int(weights.get(priority, 1)))
+            self.credits[priority] += weight
+            total += weight
+        lane = max(lanes, key=lambda priority: self.credits[priority])
+        self.credits[lane] -= total
+        return lane
+
+
+    def _pick_user(self, lane, users):
+        # Deficit round robin with a cost of one item: the user at the head of the round
+        # tops up its deficit by its weight when it ran out, is served once, and goes to
+        # the back when its turn is used up
+        deficits = self.deficits[lane]
+        for user in list(deficits):
+            if user not in users:
+                # Users without waiting items leave the round and lose their deficit
+                del deficits[user]
+        for user in users:
+            deficits.setdefault(user, 0)
+
+        user = next(iter(deficits))
+        if deficits[user] < 1:
+            deficits[user] += max(1, int(config.get('user_weights').get(user, 1)))
+        deficits[user] -= 1
+        if deficits[user] < 1:
+            deficits[user] = deficits.pop(user)
+        return user
+
+
+    def select(self, items):
+        """Pick the next `(local_id, item)` from the waiting `items`, or None."""
+        lanes = {}
+        for entry in items:
+            lanes.setdefault(item_priority(entry[1]), {}).setdefault(item_user(entry[1]), []).append(entry)
+        if not lanes:
+            return None
+        lane = self._pick_lane(lanes)
+        return min(lanes[lane][self._pick_user(lane, lanes[lane])], key=_order_key)
+
+
+    def get_deficits(self):
+        return {lane: dict(deficits) for lane, deficits in self.deficits.items()}
+
+
+scheduler = Scheduler()
+
+
+def service_limit(service, setting):
+    """Concurrency limit of `service` in the `setting` config key, None if unlimited."""
+    limit = config.get(setting).get(service)
+    return int(limit) if limit else None
+
+
+def busy_services(items):
+    """Number of `items` per service that are downloading right now."""
+    busy = {}
+    for item in items:
+        if not item['available'] and item['item_status'] in SERVICE_BUSY_STATUSES:
+            busy[item['item_service']] = busy.get(item['item_service'], 0) + 1
+    return busy
+
+
+def select_next_item(priorities=None):
+    """
+    Claim the next waiting download queue item, only from the `priorities` lanes if given.
+    Services at their `service_max_concurrent_downloads` limit are skipped.
+    Must be called with `download_queue_lock` held.
+    """
+    busy = busy_services(download_queue.values())
+    saturated = set()
+    for service, count in busy.items():
+        limit = service_limit(service, 'service_max_concurrent_downloads')
+        if limit is not None and count >= limit:
+            saturated.add(service)
+
+    available_items = [
+        (local_id, item) for local_id, item in download_queue.items()
+        if item['available'] and item['item_status'] == 'Waiting'
+        and item['item_service'] not in saturated
+        and (priorities is None or item_priority(item) in priorities)
+    ]
+    selected = scheduler.select(available_items)
+    if selected:
+        # Marked as claimed right away so the next worker's selection already counts it,
+        # the worker sets 'Downloading' once it holds a metadata slot
+        selected[1]['available'] = False
+        selected[1]['item_status'] = CLAIMED_STATUS
+        selected[1]['last_update_time'] = time.time()
+    return selected
+
+
+class ServiceLimiter:
+    """Bounds concurrent calls per service to the limits in a config key, read on every call."""
+    def __init__(self, setting):
+        self.setting = setting
+        self.condition = threading.Condition()
+        self.active = {}
+
+
+    @contextmanager
+    def slot(self, service, on_wait=None):
+        """Hold one of `service`'s slots, calling `on_wait()` about once a second while none is free."""
+        with self.condition:
+            while True:
+                limit = service_limit(service, self.setting)
+                if limit is None or self.active.get(service, 0) < limit:
+                    break
+                if on_wait is not None:
+                    on_wait()
+                # Timed so a raised limit is picked up without a notification
+                self.condition.wait(1)
+            self.active[service] = self.active.get(service, 0) + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[service] -= 1
+                self.condition.notify_all()
+
+
+    def get_active(self):
+        with self.condition:
+            return {service: count for service, count in self.active.items() if count}
+
+
+metadata_limiter = ServiceLimiter('service_max_concurrent_metadata')
+
+
+def metadata_slot(service, on_wait=None):
+    """Context manager held around a metadata request to `service`."""
+    return metadata_limiter.slot(service, on_wait)
+
+
+def get_service_stats():
+    """Downloads and metadata requests in flight per service, with their limits."""
+    busy = busy_services(item for _, item in download_queue.entries())
+    metadata = metadata_limiter.get_active()
+    services = set(busy) | set(metadata) | set(config.get('service_max_concurrent_downloads')) | set(config.get('service_max_concurrent_metadata'))
+    return [{
+        'service': service,
+        'downloads': busy.get(service, 0),
+        'download_limit': service_limit(service, 'service_max_concurrent_downloads'),
+        'metadata_requests': metadata.get(service, 0),
+        'metadata_limit': service_limit(service, 'service_max_concurrent_metadata')
+    } for service in sorted(services)]
+
+
+def set_priority(priority, local_ids=(), playlist_name=None, playlist_by=None, user=None):
+    """
+    Move items, or every item of a playlist, to the `priority` lane.
+    Items still waiting for metadata are updated as well. With `user` set only
+    that user's items are changed. Returns the number of items changed.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    local_ids = set(local_ids)
+
+    def matches(local_id, item):
+        if user is not None and item.get('user') != user:
+            return False
+        if local_id in local_ids:
+            return True
+        return playlist_name is not None and item.get('playlist_name') == playlist_name and item.get('playlist_by') == playlist_by
+
+    changed = 0
+    with download_queue_lock:
+        for local_id, item in download_queue.items():
+            if matches(local_id, item):
+                item['priority'] = priority
+                changed += 1
+    with pending_lock:
+        for local_id, item in pending.items():
+            if matches(local_id, item):
+                item['priority'] = priority
+                changed += 1
+    logger.info(f"Moved {changed} items to the {priority} lane")
+    return changed
+
+
+def _active_counts():
+    counts = {}
+    for _, item in download_queue.entries():
+        if item['item_status'] not in FINISHED_STATUSES:
+            user = item_user(item)
+            counts[user] = counts.get(user, 0) + 1
+    return counts
+
+
+def admit_pending(items, room=None):
+    """
+    Order pending `(local_id, item)` entries for the download queue and hold back those
+    of users at their quota, and beyond `room` free places except for interactive items.
+    Users take turns so no single import is admitted as a block.
+    Returns `(admitted, deferred)` where deferred is the number of entries held back.
+    """
+    active = _active_counts()
+    ranks = {}
+    admitted = []
+    deferred = 0
+    for entry in sorted(items, key=lambda x: (PRIORITIES.index(item_priority(x[1])), int(x[1].get('playlist_number', 0) or 0))):
+        user = item_user(entry[1])
+        quota = user_quota(user)
+        if quota is not None and active.get(user, 0) >= quota:
+            deferred += 1
+            continue
+        if room is not None and item_priority(entry[1]) != 'interactive':
+            if room <= 0:
+                deferred += 1
+                continue
+            room -= 1
+        active[user] = active.get(user, 0) + 1
+        rank = ranks[user] = ranks.get(user, -1) + 1
+        admitted.append((rank, entry))
+    # Stable, so within a rank the lane and playlist order is kept
+    admitted.sort(key=lambda ranked: (PRIORITIES.index(item_priority(ranked[1][1])), ranked[0]))
+    return [entry for _, entry in admitted], deferred
+
+
+def get_user_stats():
+    """Queue depth and wait time per submitting user."""
+    now = time.time()
+    users = {}
+
+    def stats(user):
+        return users.setdefault(user, {
+            'user': user,
+            'pending': 0,
+            'waiting': 0,
+            'in_progress': 0,
+            'finished': 0,
+            'oldest_wait_seconds': 0,
+            'quota': user_quota(user),
+            'weight': max(1, int(config.get('user_weights').get(user, 1))) if user is not None else 1
+        })
+
+    with pending_lock:
+        for item in pending.values():
+            stats(item_user(item))['pending'] += 1
+    for _, item in download_queue.entries():
+        user_stats = stats(item_user(item))
+        if item['item_status'] == 'Waiting':
+            user_stats['waiting'] += 1
+            waited = now - (item.get('last_update_time') or now)
+            user_stats['oldest_wait_seconds'] = max(user_stats['oldest_wait_seconds'], int(waited))
+        elif item['item_status'] in FINISHED_STATUSES:
+            user_stats['finished'] += 1
+        else:
+            user_stats['in_progress'] += 1
+    return list(users.values())
@@ -1,18 +1,10 @@
 import os
 import re
 from .accounts import get_account_token
-from .api.apple_music import apple_music_get_search_results
-from .api.bandcamp import bandcamp_get_search_results
-from .api.deezer import deezer_get_search_results
-from .api.qobuz import qobuz_get_search_results
-from .api.soundcloud import soundcloud_get_search_results
-from .api.spotify import spotify_get_search_results, spotify_get_item_by_id
-from .api.tidal import tidal_get_search_results
-from .api.youtube_music import youtube_music_get_search_results
-from .api.crunchyroll import crunchyroll_get_search_results
 from .otsconfig import config
 from .parse_item import parse_url
 from .runtimedata import account_pool, get_logger
+from .services import get_service_function
 
 logger = get_logger("search")
 
@@ -46,7 +38,7 @@ def get_search_results(search_term, content_types=None):
         if service == 'spotify':
             try:
                 token = get_account_token(service)
-                return spotify_get_item_by_id(token, spotify_id, spotify_type)
+                return get_service_function(service, "get_item_by_id")(token, spotify_id, spotify_type)
             except (ConnectionError, ConnectionRefusedError, OSError, TimeoutError) as e:
                 logger.error(f"Connection error while fetching Spotify URI: {e}")
                 logger.error("This may be due to temporary network issues or Spotify rate limiting. Please try again in a moment.")
@@ -67,7 +59,7 @@ def get_search_results(search_term, content_types=None):
         if service == 'spotify':
             try:
                 token = get_account_token(service)
-                return spotify_get_item_by_id(token, search_term, 'playlist')
+                return get_service_function(service, "get_item_by_id")(token, search_term, 'playlist')
             except (ConnectionError, ConnectionRefusedError, OSError, TimeoutError) as e:
                 logger.error(f"Connection error while fetching Spotify ID: {e}")
                 logger.error("This may be due to temporary network issues or Spotify rate limiting. Please try again in a moment.")
@@ -101,7 +93,7 @@ def get_search_results(search_term, content_types=None):
         if search_term and service != 'generic':
             try:
                 token = get_account_token(service)
-                return globals()[f"{service}_get_search_results"](token, search_term, content_types)
+                return get_service_function(service, "get_search_results")(token, search_term, content_types)
             except (ConnectionError, ConnectionRefusedError, OSError, TimeoutError) as e:
                 logger.error(f"Connection error during search: {e}")
                 logger.error("This may be due to temporary network issues or Spotify rate limiting. Please try again in a moment.")
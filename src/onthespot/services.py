@@ -0,0 +1,55 @@
+"""
+Lazy registry for the service provider modules in onthespot.api.
+
+Provider modules pull in heavy dependencies (librespot, yt_dlp, Cryptodome,
+...), so they are only imported the first time an account, URL or queued
+item actually needs them.
+"""
+import importlib
+import threading
+
+SERVICES = (
+    'apple_music',
+    'bandcamp',
+    'crunchyroll',
+    'deezer',
+    'generic',
+    'qobuz',
+    'soundcloud',
+    'spotify',
+    'tidal',
+    'youtube_music',
+)
+
+_modules = {}
+_modules_lock = threading.Lock()
+
+
+def get_service_module(service):
+    """Return the provider module for a service, importing it on first use."""
+    module = _modules.get(service)
+    if module is None:
+        if service not in SERVICES:
+            raise KeyError(f"Unknown service: {service}")
+        with _modules_lock:
+            module = _modules.get(service)
+            if module is None:
+                module = importlib.import_module(f'.api.{service}', __package__)
+                _modules[service] = module
+    return module
+
+
+def get_service_function(service, name):
+    """Return `{service}_{name}` from the service's provider module."""
+    return getattr(get_service_module(service), f'{service}_{name}')
+
+
+def register_service(service, module):
+    """Use `module` as the provider for `service`, e.g. a stand-in for benchmarks."""
+    with _modules_lock:
+        _modules[service] = module
+
+
+def loaded_services():
+    """Names of the services whose provider module has been imported."""
+    return list(_modules)
@@ -0,0 +1,188 @@
+"""
+Local staging for downloads.
+
+When `staging_download_path` is set, download workers fetch, convert and tag
+audio in that (fast, local) directory. Finished files are handed to a single
+background mover that copies them sequentially into the library and renames
+them into place atomically, so the library volume only ever sees complete
+files and one writer.
+"""
+import os
+import queue
+import shutil
+import threading
+import time
+from .otsconfig import config
+from .runtimedata import get_logger
+
+logger = get_logger("staging")
+
+COPY_BUFFER_SIZE = 1024 * 1024
+COVER_NAMES = ('cover.jpg', 'cover.jpeg', 'cover.png')
+
+
+def get_staging_root():
+    """Staging directory, or None if downloads go straight into the library."""
+    path = config.get('staging_download_path')
+    if not path:
+        return None
+    return os.path.abspath(os.path.expanduser(path))
+
+
+class StagingMover:
+    def __init__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.is_running = True
+        self.moves = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.backlog_bytes = 0
+        self.moved_files = 0
+        self.moved_bytes = 0
+        self.busy_time = 0.0
+        self.failed_moves = 0
+        self.last_error = None
+
+
+    def start(self):
+        logger.info('Starting Staging Mover')
+        self.thread.start()
+
+
+    def enqueue(self, source_path, library_dir, on_done, on_error):
+        """
+        Move `source_path` and its sidecar files into `library_dir` in the background.
+        `on_done(library_path)` or `on_error(exception)` is called from the mover thread.
+        """
+        size = os.path.getsize(source_path)
+        with self.stats_lock:
+            self.backlog_bytes += size
+        self.moves.put((source_path, library_dir, size, on_done, on_error))
+
+
+    def run(self):
+        while self.is_running:
+            try:
+                source_path, library_dir, size, on_done, on_error = self.moves.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            start = time.time()
+            try:
+                library_path = self._move_with_sidecars(source_path, library_dir)
+            except Exception as e:
+                logger.error(f"Failed to move {source_path} into the library: {e}")
+                with self.stats_lock:
+                    self.backlog_bytes -= size
+                    self.failed_moves += 1
+                    self.last_error = str(e)
+                self._notify(on_error, e)
+                continue
+
+            with self.stats_lock:
+                self.backlog_bytes -= size
+                self.moved_files += 1
+                self.moved_bytes += size
+                self.busy_time += time.time() - start
+            logger.debug(f"Moved {source_path} to {library_path} in {time.time() - start:.2f}s")
+            self._notify(on_done, library_path)
+
+
+    def _notify(self, callback, argument):
+        # A failing callback must not take the mover down with it
+        try:
+            callback(argument)
+        except Exception as e:
+            logger.error(f"Staging mover callback failed: {e}")
+
+
+    def stop(self):
+        logger.info('Stopping Staging Mover')
+        self.is_running = False
+        self.thread.join()
+
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                'backlog_items': self.moves.qsize(),
+                'backlog_bytes': self.backlog_bytes,
+                'moved_files': self.moved_files,
+                'moved_bytes': self.moved_bytes,
+                'throughput_mb_per_s': self.moved_bytes / self.busy_time / (1024 * 1024) if self.busy_time else 0.0,
+                'failed_moves': self.failed_moves,
+                'last_error': self.last_error
+            }
+
+
+    def _move_with_sidecars(self, source_path, library_dir):
+        os.makedirs(library_dir, exist_ok=True)
+        source_dir, file_name = os.path.split(source_path)
+        stem = os.path.splitext(file_name)[0]
+
+        # Lyrics and other files named after the track travel with it
+        for entry in os.scandir(source_dir):
+            if entry.is_file() and entry.name != file_name and os.path.splitext(entry.name)[0] == stem:
+                self._move_file(entry.path, os.path.join(library_dir, entry.name))
+
+        # Album covers are shared by the directory, keep the library copy if there already is one
+        for cover_name in COVER_NAMES:
+            cover_path = os.path.join(source_dir, cover_name)
+            if os.path.isfile(cover_path):
+                library_cover = os.path.join(library_dir, cover_name)
+                if os.path.exists(library_cover):
+                    os.remove(cover_path)
+                else:
+                    self._move_file(cover_path, library_cover)
+
+        library_path = os.path.join(library_dir, file_name)
+        self._move_file(source_path, library_path)
+
+        # Emptied staging directories are left in place, a worker may be about to write into them
+        return library_path
+
+
+    def _move_file(self, source_path, target_path):
+        if os.stat(source_path).st_dev == os.stat(os.path.dirname(target_path)).st_dev:
+            os.replace(source_path, target_path)
+            return
+
+        # One sequential copy to a hidden name, then an atomic rename into place
+        partial_path = os.path.join(os.path.dirname(target_path), '.~' + os.path.basename(target_path))
+        try:
+            with open(source_path, 'rb') as source, open(partial_path, 'wb') as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+                target.flush()
+                os.fsync(target.fileno())
+            shutil.copystat(source_path, partial_path)
+            os.replace(partial_path, target_path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.remove(source_path)
+
+
+_mover = None
+_mover_lock = threading.Lock()
+
+
+def get_staging_mover():
+    """
+    Shared mover, started on first use. It is not registered with the worker
+    pool so soft restarts of the download workers don't drop its backlog.
+    """
+    global _mover
+    with _mover_lock:
+        if _mover is None:
+            _mover = StagingMover()
+            _mover.start()
+        return _mover
+
+
+def get_staging_stats():
+    if _mover is None:
+        return {'staging_path': get_staging_root(), 'running': False}
+    stats = _mover.get_stats()
+    stats['staging_path'] = get_staging_root()
+    stats['running'] = True
+    return stats
@@ -1,18 +1,17 @@
 import base64
 import json
+import logging
 import os
 import platform
 import requests
+import shutil
 import ssl
 import subprocess
+import threading
 import time
 from hashlib import md5
-from io import BytesIO
-from PIL import Image
-from mutagen.flac import Picture
-from mutagen.id3 import ID3, ID3NoHeaderError, WOAS, USLT, TCMP, COMM
-from mutagen.oggvorbis import OggVorbis
-import music_tag
+from urllib.parse import urlencode
+from .cover_cache import get_cover_path
 from .otsconfig import config
 from .runtimedata import get_logger, pending, download_queue
 
@@ -29,11 +28,72 @@ class SSLAdapter(requests.adapters.HTTPAdapter):
         return super().init_poolmanager(*args, ssl_context=context, **kwargs)
 
 
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+        self.error = None
+
+
+# Requests currently on the wire, keyed by request cache key, cache mode and credentials
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _request_cache_key(url, params):
+    # Calls without params keep the url only key of older caches
+    if not params:
+        return md5(f'{url}'.encode()).hexdigest()
+    query = urlencode(sorted((str(key), str(value)) for key, value in params.items()))
+    return md5(f'{url}?{query}'.encode()).hexdigest()
+
+
+def _credentials_key(headers, session):
+    # Callers only share a request made with the same account
+    auth = {key.lower(): value for key, value in (headers or {}).items()}.get('authorization')
+    if auth is None and session is not None:
+        auth = session.headers.get('Authorization')
+    session_id = id(session) if session is not None else None
+    return md5(f'{auth}'.encode()).hexdigest(), session_id
+
+
+def _load_validators(req_cache_file):
+    try:
+        with open(req_cache_file[:-len('.json')] + '.meta', 'r', encoding='utf-8') as mf:
+            return json.load(mf)
+    except (OSError, ValueError):
+        return {}
+
+
+def _response_validators(response):
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+
+
+def _save_validators(req_cache_file, validators):
+    meta_file = req_cache_file[:-len('.json')] + '.meta'
+    if not any(validators.values()):
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        return
+    with open(meta_file, 'w', encoding='utf-8') as mf:
+        json.dump(validators, mf)
+
+
 def make_call(url, params=None, headers=None, session=None, skip_cache=False, text=False, use_ssl=False):
+    """
+    GET `url` and return the parsed JSON body, or the text with `text=True`.
+
+    Responses are cached in the reqcache directory. Cached entries are served as is,
+    unless `skip_cache` is set: the entry is then revalidated with the ETag or
+    Last-Modified the server sent, and a 304 answer is served from the cache.
+    """
+    request_key = _request_cache_key(url, params)
+    req_cache_file = os.path.join(config.get('_cache_dir'), 'reqcache', request_key + '.json')
+    os.makedirs(os.path.dirname(req_cache_file), exist_ok=True)
     if not skip_cache:
-        request_key = md5(f'{url}'.encode()).hexdigest()
-        req_cache_file = os.path.join(config.get('_cache_dir'), 'reqcache', request_key + '.json')
-        os.makedirs(os.path.dirname(req_cache_file), exist_ok=True)
         if os.path.isfile(req_cache_file):
             logger.debug(f'URL "{url}" cache found! HASH: {request_key}')
             try:
@@ -47,6 +107,37 @@ def make_call(url, params=None, headers=None, session=None, skip_cache=False, te
                 return None
         logger.debug(f'URL "{url}" has cache miss! HASH: {request_key}; Fetching data')
 
+    # Identical concurrent calls, e.g. workers on tracks of one album asking for the
+    # same album, share a single request. Every caller parses its own copy of the body.
+    flight_key = (request_key, skip_cache, _credentials_key(headers, session))
+    with _in_flight_lock:
+        flight = _in_flight.get(flight_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _in_flight[flight_key] = _Flight()
+
+    if is_leader:
+        try:
+            flight.body = _fetch(url, params, headers, session, use_ssl, req_cache_file, revalidate=skip_cache)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with _in_flight_lock:
+                del _in_flight[flight_key]
+            flight.done.set()
+    else:
+        logger.debug(f'URL "{url}" is already being fetched, waiting for the result')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+
+    if flight.body is None or text:
+        return flight.body
+    return json.loads(flight.body)
+
+
+def _fetch(url, params, headers, session, use_ssl, req_cache_file, revalidate=False):
     if session is None:
         session = requests.Session()
 
@@ -55,19 +146,39 @@ def make_call(url, params=None, headers=None, session=None, skip_cache=False, te
         ctx.verify_mode = ssl.CERT_REQUIRED
         session.mount('https://', SSLAdapter(ssl_context=ctx))
 
+    request_headers = dict(headers or {})
+    if revalidate and os.path.isfile(req_cache_file):
+        validators = _load_validators(req_cache_file)
+        if validators.get('etag'):
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            request_headers['If-Modified-Since'] = validators['last_modified']
+
     max_attempts = config.get('api_retry_max_attempts', 3)
     default_delay = config.get('api_retry_default_delay', 1)
 
     for attempt in range(max_attempts):
-        response = session.get(url, headers=headers, params=params)
+        response = session.get(url, headers=request_headers, params=params)
+
+        if response.status_code == 304:
+            try:
+                with open(req_cache_file, 'r', encoding='utf-8') as cf:
+                    logger.debug(f'URL "{url}" not modified, serving cached data')
+                    return cf.read()
+            except OSError:
+                # The cache was cleared while the request was running, ask for the full body
+                request_headers = dict(headers or {})
+                continue
 
         if response.status_code == 200:
-            if not skip_cache:
+            validators = _response_validators(response)
+            # Fresh data endpoints are only worth storing if the server lets us revalidate them
+            if not revalidate or any(validators.values()):
                 with open(req_cache_file, 'w', encoding='utf-8') as cf:
                     cf.write(response.text)
-            if text:
-                return response.text
-            return json.loads(response.text)
+            # Validators are written after the body so they never vouch for older data
+            _save_validators(req_cache_file, validators)
+            return response.text
 
         if response.status_code == 429:
             retry_after = response.headers.get('Retry-After')
@@ -677,6 +788,11 @@ def embed_metadata(item, metadata):
 
 
 def set_music_thumbnail(filename, metadata):
+    # Tagging libraries are only loaded once a thumbnail is needed
+    from mutagen.flac import Picture
+    from mutagen.oggvorbis import OggVorbis
+    import music_tag
+
     # For playlist tracks, use playlist cover URL if available
     image_url = metadata.get('playlist_image_url') if metadata.get('parent_category') == 'playlist' else metadata.get('image_url')
     
@@ -691,33 +807,28 @@ def set_music_thumbnail(filename, metadata):
         # For playlists, save as cover.jpg in playlist directory (only once)
         # For albums/tracks, use configured format
         if metadata.get('parent_category') == 'playlist':
+            image_format = 'jpg'
             image_path = os.path.join(os.path.dirname(filename), 'cover.jpg')
         else:
+            image_format = config.get("album_cover_format")
             image_path = os.path.join(os.path.dirname(filename), 'cover')
-            image_path += "." + config.get("album_cover_format")
-
-        # Fetch thumbnail only if it doesn't exist (avoid re-downloading for each playlist track)
-        if not os.path.isfile(image_path):
-            logger.info(f"Fetching playlist cover image" if metadata.get('parent_category') == 'playlist' else f"Fetching item thumbnail")
-            img = Image.open(BytesIO(requests.get(image_url).content))
-            buf = BytesIO()
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            # Force JPG for playlists, use config for others
-            img_format = 'JPEG' if metadata.get('parent_category') == 'playlist' else config.get("album_cover_format")
-            img.save(buf, format=img_format)
-            buf.seek(0)
-            with open(image_path, 'wb') as cover:
-                cover.write(buf.read())
-            logger.info(f"Saved cover image: {image_path}")
-        else:
-            logger.info(f"Cover image already exists: {image_path}")
+            image_path += "." + image_format
+
+        # Covers are fetched and converted once into the shared cache, embedding reads from there
+        cached_image_path = get_cover_path(image_url, image_format)
+
+        if config.get('save_album_cover'):
+            if not os.path.isfile(image_path):
+                shutil.copyfile(cached_image_path, image_path)
+                logger.info(f"Saved cover image: {image_path}")
+            else:
+                logger.debug(f"Cover image already exists: {image_path}")
 
         if not config.get('raw_media_download'):
             # I have no idea why music tag manages to display covers
             # in file explorer but raw mutagen and ffmpeg do not.
             if config.get('embed_cover') and config.get('windows_10_explorer_thumbnails'):
-                with open(image_path, 'rb') as image_file:
+                with open(cached_image_path, 'rb') as image_file:
                     image_data = image_file.read()
                 tags = music_tag.load_file(filename)
                 tags['artwork'] = image_data
@@ -756,7 +867,7 @@ def set_music_thumbnail(filename, metadata):
                 #        ]
                 #else:
                 command += [
-                    '-i', image_path, '-map', '0:a', '-map', '1:v', '-c', 'copy', '-disposition:v:0', 'attached_pic',
+                    '-i', cached_image_path, '-map', '0:a', '-map', '1:v', '-c', 'copy', '-disposition:v:0', 'attached_pic',
                     '-metadata:s:v', 'title=Cover', '-metadata:s:v', 'comment=Cover (front), -id3v2_version 1'
                     ]
 
@@ -779,7 +890,7 @@ def set_music_thumbnail(filename, metadata):
                     raise RuntimeError(f"Failed to set thumbnail: {e}")
 
             elif config.get('embed_cover') and filetype == '.ogg':
-                with open(image_path, 'rb') as image_file:
+                with open(cached_image_path, 'rb') as image_file:
                     image_data = image_file.read()
                 tags = OggVorbis(filename)
                 logger.info(f"OGG tags before adding cover: {list(tags.keys())}")
@@ -787,7 +898,7 @@ def set_music_thumbnail(filename, metadata):
                 picture.data = image_data
                 picture.type = 3
                 picture.desc = "Cover"
-                picture.mime = f"image/{config.get('album_cover_format')}"
+                picture.mime = 'image/jpeg' if image_format == 'jpg' else f"image/{image_format}"
                 picture_data = picture.write()
                 encoded_data = base64.b64encode(picture_data)
                 vcomment_value = encoded_data.decode("ascii")
@@ -799,10 +910,8 @@ def set_music_thumbnail(filename, metadata):
             if os.path.exists(temp_name):
                 os.remove(temp_name)
 
-        if not config.get('save_album_cover') and os.path.exists(image_path):
-            os.remove(image_path)
-
 def fix_mp3_metadata(filename):
+    from mutagen.id3 import ID3, WOAS, USLT, TCMP, COMM
     id3 = ID3(filename)
     if 'TXXX:WOAS' in id3:
         id3['WOAS'] = WOAS(url=id3['TXXX:WOAS'].text[0])
@@ -854,15 +963,9 @@ def _save_playlist_cache(playlist_name, playlist_by, cache_data):
         logger.error(f"Failed to save playlist cache: {e}")
 
 
-def _add_completed_playlist_item(item, item_metadata):
-    """Track a completed playlist item in cache."""
-    if not item.get('playlist_name'):
-        return
-    
-    cache_data = _load_playlist_cache(item['playlist_name'], item['playlist_by'])
-    
-    # Add this item to completed list (avoid duplicates)
-    item_entry = {
+def build_playlist_entry(item, item_metadata):
+    """M3U entry of a completed playlist item, as kept in the playlist caches."""
+    return {
         'item_id': item.get('item_id'),
         'file_path': item.get('file_path'),
         'playlist_number': item.get('playlist_number'),
@@ -886,6 +989,17 @@ def _add_completed_playlist_item(item, item_metadata):
         'item_service': item.get('item_service'),
         'item_id_full': item.get('item_id')
     }
+
+
+def _add_completed_playlist_item(item, item_metadata):
+    """Track a completed playlist item in cache."""
+    if not item.get('playlist_name'):
+        return
+    
+    cache_data = _load_playlist_cache(item['playlist_name'], item['playlist_by'])
+    
+    # Add this item to completed list (avoid duplicates)
+    item_entry = build_playlist_entry(item, item_metadata)
     
     # Remove any existing entry with same item_id
     cache_data['completed_items'] = [
@@ -897,45 +1011,41 @@ def _add_completed_playlist_item(item, item_metadata):
     _save_playlist_cache(item['playlist_name'], item['playlist_by'], cache_data)
 
 
-def _check_and_write_playlist_m3u(playlist_name, playlist_by, download_queue):
-    """Check if playlist is complete and write M3U if so."""
+def _playlist_download_complete(playlist_name, playlist_by, download_queue):
+    """Whether every queued item of the playlist has finished."""
     if not playlist_name:
         return False
     
-    # Count total items in this playlist from download queue
-    from .runtimedata import download_queue_lock
-    with download_queue_lock:
-        playlist_items = [
-            item for item in download_queue.values()
-            if (item.get('parent_category') == 'playlist' and 
-                item.get('playlist_name') == playlist_name and
-                item.get('playlist_by') == playlist_by)
-        ]
-        
-        total_items = len(playlist_items)
-        completed_items = [item for item in playlist_items if item.get('item_status') in ('Downloaded', 'Already Exists')]
-        completed_count = len(completed_items)
-        
-        # Check if all are completed
-        all_complete = completed_count == total_items and total_items > 0
-        
-        logger.info(f"Playlist '{playlist_name}' status: {completed_count}/{total_items} complete")
-        
-        if not all_complete:
-            pending_items = [(item.get('item_id'), item.get('item_status')) for item in playlist_items if item.get('item_status') not in ('Downloaded', 'Already Exists')]
-            pending_statuses = [status for _, status in pending_items]
-            logger.info(f"Playlist '{playlist_name}' not yet complete. Pending statuses: {set(pending_statuses)}")
-            logger.info(f"Pending items: {pending_items}")
-            return False
+    # Count total items in this playlist from download queue, scanned without the queue lock
+    playlist_items = [
+        item for _, item in download_queue.entries()
+        if (item.get('parent_category') == 'playlist' and 
+            item.get('playlist_name') == playlist_name and
+            item.get('playlist_by') == playlist_by)
+    ]
     
-    # All items complete - write M3U from cache
-    logger.info(f"Playlist '{playlist_name}' complete! Writing M3U file...")
-    cache_data = _load_playlist_cache(playlist_name, playlist_by)
+    total_items = len(playlist_items)
+    completed_items = [item for item in playlist_items if item.get('item_status') in ('Downloaded', 'Already Exists')]
+    completed_count = len(completed_items)
     
-    if not cache_data['completed_items']:
-        logger.warning(f"No completed items in cache for playlist '{playlist_name}'")
-        return False
+    # Check if all are completed
+    all_complete = completed_count == total_items and total_items > 0
     
+    logger.debug(f"Playlist '{playlist_name}' status: {completed_count}/{total_items} complete")
+    
+    if not all_complete:
+        # Listing every pending item is expensive on large playlists, only build it when it is logged
+        if logger.isEnabledFor(logging.DEBUG):
+            pending_items = [(item.get('item_id'), item.get('item_status')) for item in playlist_items if item.get('item_status') not in ('Downloaded', 'Already Exists')]
+            pending_statuses = [status for _, status in pending_items]
+            logger.debug(f"Playlist '{playlist_name}' not yet complete. Pending statuses: {set(pending_statuses)}")
+            logger.debug(f"Pending items: {pending_items}")
+        return False
+    return True
+
+
+def write_playlist_m3u(playlist_name, playlist_by, item_entries):
+    """Write the M3U of a playlist from its completed item entries, ordered by playlist number."""
     # Generate M3U file
     path = config.get("m3u_path_formatter")
     m3u_file = path.format(
@@ -950,7 +1060,7 @@ def _check_and_write_playlist_m3u(playlist_name, playlist_by, download_queue):
     
     # Sort by playlist_number
     sorted_items = sorted(
-        cache_data['completed_items'],
+        item_entries,
         key=lambda x: int(x.get('playlist_number', 999)) if x.get('playlist_number') else 999
     )
     
@@ -992,6 +1102,23 @@ def _check_and_write_playlist_m3u(playlist_name, playlist_by, download_queue):
             f.write(f"{item_entry['file_path']}\n")
     
     logger.info(f"M3U file written: {m3u_path} ({len(sorted_items)} tracks)")
+    return m3u_path
+
+
+def _check_and_write_playlist_m3u(playlist_name, playlist_by, download_queue):
+    """Check if playlist is complete and write M3U if so."""
+    if not _playlist_download_complete(playlist_name, playlist_by, download_queue):
+        return False
+
+    # All items complete - write M3U from cache
+    logger.info(f"Playlist '{playlist_name}' complete! Writing M3U file...")
+    cache_data = _load_playlist_cache(playlist_name, playlist_by)
+    
+    if not cache_data['completed_items']:
+        logger.warning(f"No completed items in cache for playlist '{playlist_name}'")
+        return False
+    
+    write_playlist_m3u(playlist_name, playlist_by, cache_data['completed_items'])
     
     # Clean up cache file
     try:
@@ -1010,13 +1137,20 @@ def add_to_m3u_file(item, item_metadata):
     if not item.get('playlist_name') or item.get('parent_category') != 'playlist':
         return
     
+    from .runtimedata import download_queue
+    if item.get('playlist_sync_key'):
+        # Synced playlists keep their entries in the sync state, which the downloader already updated
+        if _playlist_download_complete(item.get('playlist_name'), item.get('playlist_by'), download_queue):
+            from .playlist_sync import write_m3u
+            write_m3u(item['playlist_sync_key'])
+        return
+
     logger.info(f"Tracking completed playlist item: {item.get('item_id')} for playlist '{item.get('playlist_name')}'")
     
     # Add to cache
     _add_completed_playlist_item(item, item_metadata)
     
     # Check if playlist is complete and write M3U if so
-    from .runtimedata import download_queue
     _check_and_write_playlist_m3u(item.get('playlist_name'), item.get('playlist_by'), download_queue)
 
 
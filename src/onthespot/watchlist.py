@@ -0,0 +1,303 @@
+"""
+Watch list of playlists, artists, labels and other sources that are synced on a schedule.
+
+Sources are kept in the `watchlist` config key with their polling interval.
+Each source starts at a fixed phase within its interval, derived from its
+uuid, and runs are at least `watchlist_min_spacing_seconds` apart, so a long
+watch list is polled evenly over time instead of in bursts. A run expands the
+source and only queues the children that were not seen on an earlier run;
+Spotify playlists use the snapshot based playlist sync instead. The ids seen
+and the statistics of the last run are kept per source in the cache directory.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from hashlib import md5
+from .accounts import get_account_token
+from .backpressure import add_pending
+from .otsconfig import cache_dir, config
+from .parse_item import identify_url, sync_spotify_playlist
+from .runtimedata import get_logger, parsing, parsing_lock
+from .services import get_service_function
+from .utils import format_local_id
+
+logger = get_logger("watchlist")
+
+WATCHABLE_TYPES = ('playlist', 'mix', 'album', 'artist', 'label', 'podcast', 'audiobook', 'show', 'season')
+# Services that work without an account token
+TOKENLESS_SERVICES = ('bandcamp', 'youtube_music', 'generic')
+
+_state_lock = threading.Lock()
+
+
+def _state_path(source_uuid):
+    return os.path.join(cache_dir(), 'watchlist', f'{source_uuid}.json')
+
+
+def _load_state(source_uuid):
+    try:
+        with open(_state_path(source_uuid), 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {'seen': []}
+
+
+def _save_state(source_uuid, state):
+    # Written next to the target and renamed so a crash never leaves a truncated state
+    path = _state_path(source_uuid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.watch.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _initial_phase(source_uuid, interval):
+    # Stable offset within the interval so sources added together don't run together
+    return int(md5(source_uuid.encode()).hexdigest(), 16) % max(1, interval)
+
+
+def _next_run(source, state, now):
+    interval = source['interval_minutes'] * 60
+    next_run = state.get('next_run')
+    if next_run is None:
+        return now + _initial_phase(source['uuid'], interval)
+    while next_run <= now:
+        next_run += interval
+    return next_run
+
+
+def add_source(url, interval_minutes=None):
+    """Watch `url`. Raises ValueError for links that can't be watched."""
+    parsed = identify_url(url)
+    if isinstance(parsed, bool) or parsed[1] not in WATCHABLE_TYPES:
+        raise ValueError(f"Unsupported watch list source: {url}")
+    item_service, item_type, item_id = parsed
+    source = {
+        'uuid': str(uuid.uuid4()),
+        'url': url,
+        'item_service': item_service,
+        'item_type': item_type,
+        'item_id': item_id,
+        'interval_minutes': int(interval_minutes or config.get('watchlist_default_interval_minutes'))
+    }
+    with _state_lock:
+        sources = config.get('watchlist', []).copy()
+        sources.append(source)
+        config.set('watchlist', sources)
+        config.save()
+        config.flush()
+        _save_state(source['uuid'], {'seen': [], 'next_run': _next_run(source, {}, time.time())})
+    logger.info(f"Watching {item_service} {item_type} {item_id} every {source['interval_minutes']} minutes")
+    return source
+
+
+def remove_source(source_uuid):
+    with _state_lock:
+        sources = config.get('watchlist', [])
+        remaining = [source for source in sources if source['uuid'] != source_uuid]
+        if len(remaining) == len(sources):
+            return False
+        config.set('watchlist', remaining)
+        config.save()
+        config.flush()
+        try:
+            os.remove(_state_path(source_uuid))
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def run_now(source_uuid):
+    """Make a source due immediately, it still waits for the minimum spacing between runs."""
+    with _state_lock:
+        if not any(source['uuid'] == source_uuid for source in config.get('watchlist', [])):
+            return False
+        state = _load_state(source_uuid)
+        state['next_run'] = time.time()
+        _save_state(source_uuid, state)
+    return True
+
+
+def get_watchlist():
+    """Watched sources with the statistics of their last run."""
+    watchlist = []
+    with _state_lock:
+        for source in config.get('watchlist', []):
+            state = _load_state(source['uuid'])
+            entry = dict(source)
+            entry.update({key: value for key, value in state.items() if key != 'seen'})
+            entry['seen_items'] = len(state['seen'])
+            watchlist.append(entry)
+    return watchlist
+
+
+def _queue_pending(item_service, item_type, item_id, **context):
+    local_id = format_local_id(item_id)
+    add_pending(local_id, dict(
+        local_id=local_id,
+        item_service=item_service,
+        item_type=item_type,
+        item_id=item_id,
+        priority='bulk',
+        **context
+    ))
+
+
+def _expand(source, token):
+    """Child ids of a source and a function that queues one of them by its position."""
+    item_service, item_type, item_id = source['item_service'], source['item_type'], source['item_id']
+
+    if item_type in ('artist', 'label'):
+        if item_service == 'youtube_music' and item_type == 'artist':
+            track_ids = get_service_function(item_service, 'get_channel_track_ids')(token, item_id)
+            return track_ids, lambda index, track_id: _queue_pending(item_service, 'track', track_id, parent_category='album')
+
+        def queue_album(index, album_id):
+            with parsing_lock:
+                parsing[album_id] = {
+                    'item_url': '',
+                    'item_service': item_service,
+                    'item_type': 'album',
+                    'item_id': album_id,
+                    'priority': 'bulk'
+                }
+        return get_service_function(item_service, f"get_{item_type}_album_ids")(token, item_id), queue_album
+
+    if item_type in ('podcast', 'audiobook', 'show', 'season'):
+        episode_type = 'podcast_episode' if item_type in ('podcast', 'audiobook') else 'episode'
+        episode_ids = get_service_function(item_service, f"get_{item_type}_episode_ids")(token, item_id)
+        return episode_ids, lambda index, episode_id: _queue_pending(item_service, episode_type, episode_id, parent_category=item_type)
+
+    playlist_name, playlist_by = '', ''
+    if item_type == 'album':
+        track_ids = get_service_function(item_service, 'get_album_track_ids')(token, item_id)
+    elif item_service == 'spotify':
+        items = get_service_function('spotify', 'get_playlist_items')(token, item_id)
+        playlist_name, playlist_by, _ = get_service_function('spotify', 'get_playlist_data')(token, item_id)
+        track_ids = [item['track']['id'] for item in items if item.get('track') and item['track'].get('id')]
+    else:
+        playlist_name, playlist_by, track_ids = get_service_function(item_service, f"get_{item_type}_data")(token, item_id)
+    parent_category = 'album' if item_type == 'album' else 'playlist'
+
+    def queue_track(index, track_id):
+        _queue_pending(
+            item_service, 'track', track_id,
+            parent_category=parent_category,
+            parent_id=item_id if parent_category == 'album' else '',
+            playlist_name=playlist_name,
+            playlist_by=playlist_by,
+            playlist_number=str(index + 1),
+            playlist_total=len(track_ids)
+        )
+    return track_ids, queue_track
+
+
+def sync_source(source):
+    """Queue what is new in `source` since its last run. Returns `(new_items, total_items)`."""
+    token = get_account_token(source['item_service'])
+    if token is None and source['item_service'] not in TOKENLESS_SERVICES:
+        raise RuntimeError(f"No usable {source['item_service']} account")
+
+    if source['item_service'] == 'spotify' and source['item_type'] == 'playlist' and config.get('incremental_playlist_sync'):
+        playlist_info = sync_spotify_playlist(token, source['item_id'], priority='bulk')
+        if playlist_info:
+            return playlist_info['queued'], playlist_info['total']
+
+    child_ids, queue_child = _expand(source, token)
+    with _state_lock:
+        seen = set(_load_state(source['uuid'])['seen'])
+    new_items = 0
+    for index, child_id in enumerate(child_ids):
+        if child_id and child_id not in seen:
+            queue_child(index, child_id)
+            seen.add(child_id)
+            new_items += 1
+    with _state_lock:
+        state = _load_state(source['uuid'])
+        state['seen'] = sorted(seen.union(state['seen']))
+        _save_state(source['uuid'], state)
+    return new_items, len(child_ids)
+
+
+class WatchlistWorker(threading.Thread):
+    """
+    Worker that runs due watch list sources, one at a time and spaced out
+    by `watchlist_min_spacing_seconds`.
+    """
+    def __init__(self):
+        super().__init__()
+        self.is_running = True
+        self.CHECK_INTERVAL = 5
+        self.last_start = 0
+
+    def run(self):
+        logger.info('WatchlistWorker started')
+        while self.is_running:
+            try:
+                time.sleep(self.CHECK_INTERVAL)
+                if time.time() - self.last_start < config.get('watchlist_min_spacing_seconds'):
+                    continue
+                source = self._next_due_source()
+                if source:
+                    self.last_start = time.time()
+                    self._run_source(source)
+            except Exception as e:
+                logger.error(f"Error in WatchlistWorker: {e}")
+
+    def _next_due_source(self):
+        now = time.time()
+        due = []
+        with _state_lock:
+            for source in config.get('watchlist', []):
+                state = _load_state(source['uuid'])
+                next_run = state.get('next_run')
+                if next_run is None:
+                    state['next_run'] = next_run = _next_run(source, state, now)
+                    _save_state(source['uuid'], state)
+                if next_run <= now:
+                    due.append((next_run, source))
+        if not due:
+            return None
+        return min(due, key=lambda entry: entry[0])[1]
+
+    def _run_source(self, source):
+        logger.info(f"Syncing watched {source['item_service']} {source['item_type']}: {source['url']}")
+        started = time.time()
+        new_items, total_items, error = 0, None, None
+        try:
+            new_items, total_items = sync_source(source)
+        except Exception as e:
+            logger.error(f"Failed to sync watched source {source['url']}: {e}")
+            error = str(e)
+        duration = time.time() - started
+
+        with _state_lock:
+            if not any(watched['uuid'] == source['uuid'] for watched in config.get('watchlist', [])):
+                # Removed while it was running
+                return
+            state = _load_state(source['uuid'])
+            state.update({
+                'last_run': started,
+                'last_duration': duration,
+                'last_new_items': new_items,
+                'last_total_items': total_items,
+                'last_error': error,
+                'runs': state.get('runs', 0) + 1,
+                'next_run': _next_run(source, state, time.time())
+            })
+            _save_state(source['uuid'], state)
+        logger.info(f"Watched source {source['url']} synced in {duration:.1f}s, {new_items} new of {total_items} items")
+
+    def stop(self):
+        logger.info('Stopping Watchlist Worker')
+        self.is_running = False
+        self.join(timeout=5)
@@ -3,7 +3,6 @@ from datetime import timedelta
 # Required for librespot-python
 os.environ['PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION'] = 'python'
 import argparse
-import json
 import shutil
 import subprocess
 import sys
@@ -14,16 +13,6 @@ from flask import Flask, jsonify, render_template, redirect, request, send_file,
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_socketio import SocketIO, emit
 from .accounts import FillAccountPool, get_account_token
-from .api.apple_music import apple_music_get_track_metadata, apple_music_add_account, apple_music_login_user
-from .api.bandcamp import bandcamp_get_track_metadata, bandcamp_login_user
-from .api.deezer import deezer_get_track_metadata, deezer_add_account, deezer_login_user
-from .api.qobuz import qobuz_get_track_metadata, qobuz_add_account, qobuz_login_user
-from .api.soundcloud import soundcloud_get_track_metadata, soundcloud_add_account, soundcloud_login_user
-from .api.spotify import MirrorSpotifyPlayback, spotify_new_session, spotify_get_track_metadata, spotify_get_podcast_episode_metadata, spotify_login_user
-from .api.tidal import tidal_get_track_metadata, tidal_login_user
-from .api.youtube_music import youtube_music_get_track_metadata, youtube_music_add_account, youtube_music_login_user
-from .api.crunchyroll import crunchyroll_get_episode_metadata, crunchyroll_add_account, crunchyroll_login_user
-from .api.generic import generic_add_account, generic_login_user
 try:
     from .api.plex import plex_api
     PLEX_AVAILABLE = True
@@ -31,13 +20,24 @@ except Exception as e:
     print(f"WARNING: Failed to import Plex API: {e}")
     PLEX_AVAILABLE = False
     plex_api = None
+from .backpressure import download_queue_room, get_backpressure_stats, spill_store
+from .cover_cache import clear_cover_cache
 from .downloader import DownloadWorker, RetryWorker
-from .otsconfig import cache_dir, config_dir, config
+from .instrumented_lock import get_lock_stats, lock_owner
+from .item_timing import get_recent_timings, get_stage_stats
+from .otsconfig import cache_dir, config
 from .parse_item import parsingworker, parse_url
-from .runtimedata import get_logger, account_pool, pending, download_queue, download_queue_lock, pending_lock, parsing, parsing_lock, register_worker, set_worker_restart_callback, set_watchdog_restart_callback, system_notifications, system_notifications_lock, album_download_locks, album_download_locks_lock
+from .profiler import collapsed_stacks, get_memory_status, get_profiler_status, memory_diff, start_memory_tracing, start_profiler, stop_memory_tracing, stop_profiler
+from .queue_item import QueueItem, as_queue_item
+from .recovery import get_incidents, recover_stalled_item, recover_stuck_flags, report_lock, review_incidents
+from .runtimedata import get_logger, account_pool, pending, download_queue, download_queue_lock, pending_lock, parsing, parsing_lock, register_worker, set_worker_restart_callback, set_watchdog_restart_callback, system_notifications, system_notifications_lock
 from . import runtimedata
+from .scheduler import CLAIMED_STATUS, admit_pending, get_service_stats, get_user_stats, item_priority, metadata_slot, set_priority
 from .search import get_search_results
+from .services import get_service_function, loaded_services
+from .staging import get_staging_stats
 from .utils import format_bytes
+from .watchlist import WatchlistWorker, add_source, get_watchlist, remove_source, run_now
 
 logger = get_logger("web")
 _restart_lock = threading.Lock()
@@ -48,29 +48,26 @@ def _cache_download_queue_to_disk():
     """Persist the current download queue so the new process can resume it."""
     import json
     cached_path = os.path.join(cache_dir(), 'cached_download_queue.json')
-    # Never block forever here: hard restart must remain possible even if the queue lock is stuck.
-    lock_acquired = download_queue_lock.acquire(timeout=3)
-    if not lock_acquired:
-        raise TimeoutError("Timed out acquiring download_queue_lock while caching queue")
-    try:
-        # Save essential metadata to preserve playlist context
-        items_to_cache = []
-        for item in download_queue.values():
-            items_to_cache.append({
-                'item_url': item.get('item_url'),
-                'item_service': item.get('item_service'),
-                'item_type': item.get('item_type'),
-                'item_id': item.get('item_id'),
-                'parent_category': item.get('parent_category'),
-                'playlist_name': item.get('playlist_name'),
-                'playlist_by': item.get('playlist_by'),
-                'playlist_number': item.get('playlist_number'),
-                'playlist_total': item.get('playlist_total')
-            })
-        with open(cached_path, 'w') as file:
-            json.dump(items_to_cache, file, indent=2)
-    finally:
-        download_queue_lock.release()
+    # Read from a snapshot, hard restart must remain possible even if the queue lock is stuck
+    _, entries = download_queue.snapshot()
+    # Save essential metadata to preserve playlist context
+    items_to_cache = []
+    for item in entries.values():
+        items_to_cache.append({
+            'item_url': item.get('item_url'),
+            'item_service': item.get('item_service'),
+            'item_type': item.get('item_type'),
+            'item_id': item.get('item_id'),
+            'parent_category': item.get('parent_category'),
+            'playlist_name': item.get('playlist_name'),
+            'playlist_by': item.get('playlist_by'),
+            'playlist_number': item.get('playlist_number'),
+            'playlist_total': item.get('playlist_total'),
+            'priority': item.get('priority'),
+            'user': item.get('user')
+        })
+    with open(cached_path, 'w') as file:
+        json.dump(items_to_cache, file, indent=2)
     return cached_path
 
 
@@ -107,6 +104,12 @@ def trigger_hard_restart(reason):
         # Caching is best-effort; do not let it prevent restart.
         logger.error(f"Failed to cache download queue before restart: {e}")
 
+    # os._exit skips atexit handlers, persist pending config changes first
+    try:
+        config.flush()
+    except Exception as e:
+        logger.error(f"Failed to save config before restart: {e}")
+
     try:
         subprocess.Popen([sys.executable, '-m', 'onthespot.web'] + (sys.argv[1:]))
     except Exception as e:
@@ -115,6 +118,7 @@ def trigger_hard_restart(reason):
             _restart_in_progress = False
         return
 
+    runtimedata.flush_logs()
     os._exit(0)
 os.environ['FLASK_ENV'] = 'production'
 web_resources = os.path.join(config.app_root, 'resources', 'web')
@@ -157,18 +161,26 @@ class QueueWorker(threading.Thread):
                     # Process pending items in batches to avoid long blocking for huge playlists
                     BATCH_SIZE = 50  # Process 50 items at a time
                     with pending_lock:
-                        # Get first BATCH_SIZE items
-                        all_items = list(pending.items())
-                        # Sort by playlist number to maintain order
-                        all_items.sort(key=lambda x: int(x[1].get('playlist_number', 0) or 0))
+                        # Higher priority lanes first, users taking turns, then by playlist number to maintain order.
+                        # Items of users at their queue quota, or beyond the download queue's high water mark, stay pending.
+                        all_items, deferred = admit_pending(list(pending.items()), download_queue_room())
                         
+                        # Get first BATCH_SIZE items
                         items_to_process = all_items[:BATCH_SIZE]
                         # Remove processed items from pending
                         for local_id, _ in items_to_process:
                             del pending[local_id]
                         
-                        remaining = len(pending)
+                        remaining = len(all_items) - len(items_to_process)
+                    
+                    if not items_to_process:
+                        # Everything left is held back by quotas or a full download queue, don't keep downloads paused for it
+                        runtimedata.set_batch_queue_processing_flag(False)
+                        time.sleep(1)
+                        continue
                     
+                    if deferred:
+                        logger.debug(f"QueueWorker holding back {deferred} pending items of users at their quota or for a full download queue")
                     logger.info(f"QueueWorker processing {len(items_to_process)} items from pending queue ({remaining} remaining)")
                     
                     for local_id, item in items_to_process:
@@ -176,26 +188,15 @@ class QueueWorker(threading.Thread):
                             logger.debug(f"QueueWorker processing item: {local_id} (service: {item['item_service']}, type: {item['item_type']})")
                             token = get_account_token(item['item_service'])
                             
-                            # For Spotify albums, use album lock to serialize track_number lookups
-                            album_lock_ctx = None
-                            if item['item_service'] == "spotify" and item.get('parent_category') == 'album' and item.get('parent_id'):
-                                album_key = f"{item['item_service']}:{item.get('parent_id')}"
-                                with album_download_locks_lock:
-                                    if album_key not in album_download_locks:
-                                        album_download_locks[album_key] = threading.Lock()
-                                    album_lock_ctx = album_download_locks[album_key]
-                            
-                            if album_lock_ctx:
-                                item_metadata = globals()[f"{item['item_service']}_get_{item['item_type']}_metadata"](token, item['item_id'], album_lock=album_lock_ctx)
-                            else:
-                                item_metadata = globals()[f"{item['item_service']}_get_{item['item_type']}_metadata"](token, item['item_id'])
+                            with metadata_slot(item['item_service']):
+                                item_metadata = get_service_function(item['item_service'], f"get_{item['item_type']}_metadata")(token, item['item_id'])
                             if item_metadata:
                                 # Preserve playlist context from pending item
                                 playlist_total = item.get('playlist_total')
                                 logger.debug(f"QueueWorker: Processing {local_id}, pending item keys: {list(item.keys())}, playlist_total={playlist_total}, playlist_number={item.get('playlist_number')}")
                                 
                                 with download_queue_lock:
-                                    download_queue[local_id] = {
+                                    download_queue[local_id] = QueueItem({
                                         'local_id': local_id,
                                         'available': True,
                                         "item_service": item["item_service"],
@@ -210,6 +211,9 @@ class QueueWorker(threading.Thread):
                                         'playlist_by': item.get('playlist_by'),
                                         'playlist_number': item.get('playlist_number'),
                                         'playlist_total': playlist_total,
+                                        'playlist_sync_key': item.get('playlist_sync_key'),
+                                        'priority': item_priority(item),
+                                        'user': item.get('user'),
                                         'track_number': item_metadata.get('track_number'),
                                         'album_name': item_metadata.get('album_name'),
                                         'item_album_name': item_metadata.get('album_name'),
@@ -217,11 +221,11 @@ class QueueWorker(threading.Thread):
                                         'item_url': item_metadata["item_url"],
                                         'progress': 0,
                                         'last_update_time': time.time()
-                                    }
+                                    })
                         except Exception as e:
                             logger.error(f"Error processing {local_id}: {str(e)}\nTraceback: {traceback.format_exc()}")
                             with pending_lock:
-                                pending[local_id] = item
+                                pending[local_id] = as_queue_item(item)
                     
                     logger.info(f"QueueWorker finished processing batch, {len(download_queue)} items now in download queue")
                     
@@ -245,7 +249,10 @@ class WatchdogWorker(threading.Thread):
     Worker that monitors for stuck batch operation flags and stuck downloads.
     Checks every 30 seconds for:
     1. Batch operation flags that have been stuck longer than timeout
-    2. Downloads stuck in "Downloading" state without progress updates
+    2. A download_queue_lock that cannot be acquired
+    3. Downloads stuck in "Downloading" state without progress updates
+    Problems are handed to the graduated recovery in recovery.py, which only
+    restarts the process as a last resort.
     """
     def __init__(self):
         super().__init__()
@@ -261,32 +268,34 @@ class WatchdogWorker(threading.Thread):
                 
                 # Check and clear stuck flags
                 from .runtimedata import check_and_clear_stuck_flags
-                if check_and_clear_stuck_flags():
+                cleared_flags = check_and_clear_stuck_flags()
+                if cleared_flags:
                     logger.warning("Watchdog cleared stuck flags - workers should resume")
+                    recover_stuck_flags(cleared_flags)
                 
                 # Check for stuck downloads
-                stuck_detected = False
+                stalled = []
                 lock_acquired = download_queue_lock.acquire(timeout=2)
                 if not lock_acquired:
-                    logger.error("⚠️ WATCHDOG ALERT: download_queue_lock could not be acquired (possible deadlock)")
-                    stuck_detected = True
+                    owner = lock_owner(download_queue_lock)
+                    held_by = f", held by {owner}" if owner else ""
+                    logger.error(f"⚠️ WATCHDOG ALERT: download_queue_lock could not be acquired (possible deadlock){held_by}")
+                    report_lock('download_queue_lock', False, owner)
                 else:
-                    try:
-                        current_time = time.time()
-                        for local_id, item in download_queue.items():
-                            # Check if item has been in "Downloading" state for too long without updates
-                            if item['item_status'] == 'Downloading':
-                                last_update = item.get('last_update_time', 0)
-                                if last_update > 0 and current_time - last_update > stuck_timeout:
-                                    logger.error(f"⚠️ WATCHDOG ALERT: Download stuck for {int(current_time - last_update)}s without progress: {item.get('item_name', 'Unknown')} (ID: {local_id})")
-                                    stuck_detected = True
-                                    break
-                    finally:
-                        download_queue_lock.release()
-                
-                if stuck_detected:
-                    logger.error("🚨 WATCHDOG: Triggering hard restart due to stuck download...")
-                    trigger_hard_restart("watchdog detected stuck download")
+                    download_queue_lock.release()
+                    report_lock('download_queue_lock', True)
+                    current_time = time.time()
+                    for local_id, item in download_queue.entries():
+                        # Check if a claimed or downloading item has gone too long without updates
+                        if item['item_status'] in (CLAIMED_STATUS, 'Downloading'):
+                            last_update = item.get('last_update_time', 0)
+                            if last_update > 0 and current_time - last_update > stuck_timeout:
+                                logger.error(f"⚠️ WATCHDOG ALERT: Download stuck for {int(current_time - last_update)}s without progress: {item.get('item_name', 'Unknown')} (ID: {local_id})")
+                                stalled.append((local_id, item))
+
+                for local_id, item in stalled:
+                    recover_stalled_item(local_id, item)
+                review_incidents(stuck_timeout)
                     
             except Exception as e:
                 logger.error(f"Error in WatchdogWorker: {e}\nTraceback: {traceback.format_exc()}")
@@ -349,70 +358,72 @@ class AutoClearWorker(threading.Thread):
             try:
                 time.sleep(5)  # Check every 5 seconds
 
-                with download_queue_lock:
-                    if not download_queue:
-                        # Queue is empty, reset timer
-                        self.last_all_done_time = None
-                        continue
+                # Scanned without the queue lock, only clearing below changes the queue
+                entries = download_queue.entries()
+                if not entries:
+                    # Queue is empty, reset timer
+                    self.last_all_done_time = None
+                    continue
 
-                    # Check if all items are in a "done" state
-                    all_done = True
-                    all_successful = True
-                    for local_id, item in download_queue.items():
-                        status = item.get("item_status", "")
-                        if status not in ("Downloaded", "Already Exists", "Cancelled", "Unavailable", "Deleted", "Failed"):
-                            # Found an item that's still in progress
-                            all_done = False
-                            break
-                        # Check if this item failed (for Plex scan decision)
-                        if status in ("Failed", "Cancelled", "Unavailable"):
-                            all_successful = False
-
-                    if all_done:
-                        # All items are done
-                        if self.last_all_done_time is None:
-                            # First time we've noticed everything is done
-                            self.last_all_done_time = time.time()
-                            logger.info(f"All downloads complete. Will auto-clear in {self.CLEAR_DELAY_SECONDS} seconds...")
-                            
-                            # Trigger Plex library scan if enabled (only if all successful)
-                            if config.get('plex_auto_scan', False) and all_successful:
-                                try:
-                                    from .api.plex import plex_api
-                                    logger.info("Triggering Plex library scan after download completion...")
-                                    result = plex_api.scan_library()
-                                    if result.get('success'):
-                                        logger.info("Plex library scan triggered successfully")
-                                        # Add notification for web UI
-                                        with system_notifications_lock:
-                                            system_notifications.append({
-                                                'timestamp': time.time(),
-                                                'message': 'Added to Plex',
-                                                'type': 'success'
-                                            })
-                                    else:
-                                        logger.warning(f"Plex library scan failed: {result.get('error')}")
-                                        with system_notifications_lock:
-                                            system_notifications.append({
-                                                'timestamp': time.time(),
-                                                'message': f"Plex library scan failed: {result.get('error')}",
-                                                'type': 'error'
-                                            })
-                                except Exception as e:
-                                    logger.error(f"Failed to trigger Plex library scan: {e}")
+                # Check if all items are in a "done" state
+                all_done = True
+                all_successful = True
+                for local_id, item in entries:
+                    status = item.get("item_status", "")
+                    if status not in ("Downloaded", "Already Exists", "Cancelled", "Unavailable", "Deleted", "Failed"):
+                        # Found an item that's still in progress
+                        all_done = False
+                        break
+                    # Check if this item failed (for Plex scan decision)
+                    if status in ("Failed", "Cancelled", "Unavailable"):
+                        all_successful = False
+
+                if all_done:
+                    # All items are done
+                    if self.last_all_done_time is None:
+                        # First time we've noticed everything is done
+                        self.last_all_done_time = time.time()
+                        logger.info(f"All downloads complete. Will auto-clear in {self.CLEAR_DELAY_SECONDS} seconds...")
+                        
+                        # Trigger Plex library scan if enabled (only if all successful)
+                        if config.get('plex_auto_scan', False) and all_successful:
+                            try:
+                                from .api.plex import plex_api
+                                logger.info("Triggering Plex library scan after download completion...")
+                                result = plex_api.scan_library()
+                                if result.get('success'):
+                                    logger.info("Plex library scan triggered successfully")
+                                    # Add notification for web UI
                                     with system_notifications_lock:
                                         system_notifications.append({
                                             'timestamp': time.time(),
-                                            'message': f"Failed to trigger Plex library scan: {str(e)}",
+                                            'message': 'Added to Plex',
+                                            'type': 'success'
+                                        })
+                                else:
+                                    logger.warning(f"Plex library scan failed: {result.get('error')}")
+                                    with system_notifications_lock:
+                                        system_notifications.append({
+                                            'timestamp': time.time(),
+                                            'message': f"Plex library scan failed: {result.get('error')}",
                                             'type': 'error'
                                         })
-                        else:
-                            # Check if enough time has passed
-                            elapsed = time.time() - self.last_all_done_time
-                            if elapsed >= self.CLEAR_DELAY_SECONDS:
-                                # Time to clear!
-                                logger.info("Auto-clearing completed downloads...")
-                                keys_to_delete = []
+                            except Exception as e:
+                                logger.error(f"Failed to trigger Plex library scan: {e}")
+                                with system_notifications_lock:
+                                    system_notifications.append({
+                                        'timestamp': time.time(),
+                                        'message': f"Failed to trigger Plex library scan: {str(e)}",
+                                        'type': 'error'
+                                    })
+                    else:
+                        # Check if enough time has passed
+                        elapsed = time.time() - self.last_all_done_time
+                        if elapsed >= self.CLEAR_DELAY_SECONDS:
+                            # Time to clear!
+                            logger.info("Auto-clearing completed downloads...")
+                            keys_to_delete = []
+                            with download_queue_lock:
                                 for local_id, item in download_queue.items():
                                     if item["item_status"] in ("Downloaded", "Already Exists", "Cancelled", "Unavailable", "Deleted"):
                                         keys_to_delete.append(local_id)
@@ -420,13 +431,13 @@ class AutoClearWorker(threading.Thread):
                                 for key in keys_to_delete:
                                     del download_queue[key]
 
-                                logger.info(f"Auto-cleared {len(keys_to_delete)} items from download queue")
-                                self.last_all_done_time = None
-                    else:
-                        # Not all items are done, reset timer
-                        if self.last_all_done_time is not None:
-                            logger.debug("New downloads detected, resetting auto-clear timer")
-                        self.last_all_done_time = None
+                            logger.info(f"Auto-cleared {len(keys_to_delete)} items from download queue")
+                            self.last_all_done_time = None
+                else:
+                    # Not all items are done, reset timer
+                    if self.last_all_done_time is not None:
+                        logger.debug("New downloads detected, resetting auto-clear timer")
+                    self.last_all_done_time = None
 
             except Exception as e:
                 logger.error(f"Error in AutoClearWorker: {str(e)}\nTraceback: {traceback.format_exc()}")
@@ -444,6 +455,10 @@ class WebSocketBroadcaster(threading.Thread):
         super().__init__()
         self.is_running = True
         self.daemon = True
+        self.last_version = None
+        self.last_emit = 0
+        self.last_progress = None
+        self.REFRESH_SECONDS = 5
 
     def run(self):
         logger.info('WebSocketBroadcaster started')
@@ -451,11 +466,21 @@ class WebSocketBroadcaster(threading.Thread):
             try:
                 time.sleep(0.1)  # Broadcast 10 times per second for real-time updates
                 
-                with download_queue_lock:
-                    queue_data = dict(download_queue)
-                
-                # Emit queue update to all connected clients
-                socketio.emit('queue_update', queue_data, namespace='/')
+                # Snapshots are shared with /api/download_queue and taken without the queue lock
+                version, queue_data = download_queue.snapshot()
+                if version != self.last_version or time.time() - self.last_emit >= self.REFRESH_SECONDS:
+                    # Emit queue update to all connected clients
+                    socketio.emit('queue_update', queue_data, namespace='/')
+                    self.last_version = version
+                    self.last_emit = time.time()
+                    # Snapshots may carry older progress, the update below follows right away
+                    self.last_progress = None
+
+                # Progress doesn't change the version, it is sent on its own and only for active items
+                progress = download_queue.progress()
+                if progress != self.last_progress:
+                    socketio.emit('progress_update', progress, namespace='/')
+                    self.last_progress = progress
                 
             except Exception as e:
                 logger.error(f"Error in WebSocketBroadcaster: {str(e)}")
@@ -519,11 +544,7 @@ def login():
             return redirect(url_for('search'))
         flash('Invalid credentials, please try again.')
 
-    # Load config for template
-    config_path = os.path.join(config_dir(), 'otsconfig.json')
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
-    return render_template('login.html', config=config_data)
+    return render_template('login.html', config=config.as_dict())
 
 
 @app.route('/api/auth/plex', methods=['POST'])
@@ -688,18 +709,13 @@ def index():
 @app.route('/search')
 @login_required
 def search():
-    config_path = os.path.join(config_dir(), 'otsconfig.json')
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
-    return render_template('search.html', config=config_data, user=current_user)
+    return render_template('search.html', config=config.as_dict(), user=current_user)
 
 
 @app.route('/download_queue')
 @login_required
 def download_queue_page():
-    config_path = os.path.join(config_dir(), 'otsconfig.json')
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
+    config_data = config.as_dict()
     if socketio.async_mode == "threading":
         socketio_transports = ["polling"]
     else:
@@ -710,10 +726,7 @@ def download_queue_page():
 @app.route('/settings')
 @admin_required
 def settings():
-    config_path = os.path.join(config_dir(), 'otsconfig.json')
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
-    return render_template('settings.html', config=config_data, account_pool=account_pool)
+    return render_template('settings.html', config=config.as_dict(), account_pool=account_pool)
 
 
 @app.route('/about')
@@ -818,11 +831,12 @@ def cancel_items():
     # Clear pending queue
     with pending_lock:
         pending.clear()
+        spill_store.clear()
     
     # Cancel all items in download queue that are waiting or downloading
     with download_queue_lock:
         for local_id, item in download_queue.items():
-            if item["item_status"] in ("Waiting", "Downloading"):
+            if item["item_status"] in ("Waiting", CLAIMED_STATUS, "Downloading"):
                 download_queue[local_id]['item_status'] = 'Cancelled'
     
     return jsonify(success=True)
@@ -840,16 +854,15 @@ def retry_items():
                 break
 
     # If there are failed downloads, force reconnect all Spotify accounts
-    if has_failed_downloads:
+    if has_failed_downloads and any(account.get('service') == 'spotify' for account in account_pool):
         logger.info("Found failed downloads - forcing Spotify account reconnection before retry")
-        from .api.spotify import spotify_re_init_session
 
         reconnected_count = 0
         for account_idx, account in enumerate(account_pool):
             if account.get('service') == 'spotify' and account.get('login', {}).get('session'):
                 try:
                     logger.info(f"Reconnecting Spotify account {account_idx}: {account.get('username', 'unknown')}")
-                    spotify_re_init_session(account)
+                    get_service_function('spotify', 're_init_session')(account)
                     account['last_session_time'] = time.time()
                     reconnected_count += 1
                 except Exception as e:
@@ -877,8 +890,14 @@ def restart():
 @app.route('/api/download_queue')
 @login_required
 def get_items():
-    with download_queue_lock:
-        return Response(json.dumps(download_queue, sort_keys=True), mimetype='application/json')
+    return Response(download_queue.snapshot_json(), mimetype='application/json')
+
+
+@app.route('/api/download_progress')
+@login_required
+def get_progress():
+    """Current progress of the items being downloaded, /api/download_queue may lag behind on it."""
+    return jsonify(download_queue.progress())
 
 @app.route('/api/cancel/<path:local_id>', methods=['POST'])
 @login_required
@@ -899,6 +918,129 @@ def retry_item(local_id):
     return jsonify(success=True)
 
 
+@app.route('/api/priority', methods=['POST'])
+@login_required
+def change_priority():
+    """Move items, or a whole playlist, to another priority lane."""
+    data = request.get_json()
+    try:
+        changed = set_priority(
+            data.get('priority'),
+            local_ids=data.get('local_ids', []),
+            playlist_name=data.get('playlist_name'),
+            playlist_by=data.get('playlist_by'),
+            # Other users' items are left alone, only admins reorder the whole queue
+            user=None if current_user.is_admin else current_user.id
+        )
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, changed=changed)
+
+
+@app.route('/api/queue_users')
+@admin_required
+def queue_users():
+    """Queue depth, wait time and quota of every user with items in the queue."""
+    return jsonify(users=get_user_stats())
+
+
+@app.route('/api/service_load')
+@admin_required
+def service_load():
+    """Downloads and metadata requests in flight per service against their limits."""
+    return jsonify(services=get_service_stats())
+
+
+@app.route('/api/backpressure')
+@admin_required
+def backpressure():
+    """Pending queue fill, spilled items and whether parsing is paused."""
+    return jsonify(get_backpressure_stats())
+
+
+@app.route('/api/stage_timings')
+@admin_required
+def stage_timings():
+    """Percentiles of the time completed items spent per stage by service, and the latest completions."""
+    service = request.args.get('service') or None
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(services=get_stage_stats(service), recent=get_recent_timings(service, limit))
+
+
+@app.route('/api/locks')
+@admin_required
+def lock_stats():
+    """Acquire waits, hold times, top holders and current owner of the global locks, with instrument_locks on."""
+    return jsonify(enabled=config.get('instrument_locks'), locks=get_lock_stats())
+
+
+@app.route('/api/incidents')
+@admin_required
+def incidents():
+    """Stalls the watchdog recovered from, the steps taken and the downloads each one cost."""
+    return jsonify(get_incidents(request.args.get('limit', 50, type=int)))
+
+
+@app.route('/api/profiler')
+@admin_required
+def profiler_status():
+    """State of the sampling profiler and of memory tracing."""
+    return jsonify(profiler=get_profiler_status(), memory=get_memory_status())
+
+
+@app.route('/api/profiler/start', methods=['POST'])
+@admin_required
+def profiler_start():
+    data = request.get_json(silent=True) or {}
+    try:
+        status = start_profiler(data.get('interval_ms'), data.get('max_seconds'), bool(data.get('include_lines')))
+    except (TypeError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, profiler=status)
+
+
+@app.route('/api/profiler/stop', methods=['POST'])
+@admin_required
+def profiler_stop():
+    return jsonify(success=True, profiler=stop_profiler())
+
+
+@app.route('/api/profiler/stacks')
+@admin_required
+def profiler_stacks():
+    """Sampled stacks in the collapsed format of flamegraph.pl and speedscope."""
+    return Response(collapsed_stacks(), mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=onthespot.collapsed'})
+
+
+@app.route('/api/profiler/memory/start', methods=['POST'])
+@admin_required
+def profiler_memory_start():
+    data = request.get_json(silent=True) or {}
+    try:
+        status = start_memory_tracing(max(1, int(data.get('frames', 1))))
+    except (TypeError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, memory=status)
+
+
+@app.route('/api/profiler/memory')
+@admin_required
+def profiler_memory_diff():
+    """Top allocation changes since memory tracing started, or since the last diff with rebase=true."""
+    try:
+        diff = memory_diff(request.args.get('limit', 10, type=int), request.args.get('rebase') == 'true')
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, memory=diff)
+
+
+@app.route('/api/profiler/memory/stop', methods=['POST'])
+@admin_required
+def profiler_memory_stop():
+    return jsonify(success=True, memory=stop_memory_tracing())
+
+
 @app.route('/api/download/<path:local_id>')
 @login_required
 def download_media(local_id):
@@ -910,7 +1052,7 @@ def download_media(local_id):
 @app.route('/api/parse_url/<path:url>', methods=['POST'])
 @login_required
 def parse_download(url):
-    parse_url(url)
+    parse_url(url, user=current_user.id)
     return jsonify(success=True)
 
 @app.route('/api/notifications', methods=['GET'])
@@ -939,7 +1081,7 @@ def update_settings():
         if isinstance(value, str) and value.isdigit():
             value = int(value)
         config.set(key, value)
-        config.save()
+    config.save()
     return jsonify(success=True)
 
 
@@ -947,22 +1089,13 @@ def update_settings():
 @login_required
 def add_account():
     account = request.get_json()
-    if account['service'] == 'apple_music':
-        apple_music_add_account(account['password'])
-    elif account['service'] == "bandcamp":
-        bandcamp_add_account()
-    elif account['service'] == "deezer":
-        deezer_add_account(account['password'])
-    elif account['service'] == "qobuz":
-        qobuz_add_account(account['email'], account['password'])
-    elif account['service'] == "soundcloud":
-        soundcloud_add_account(account['password'])
-    elif account['service'] == "youtube_music":
-        youtube_music_add_account()
-    elif account['service'] == "crunchyroll":
-        crunchyroll_add_account(account['email'], account['password'])
-    elif account['service'] == "generic":
-        generic_add_account()
+    service = account['service']
+    if service in ('apple_music', 'deezer', 'soundcloud'):
+        get_service_function(service, 'add_account')(account['password'])
+    elif service in ('bandcamp', 'youtube_music', 'generic'):
+        get_service_function(service, 'add_account')()
+    elif service in ('qobuz', 'crunchyroll'):
+        get_service_function(service, 'add_account')(account['email'], account['password'])
     config.set('active_account_number', config.get('active_account_number') + 1)
     config.save()
     return jsonify(success=True)
@@ -988,12 +1121,54 @@ def remove_account(uuid):
 def clear_cache():
     shutil.rmtree(os.path.join(cache_dir(), "reqcache"))
     shutil.rmtree(os.path.join(cache_dir(), "logs"))
-    # Clear in-memory album track IDs cache
-    from .api.spotify import clear_album_track_ids_cache
-    clear_album_track_ids_cache()
+    # Clear in-memory album track IDs cache, only if the Spotify provider was loaded
+    if 'spotify' in loaded_services():
+        get_service_function('spotify', 'clear_album_track_ids_cache')()
+    clear_cover_cache()
     return jsonify(success=True)
 
 
+@app.route('/api/log_stats')
+@admin_required
+def log_stats():
+    return jsonify(runtimedata.get_log_stats())
+
+
+@app.route('/api/staging_stats')
+@admin_required
+def staging_stats():
+    return jsonify(get_staging_stats())
+
+
+@app.route('/api/watchlist', methods=['GET'])
+@admin_required
+def watchlist():
+    return jsonify(get_watchlist())
+
+
+@app.route('/api/watchlist', methods=['POST'])
+@admin_required
+def watchlist_add():
+    data = request.get_json()
+    try:
+        source = add_source(data['url'], data.get('interval_minutes'))
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, source=source)
+
+
+@app.route('/api/watchlist/<source_uuid>', methods=['DELETE'])
+@admin_required
+def watchlist_remove(source_uuid):
+    return jsonify(success=remove_source(source_uuid))
+
+
+@app.route('/api/watchlist/<source_uuid>/run', methods=['POST'])
+@admin_required
+def watchlist_run(source_uuid):
+    return jsonify(success=run_now(source_uuid))
+
+
 # Plex API routes
 @app.route('/plex_playlists')
 @login_required
@@ -1003,9 +1178,7 @@ def plex_playlists():
     if not PLEX_AVAILABLE:
         return jsonify(success=False, error="Plex API not available"), 500
     logger.debug("=== Loading Plex playlists page ===")
-    config_path = os.path.join(config_dir(), 'otsconfig.json')
-    with open(config_path, 'r') as config_file:
-        config_data = json.load(config_file)
+    config_data = config.as_dict()
 
     # Get m3u directory from config
     m3u_formatter = config_data.get('m3u_path_formatter', './m3u/')
@@ -1147,6 +1320,11 @@ def main():
         autoclear_worker.start()
         register_worker(autoclear_worker)
         
+        # Start watch list scheduler
+        watchlist_worker = WatchlistWorker()
+        watchlist_worker.start()
+        register_worker(watchlist_worker)
+        
         # Start WebSocket broadcaster for real-time updates
         ws_broadcaster = WebSocketBroadcaster()
         ws_broadcaster.start()
@@ -1176,13 +1354,13 @@ def main():
             logger.error("Attempting hard restart as fallback...")
             trigger_hard_restart("soft restart failed")
     
-    def watchdog_hard_restart():
+    def watchdog_hard_restart(reason="watchdog detected stuck flags (30s timeout)"):
         """Hard restart triggered by watchdog for stuck system"""
-        trigger_hard_restart("watchdog detected stuck flags (30s timeout)")
+        trigger_hard_restart(reason)
 
     # Register the restart callbacks
     set_worker_restart_callback(restart_workers)  # Soft restart for failure threshold
-    set_watchdog_restart_callback(watchdog_hard_restart)  # Hard restart for stuck flags
+    set_watchdog_restart_callback(watchdog_hard_restart)  # Hard restart when graduated recovery runs out of steps
 
     # Start initial workers
     start_workers()
@@ -1202,7 +1380,7 @@ def main():
             service = account['service']
             try:
                 logger.info(f"Re-initializing account {account.get('uuid', 'unknown')} ({service})")
-                valid_login = globals()[f"{service}_login_user"](account)
+                valid_login = get_service_function(service, "login_user")(account)
                 if valid_login:
                     logger.info(f"Successfully re-initialized account {account.get('uuid', 'unknown')}")
                 else:
@@ -1219,6 +1397,7 @@ def main():
     logger.info(f"Account pool ready: {len(active_accounts)} active accounts out of {len(account_pool)} total")
 
     if config.get('mirror_spotify_playback'):
+        from .api.spotify import MirrorSpotifyPlayback
         mirrorplayback = MirrorSpotifyPlayback()
         mirrorplayback.start()
 
@@ -1247,7 +1426,9 @@ def main():
                         'playlist_name': item_data.get('playlist_name'),
                         'playlist_by': item_data.get('playlist_by'),
                         'playlist_number': item_data.get('playlist_number'),
-                        'playlist_total': item_data.get('playlist_total')
+                        'playlist_total': item_data.get('playlist_total'),
+                        'priority': item_data.get('priority'),
+                        'user': item_data.get('user')
                     }
             logger.info(f'Restored {len(cached_items)} items from cached queue')
             os.remove(cached_file_json)